@@ -414,11 +414,30 @@ dir but you forgot to put quotes around the directory, since it contains spaces.
 
     # Set up the cache objects to use
     caches = []
-    caches.append(cache.LRUCache(size=100))
+    if config.get("chunkcache_mb"):
+        caches.append(cache.LRUCache(size=None,
+            maxbytes=config['chunkcache_mb'] * 1024 * 1024,
+            sizeof=world.estimate_chunk_size))
+    else:
+        caches.append(cache.LRUCache(size=100))
+    if config.get("sharedchunkcache_mb"):
+        caches.append(cache.SharedMemoryCache(
+            config['sharedchunkcache_mb'] * 1024 * 1024,
+            prepare=world.decode_chunk_sections))
+    if config.get("diskchunkcache"):
+        caches.append(cache.DiskCache(config['diskchunkcache'],
+            config['diskchunkcache_mb'] * 1024 * 1024,
+            prepare=world.decode_chunk_sections))
     if config.get("memcached_host", False):
         caches.append(cache.Memcached(config['memcached_host']))
     # TODO: optionally more caching layers here
 
+    # count the corrupt chunks found by all the workers, for the summary
+    corrupt_chunks = set()
+    @world.RegionSet.corrupt_chunk.register
+    def count_corrupt_chunk(regiondir, x, z):
+        corrupt_chunks.add((regiondir, x, z))
+
     renders = config['renders']
     for render_name, render in renders.iteritems():
         logging.debug("Found the following render thing: %r", render)
@@ -452,6 +471,11 @@ dir but you forgot to put quotes around the directory, since it contains spaces.
             logging.error("Sorry, you requested dimension '%s' for %s, but I couldn't find it", render['dimension'][0], render_name)
             return 1
 
+        # Keep the chunk timestamps of unchanged region files in the output
+        # directory, so the chunk scans don't have to open them
+        if rset.timestamp_index is None:
+            rset.use_timestamp_index(destdir)
+
         #################
         # Apply any regionset transformations here
 
@@ -479,8 +503,9 @@ dir but you forgot to put quotes around the directory, since it contains spaces.
 
         # only pass to the TileSet the options it really cares about
         render['name'] = render_name # perhaps a hack. This is stored here for the asset manager
-        tileSetOpts = util.dict_subset(render, ["name", "imgformat", "renderchecks", "rerenderprob", "bgcolor", "defaultzoom", "imgquality", "optimizeimg", "rendermode", "worldname_orig", "title", "dimension", "changelist", "showspawn", "overlay", "base", "poititle", "maxzoom", "showlocationmarker", "minzoom"])
+        tileSetOpts = util.dict_subset(render, ["name", "imgformat", "renderchecks", "rerenderprob", "subtreelevels", "renderorder", "bgcolor", "defaultzoom", "imgquality", "optimizeimg", "rendermode", "worldname_orig", "title", "dimension", "changelist", "showspawn", "overlay", "base", "poititle", "maxzoom", "showlocationmarker", "minzoom"])
         tileSetOpts.update({"spawn": w.find_true_spawn()}) # TODO find a better way to do this
+        tileSetOpts['spritecache_mb'] = config['spritecache_mb']
         tset = tileset.TileSet(w, rset, assetMrg, tex, tileSetOpts, tileset_dir)
         tilesets.append(tset)
 
@@ -501,6 +526,13 @@ dir but you forgot to put quotes around the directory, since it contains spaces.
     dispatch.render_all(tilesets, config['observer'])
     dispatch.close()
 
+    for ts in tilesets:
+        ts.finish()
+
+    if corrupt_chunks:
+        logging.warning("%d corrupt chunks could not be rendered", len(corrupt_chunks))
+    cache.report_hit_rates()
+
     assetMrg.finalize(tilesets)
 
     for out in changelists.itervalues():
@@ -509,8 +541,7 @@ dir but you forgot to put quotes around the directory, since it contains spaces.
 
     if config['processes'] == 1:
         logging.debug("Final cache stats:")
-        for c in caches:
-            logging.debug("\t%s: %s hits, %s misses", c.__class__.__name__, c.hits, c.misses)
+        cache.report_stats()
     if options.pid:
         os.remove(options.pid)
 
@@ -54,7 +54,7 @@ def parseBucketChunks((bucket, rset)):
     l = len(bucket)
     for b in bucket:
         try:
-            data = rset.get_chunk(b[0],b[1])
+            data = rset.get_chunk(b[0],b[1], fields=('TileEntities', 'Entities'))
             pois['TileEntities'] += data['TileEntities']
             pois['Entities']     += data['Entities']
         except nbt.CorruptChunkError:
@@ -87,7 +87,7 @@ def handleEntities(rset, outputdir, render, rname, config):
     if numbuckets == 1:
         for (x,z,mtime) in rset.iterate_chunks():
             try:
-                data = rset.get_chunk(x,z) 
+                data = rset.get_chunk(x,z, fields=('TileEntities', 'Entities'))
                 rset._pois['TileEntities'] += data['TileEntities']
                 rset._pois['Entities']     += data['Entities']
             except nbt.CorruptChunkError:
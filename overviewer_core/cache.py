@@ -19,11 +19,108 @@ Each cache class should implement the standard container type interface
 (__getitem__ and __setitem__), as well as provide a "hits" and "misses"
 attribute.
 
+Keys are tuples. A cache that can only store string keys, such as one kept
+outside this process, should set a true "digest_keys" attribute; it is then
+given digest_key(key) instead of the key itself. A cache whose items outlive
+the render should set a true "persistent" attribute; its keys then carry
+whatever the item depends on (for chunks, the chunk's mtime), so an item
+that changed is never returned.
+
 """
+import atexit
 import functools
+import hashlib
 import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import weakref
 import cPickle
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import numpy
+
+# Every cache object created in this process, including the copies unpickled
+# in worker processes, so their statistics can be reported at the end
+_live_caches = weakref.WeakSet()
+
+# The open files of the SharedMemoryCaches created in this process, by path.
+# Their paths are unlinked straight away, so worker processes forked from
+# this one map the file through the descriptor they inherit
+_shared_files = {}
+
+def estimate_size(value):
+    """Estimates the number of bytes held by value, walking into dicts, lists
+    and tuples. Only numpy arrays and strings are counted, which is where
+    nearly all of the memory of a parsed chunk is.
+
+    """
+    if isinstance(value, numpy.ndarray):
+        return value.nbytes
+    elif isinstance(value, (str, unicode, buffer)):
+        return len(value)
+    elif isinstance(value, dict):
+        return sum(estimate_size(v) for v in value.itervalues())
+    elif isinstance(value, (list, tuple)):
+        return sum(estimate_size(v) for v in value)
+    return 0
+
+def digest_key(key):
+    """Returns a string digest of a tuple key, for caches with digest_keys"""
+    return hashlib.md5(repr(key)).hexdigest()
+
+# the hits and misses of caches in other processes, as sent by
+# add_counts()
+_remote_counts = {}
+
+def get_counts():
+    """Returns the hits and misses of every cache in this process, totalled by
+    kind of cache, as a dict mapping class names to (hits, misses) pairs"""
+    counts = {}
+    for c in list(_live_caches):
+        hits, misses = counts.get(c.__class__.__name__, (0, 0))
+        counts[c.__class__.__name__] = (hits + c.hits, misses + c.misses)
+    return counts
+
+def add_counts(counts):
+    """Adds hits and misses in the form get_counts() returns, from caches in
+    another process, to the totals report_hit_rates() gives"""
+    for name, (hits, misses) in counts.iteritems():
+        oldhits, oldmisses = _remote_counts.get(name, (0, 0))
+        _remote_counts[name] = (oldhits + hits, oldmisses + misses)
+
+def report_hit_rates():
+    """Logs the hit rate of each kind of cache, over this process and all
+    the others that sent their counts"""
+    counts = dict(_remote_counts)
+    for name, (hits, misses) in get_counts().iteritems():
+        oldhits, oldmisses = counts.get(name, (0, 0))
+        counts[name] = (oldhits + hits, oldmisses + misses)
+    for name, (hits, misses) in sorted(counts.iteritems()):
+        if hits + misses:
+            logging.info("%s hit rate: %.1f%% (%s of %s lookups)", name,
+                    100.0 * hits / (hits + misses), hits, hits + misses)
+
+def report_stats():
+    """Logs the statistics of every cache in this process"""
+    for c in list(_live_caches):
+        stats = "%s hits, %s misses" % (c.hits, c.misses)
+        if isinstance(c, LRUCache):
+            stats += ", %s evictions, %s items (%.1f MB) resident" % (
+                    c.evictions, len(c.cache), c.bytes / 1048576.0)
+        elif isinstance(c, DiskCache):
+            stats += ", %s evictions" % c.evictions
+        elif isinstance(c, SharedMemoryCache):
+            stats += ", %s stored, %s not stored for lack of room" % (
+                    c.stores, c.full)
+        logging.debug("\t%s (pid %s): %s", c.__class__.__name__, os.getpid(), stats)
+
 class LRUCache(object):
     """A simple, generic, in-memory LRU cache that implements the standard
     python container interface.
@@ -40,22 +137,37 @@ class LRUCache(object):
     first item of the list is evicted. All operations have constant time
     complexity (dict lookups are worst case O(n) time)
 
+    The cache can also be bounded by a byte budget instead of (or as well as)
+    an item count. Items are then evicted from the front of the list until the
+    estimated size of everything in the cache fits in the budget.
+
+    All operations hold a lock, so a cache may be shared with the chunk
+    prefetch thread of a worker process.
+
     """
     class _LinkNode(object):
-        __slots__ = ['left', 'right', 'key', 'value']
-        def __init__(self,l=None,r=None,k=None,v=None):
+        __slots__ = ['left', 'right', 'key', 'value', 'nbytes']
+        def __init__(self,l=None,r=None,k=None,v=None,n=0):
             self.left = l
             self.right = r
             self.key = k
             self.value = v
+            self.nbytes = n
 
-    def __init__(self, size=100, destructor=None):
-        """Initialize a new LRU cache with the given size.
+    digest_keys = False
+
+    def __init__(self, size=100, destructor=None, maxbytes=None, sizeof=estimate_size):
+        """Initialize a new LRU cache with the given size. A size of None
+        means there is no limit on the number of items.
 
         destructor, if given, is a callable that is called upon an item being
         evicted from the cache. It takes one argument, the value stored in the
         cache.
 
+        maxbytes, if given, is the most bytes the items in the cache may take
+        up, as estimated by the sizeof callable. The most recently added item
+        is never evicted, even if it alone is over the budget.
+
         """
         self.cache = {}
 
@@ -68,75 +180,496 @@ class LRUCache(object):
 
         self.hits = 0
         self.misses = 0
+        self.evictions = 0
 
         self.size = size
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        # estimated size of everything in the cache
+        self.bytes = 0
 
         self.destructor = destructor
 
+        self._lock = threading.Lock()
+
+        _live_caches.add(self)
+
     # Initialize an empty cache of the same size for worker processes
     def __getstate__(self):
-        return self.size
-    def __setstate__(self, size):
-        self.__init__(size)
+        return self.size, self.maxbytes, self.sizeof
+    def __setstate__(self, state):
+        size, maxbytes, sizeof = state
+        self.__init__(size, maxbytes=maxbytes, sizeof=sizeof)
 
-    def __getitem__(self, key):
-        try:
-            link = self.cache[key]
-        except KeyError:
-            self.misses += 1
-            raise
-
-        # Disconnect the link from where it is
+    def _unlink(self, link):
+        del self.cache[link.key]
         link.left.right = link.right
         link.right.left = link.left
+        self.bytes -= link.nbytes
 
-        # Insert the link at the end of the list
-        tail = self.listtail
-        link.left = tail.left
-        link.right = tail
-        tail.left.right = link
-        tail.left = link
+        # Call the destructor
+        d = self.destructor
+        if d:
+            d(link.value)
 
-        self.hits += 1
-        return link.value
+    def _over_budget(self):
+        if self.size is not None and len(self.cache) > self.size:
+            return True
+        return self.maxbytes is not None and self.bytes > self.maxbytes
 
-    def __setitem__(self, key, value):
-        cache = self.cache
-        if key in cache:
-            # Shortcut this case
-            cache[key].value = value
-            return
-        if len(cache) >= self.size:
-            # Evict a node
-            link = self.listhead.right
-            del cache[link.key]
+    def __getitem__(self, key):
+        with self._lock:
+            try:
+                link = self.cache[key]
+            except KeyError:
+                self.misses += 1
+                raise
+
+            # Disconnect the link from where it is
             link.left.right = link.right
             link.right.left = link.left
-            d = self.destructor
-            if d:
-                d(link.value)
-            del link
 
-        # The node doesn't exist already, and we have room for it. Let's do this.
-        tail = self.listtail
-        link = LRUCache._LinkNode(tail.left, tail,key,value)
-        tail.left.right = link
-        tail.left = link
+            # Insert the link at the end of the list
+            tail = self.listtail
+            link.left = tail.left
+            link.right = tail
+            tail.left.right = link
+            tail.left = link
+
+            self.hits += 1
+            return link.value
+
+    def __setitem__(self, key, value):
+        nbytes = self.sizeof(value) if self.maxbytes is not None else 0
+        with self._lock:
+            cache = self.cache
+            if key in cache:
+                # Shortcut this case
+                link = cache[key]
+                link.value = value
+                self.bytes += nbytes - link.nbytes
+                link.nbytes = nbytes
+            else:
+                tail = self.listtail
+                link = LRUCache._LinkNode(tail.left, tail,key,value,nbytes)
+                tail.left.right = link
+                tail.left = link
 
-        cache[key] = link
+                cache[key] = link
+                self.bytes += nbytes
+
+            # Evict nodes until we're back within our limits, but never the
+            # one we just added
+            while self._over_budget() and self.listhead.right is not link:
+                self._unlink(self.listhead.right)
+                self.evictions += 1
 
     def __delitem__(self, key):
-        # Used to flush the cache of this key
-        cache = self.cache
-        link = cache[key]
-        del cache[key]
-        link.left.right = link.right
-        link.right.left = link.left
-        
-        # Call the destructor
-        d = self.destructor
-        if d:
-            d(link.value)
+        with self._lock:
+            # Used to flush the cache of this key
+            self._unlink(self.cache[key])
+
+class _SharedArray(object):
+    """Stands in for a numpy array in the pickled part of a value laid out by
+    _pack_value(). offset is relative to the start of the value."""
+    __slots__ = ['offset', 'dtype', 'shape']
+    def __init__(self, offset, dtype, shape):
+        self.offset = offset
+        self.dtype = dtype
+        self.shape = shape
+    def __getstate__(self):
+        return self.offset, self.dtype, self.shape
+    def __setstate__(self, state):
+        self.offset, self.dtype, self.shape = state
+
+def _pack_value(value, align=16):
+    """Lays value out as a pickled skeleton followed by the raw data of each
+    numpy array in it, each aligned to align bytes. Returns (header,
+    [(offset, array)], total length); header is the length of the pickle
+    followed by the pickle, and offsets are from the start of the header.
+
+    """
+    arrays = []
+    def strip(v):
+        if isinstance(v, numpy.ndarray):
+            shared = _SharedArray(0, v.dtype.str, v.shape)
+            arrays.append((shared, v))
+            return shared
+        elif isinstance(v, dict):
+            return dict((k, strip(i)) for k, i in v.iteritems())
+        elif isinstance(v, list):
+            return [strip(i) for i in v]
+        elif isinstance(v, tuple):
+            return tuple(strip(i) for i in v)
+        return v
+    skeleton = strip(value)
+
+    # the skeleton's length isn't known until the array offsets are in it, so
+    # leave it room to grow a little when they're filled in
+    placed = []
+    guess = len(cPickle.dumps(skeleton, -1)) + 4 + 8 * len(arrays)
+    while True:
+        pos = guess + (-guess % align)
+        del placed[:]
+        for shared, array in arrays:
+            shared.offset = pos
+            placed.append((pos, array))
+            pos += array.nbytes
+            pos += -pos % align
+        pickled = cPickle.dumps(skeleton, -1)
+        if len(pickled) + 4 <= guess:
+            break
+        guess = len(pickled) + 4 + 64
+    return struct.pack("<I", len(pickled)) + pickled, placed, pos
+
+def _unpack_value(buf, start):
+    """Reverses _pack_value() for data laid out in buf at start. The arrays
+    returned are read-only views on buf."""
+    picklelen, = struct.unpack_from("<I", buf, start)
+    skeleton = cPickle.loads(buf[start + 4:start + 4 + picklelen])
+    def attach(v):
+        if isinstance(v, _SharedArray):
+            count = 1
+            for dim in v.shape:
+                count *= dim
+            array = numpy.frombuffer(buf, dtype=numpy.dtype(v.dtype), count=count,
+                    offset=start + v.offset).reshape(v.shape)
+            array.flags.writeable = False
+            return array
+        elif isinstance(v, dict):
+            for k, i in v.iteritems():
+                v[k] = attach(i)
+            return v
+        elif isinstance(v, list):
+            return [attach(i) for i in v]
+        elif isinstance(v, tuple):
+            return tuple(attach(i) for i in v)
+        return v
+    return attach(skeleton)
+
+class SharedMemoryCache(object):
+    """A cache kept in a memory-mapped file that all worker processes map, so
+    a chunk parsed by one worker can be used by the others.
+
+    The file starts with an index of fixed-size entries, one per slot, each
+    holding the key digest and the length of the data in the slot. Slots are
+    found by open addressing from the digest. Numpy arrays are stored raw in
+    the slot and handed back as read-only views on the mapping, so a hit
+    costs no copying; everything else in the value is pickled.
+
+    Slots are written once and never reused. Other processes may hold views
+    on a slot, so nothing can safely be evicted; once the probed slots for a
+    key are taken, the value simply isn't stored.
+
+    Slots are claimed while holding a lock on the file, under a placeholder
+    that no lookup matches. The data is written without the lock, and only
+    then are the key and length put in the index, so lookups need no lock.
+    A process that dies while writing only wastes the slot.
+
+    The file is unlinked as soon as it's created, so it's never left behind,
+    even if the render is killed. Processes forked from the one that created
+    it share it through the open file they inherit; others can't use it.
+
+    """
+    digest_keys = True
+
+    # key digest, data length
+    _entry = struct.Struct("32sI")
+    _empty = "\x00" * 32
+    # how many slots to try for each key
+    probes = 8
+    # alignment of arrays within a slot
+    align = 16
+
+    def __init__(self, maxbytes, slotsize=384*1024, path=None, prepare=None):
+        """Creates a cache of about maxbytes, in slots of slotsize bytes. The
+        file is created in path, or in a temporary directory (/dev/shm if
+        there is one) by default. The file is sparse, so memory is only used
+        for the slots that have been filled in. It is freed once every
+        process using it has closed it or exited.
+
+        prepare, if given, is called with each value before it is stored,
+        and returns the value to store instead.
+
+        """
+        if fcntl is None:
+            raise RuntimeError("The shared memory cache needs file locking, which isn't available on this platform")
+        if path is None:
+            if os.path.isdir("/dev/shm"):
+                tmpdir = "/dev/shm"
+            else:
+                tmpdir = None
+            fd, path = tempfile.mkstemp(prefix="overviewer-chunks-", dir=tmpdir)
+            os.close(fd)
+        self.slots = max(1, maxbytes // slotsize)
+        self.slotsize = slotsize
+        self.path = path
+        self.prepare = prepare
+
+        indexsize = self.slots * self._entry.size
+        f = open(path, "r+b")
+        try:
+            f.truncate(indexsize + (-indexsize % mmap.PAGESIZE) + self.slots * slotsize)
+        finally:
+            os.remove(path)
+        _shared_files[path] = f
+        self._open()
+        # only the object that created the file lets go of it for good
+        self.owner = True
+        atexit.register(self.close)
+
+    def _open(self):
+        indexsize = self.slots * self._entry.size
+        self.database = indexsize + (-indexsize % mmap.PAGESIZE)
+        shared = _shared_files.get(self.path)
+        if shared is None or shared.closed:
+            raise RuntimeError("The shared memory cache can only be used by "
+                    "the process that created it and processes forked from it")
+        self._file = os.fdopen(os.dup(shared.fileno()), "r+b")
+        self.mmap = mmap.mmap(self._file.fileno(), 0)
+        self._lock = threading.Lock()
+        # claims of slots by this object, told apart from any other's
+        self._claims = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.full = 0
+        self.owner = False
+
+        _live_caches.add(self)
+
+    # Worker processes map the same file
+    def __getstate__(self):
+        return self.path, self.slots, self.slotsize, self.prepare
+    def __setstate__(self, state):
+        self.path, self.slots, self.slotsize, self.prepare = state
+        self._open()
+
+    def close(self):
+        """Stops using the file. Arrays handed out keep the mapping alive for
+        as long as they need it. Closing the object that created the file
+        stops any more processes from being able to use it."""
+        if not self._file.closed:
+            self._file.close()
+        if self.owner:
+            _shared_files.pop(self.path).close()
+            self.owner = False
+
+    def _probe(self, key):
+        """Yields the index offsets of the slots a key may be in"""
+        start = int(key[:8], 16)
+        for i in xrange(self.probes):
+            yield ((start + i) % self.slots) * self._entry.size
+
+    def _slot_offset(self, entry):
+        return self.database + (entry // self._entry.size) * self.slotsize
+
+    def __getitem__(self, key):
+        entry = self._entry
+        for offset in self._probe(key):
+            slotkey, length = entry.unpack_from(self.mmap, offset)
+            if slotkey == key:
+                self.hits += 1
+                return _unpack_value(self.mmap, self._slot_offset(offset))
+            elif slotkey == self._empty:
+                break
+        self.misses += 1
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if self.prepare:
+            value = self.prepare(value)
+        data = self._dump(value)
+        if data is None:
+            self.full += 1
+            return
+
+        # claim a slot under a placeholder. Keys are hex digests, so it can't
+        # match one, and it isn't empty, so lookups probe past it
+        entry = self._entry
+        with self._lock:
+            self._claims += 1
+            placeholder = struct.pack("<cIQ", "\x01", os.getpid(), self._claims).ljust(32, "\x01")
+            fcntl.lockf(self._file, fcntl.LOCK_EX)
+            try:
+                for offset in self._probe(key):
+                    slotkey, length = entry.unpack_from(self.mmap, offset)
+                    if slotkey == key:
+                        return
+                    elif slotkey == self._empty:
+                        entry.pack_into(self.mmap, offset, placeholder, 0)
+                        break
+                else:
+                    self.full += 1
+                    return
+            finally:
+                fcntl.lockf(self._file, fcntl.LOCK_UN)
+
+        skeleton, arrays, length = data
+        start = self._slot_offset(offset)
+        self.mmap[start:start + len(skeleton)] = skeleton
+        for pos, array in arrays:
+            dest = numpy.frombuffer(self.mmap, dtype=array.dtype,
+                    count=array.size, offset=start + pos)
+            dest[...] = array.reshape(-1)
+        # publish it: the length goes in first, so a lookup that finds the
+        # key always finds the length with it
+        struct.pack_into("I", self.mmap, offset + len(key), length)
+        self.mmap[offset:offset + len(key)] = key
+        self.stores += 1
+
+    def _dump(self, value):
+        """Lays value out for a slot. Returns what _pack_value() does, or None
+        if it doesn't fit in a slot"""
+        data = _pack_value(value, self.align)
+        if data[2] > self.slotsize:
+            return None
+        return data
+
+class DiskCache(object):
+    """A cache kept as one file per item in a directory, so it lasts from one
+    run to the next and needs no server.
+
+    Values are laid out with _pack_value(): numpy arrays are written raw and
+    read back as read-only arrays on the file's contents, everything else is
+    pickled. Files are written to a temporary name and renamed into place,
+    so worker processes can share the directory.
+
+    The directory is kept to about maxbytes by removing the least recently
+    used files. Hits touch their file to mark it used. Each process trims the
+    directory after it has written a sixteenth of the budget, so it can only
+    go over by about that much per process.
+
+    Items never go stale in this cache, so keys must change whenever values
+    do; it sets "persistent" so CachedRegionSet keys it by chunk mtime.
+
+    """
+    digest_keys = True
+    persistent = True
+
+    # written at the start of every file; bump when the layout changes
+    magic = "OVC1"
+
+    def __init__(self, directory, maxbytes, prepare=None):
+        """prepare, if given, is called with each value before it is stored,
+        and returns the value to store instead."""
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self.prepare = prepare
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._written = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        _live_caches.add(self)
+
+    def __getstate__(self):
+        return self.directory, self.maxbytes, self.prepare
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def __getitem__(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            if not data.startswith(self.magic):
+                raise ValueError("not a cache file")
+            value = _unpack_value(data, len(self.magic))
+        except IOError:
+            self.misses += 1
+            raise KeyError(key)
+        except Exception:
+            # left over from another version, or damaged somehow
+            logging.debug("Removing unreadable chunk cache file %s", path)
+            self._remove(path)
+            self.misses += 1
+            raise KeyError(key)
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        path = self._path(key)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.mkdir(dirname)
+            except OSError:
+                # made by another process in the meantime
+                pass
+
+        if self.prepare:
+            value = self.prepare(value)
+        header, arrays, length = _pack_value(value)
+        fd, tmpname = tempfile.mkstemp(suffix=".tmp", dir=dirname)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(self.magic)
+                f.write(header)
+                pos = len(header)
+                for offset, array in arrays:
+                    f.write("\x00" * (offset - pos))
+                    f.write(numpy.ascontiguousarray(array).data)
+                    pos = offset + array.nbytes
+            try:
+                os.rename(tmpname, path)
+            except OSError:
+                # there's no atomic replace on Windows; another process
+                # must have stored it already
+                os.remove(tmpname)
+        except:
+            self._remove(tmpname)
+            raise
+
+        self._written += length
+        if self._written > self.maxbytes // 16:
+            self.trim()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def trim(self):
+        """Removes the least recently used files until the cache fits in its
+        budget"""
+        self._written = 0
+        files = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        if total <= self.maxbytes:
+            return
+        files.sort()
+        for mtime, size, path in files:
+            self._remove(path)
+            self.evictions += 1
+            total -= size
+            if total <= self.maxbytes:
+                break
 
 # memcached is an option, but unless your IO costs are really high, it just
 # ends up adding overhead and isn't worth it.
@@ -148,9 +681,15 @@ except ImportError:
             raise ImportError("No module 'memcache' found. Please install python-memcached")
 else:
     class Memcached(object):
+        digest_keys = True
+        persistent = True
+
         def __init__(self, conn='127.0.0.1:11211'):
             self.conn = conn
             self.mc = memcache.Client([conn], debug=0, pickler=cPickle.Pickler, unpickler=cPickle.Unpickler)
+            self.hits = 0
+            self.misses = 0
+            _live_caches.add(self)
 
         def __getstate__(self):
             return self.conn
@@ -160,7 +699,9 @@ else:
         def __getitem__(self, key):
             v = self.mc.get(key)
             if not v:
+                self.misses += 1
                 raise KeyError()
+            self.hits += 1
             return v
 
         def __setitem__(self, key, value):
@@ -14,11 +14,14 @@
 #    with the Overviewer.  If not, see <http://www.gnu.org/licenses/>.
 
 import util
+import cache
+import logging
 import multiprocessing
 import multiprocessing.managers
 import cPickle as pickle
 import Queue
 import time
+from multiprocessing.pool import ThreadPool
 from signals import Signal
 
 class Dispatcher(object):
@@ -115,6 +118,8 @@ class Dispatcher(object):
         # clean out the appropriate lists
         for job in finished_jobs:
             self._running_jobs.remove(job)
+            tileset, workitem = job
+            tileset.work_done(workitem)
         for job in dispatched_jobs:
             self._pending_jobs.remove(job)
 
@@ -195,6 +200,16 @@ class MultiprocessingDispatcherManager(multiprocessing.managers.BaseManager):
         data[1] = self.tileset_version
 
 
+def _prefetch(tileset, workitem):
+    """Calls tileset.prefetch(workitem) on a worker's prefetch thread. The
+    traceback of an exception is lost on its way back out of the thread, so
+    it's logged here."""
+    try:
+        tileset.prefetch(workitem)
+    except Exception:
+        logging.debug("Prefetching chunks for %r failed", workitem, exc_info=True)
+        raise
+
 class MultiprocessingDispatcherProcess(multiprocessing.Process):
     """This class represents a single worker process. It is created
     automatically by MultiprocessingDispatcher, but it can even be
@@ -239,29 +254,79 @@ class MultiprocessingDispatcherProcess(multiprocessing.Process):
         for name, sig in Signal.signals.iteritems():
             register_signal(name, sig)
 
+        # Chunks for the next job are read and inflated on this thread while
+        # the current job renders. zlib and the file reads release the GIL,
+        # so this overlaps I/O with render_loop(). It only ever looks one job
+        # ahead, so work is still spread evenly over the workers
+        prefetcher = ThreadPool(1)
+        next_job = None
+        prefetching = None
+        prefetch_failed = False
+
+        # cache hits and misses are sent back with the results, as the
+        # change since the last result
+        counts = {}
+
         # notify that we're starting up
         self.result_queue.put(None, False)
-        while True:
-            try:
-                job = self.job_queue.get(True, timeout)
-                if job == None:
-                    # this is a end-of-jobs sentinel
-                    return
-
-                # unpack job
-                tv, ti, workitem = job
-
-                if tv != self.tileset_version:
-                    # our tilesets changed!
-                    self.update_tilesets()
-                    assert tv == self.tileset_version
-
-                # do job
-                ret = self.tilesets[ti].do_work(workitem)
-                result = (ti, workitem, ret,)
-                self.result_queue.put(result, False)
-            except Queue.Empty:
-                pass
+        try:
+            while True:
+                try:
+                    if next_job is not None:
+                        job, next_job = next_job, None
+                    else:
+                        job = self.job_queue.get(True, timeout)
+                    if job == None:
+                        # this is a end-of-jobs sentinel
+                        return
+
+                    # unpack job
+                    tv, ti, workitem = job
+
+                    if tv != self.tileset_version:
+                        # our tilesets changed!
+                        self.update_tilesets()
+                        assert tv == self.tileset_version
+
+                    # don't load the same chunks twice: let the prefetch for
+                    # this job finish first
+                    if prefetching is not None:
+                        try:
+                            prefetching.get()
+                        except Exception, e:
+                            # the job still loads whatever it needs itself,
+                            # so carry on, but don't let it go unnoticed
+                            if not prefetch_failed:
+                                logging.warning("Prefetching chunks failed, "
+                                        "carrying on without it: %s", e)
+                                prefetch_failed = True
+                        prefetching = None
+
+                    # look at the next job, and start on its chunks
+                    try:
+                        next_job = self.job_queue.get(False)
+                    except Queue.Empty:
+                        pass
+                    else:
+                        if next_job is not None and next_job[0] == self.tileset_version:
+                            prefetching = prefetcher.apply_async(
+                                    _prefetch, (self.tilesets[next_job[1]], next_job[2]))
+
+                    # do job
+                    ret = self.tilesets[ti].do_work(workitem)
+                    newcounts = cache.get_counts()
+                    countchange = dict((name, (hits - counts.get(name, (0, 0))[0],
+                            misses - counts.get(name, (0, 0))[1]))
+                            for name, (hits, misses) in newcounts.iteritems())
+                    counts = newcounts
+                    result = (ti, workitem, ret, countchange)
+                    self.result_queue.put(result, False)
+                except Queue.Empty:
+                    pass
+        finally:
+            prefetcher.terminate()
+            logging.debug("Final cache stats:")
+            cache.report_stats()
 
 class MultiprocessingDispatcher(Dispatcher):
     """A subclass of Dispatcher that spawns worker processes and
@@ -345,7 +410,8 @@ class MultiprocessingDispatcher(Dispatcher):
 
                     if result != None:
                         # completed job
-                        ti, workitem, ret = result
+                        ti, workitem, ret, counts = result
+                        cache.add_counts(counts)
                         finished_jobs.append((self.manager.tilesets[ti], workitem))
                         self.outstanding_jobs -= 1
                     else:
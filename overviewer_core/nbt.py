@@ -14,10 +14,31 @@
 #    with the Overviewer.  If not, see <http://www.gnu.org/licenses/>.
 
 import gzip, zlib
+import mmap
 import struct
 import StringIO
 import functools
 
+import numpy
+
+# The C extension has a much faster parser for chunk data. Fall back to the
+# pure-python NBTFileReader below if it's not available.
+try:
+    from c_overviewer import read_nbt as _c_read_nbt
+    from c_overviewer import decode_section as _c_decode_section
+except ImportError:
+    _c_read_nbt = None
+    _c_decode_section = None
+
+# values for the expand argument of the C extension's read_nbt()
+_EXPAND_NONE = 0
+_EXPAND_ALL = 1
+_EXPAND_LAZY = 2
+
+# maps a packed byte to its two 4-bit entries, low nibble first, so indexing
+# it with a packed array expands it in one go
+_NIBBLE_LUT = numpy.array([(b & 0x0F, b >> 4) for b in xrange(256)], dtype=numpy.uint8)
+
 # decorator that turns the first argument from a string into an open file
 # handle
 def _file_loader(func):
@@ -69,6 +90,9 @@ class NBTFileReader(object):
     _long   = struct.Struct(">q")
     _float  = struct.Struct(">f")
     _double = struct.Struct(">d") 
+
+    # payload sizes of the fixed-size tag types, by type id
+    _fixed_sizes = {1: 1, 2: 2, 3: 4, 4: 8, 5: 4, 6: 8}
  
     def __init__(self, fileobj, is_gzip=True):
         """Create a NBT parsing object with the given file-like
@@ -98,6 +122,19 @@ class NBTFileReader(object):
             11:self._read_tag_int_array,
         }
 
+        # mapping of NBT type ids to functions that skip over them, used
+        # for the tags not asked for by read_all(fields=...)
+        self._skip_tagmap = {
+            0: self._skip_tag_end,
+            7: self._skip_tag_byte_array,
+            8: self._skip_tag_string,
+            9: self._skip_tag_list,
+            10:self._skip_tag_compound,
+            11:self._skip_tag_int_array,
+        }
+        for tagid, size in self._fixed_sizes.iteritems():
+            self._skip_tagmap[tagid] = functools.partial(self._skip_bytes, size)
+
     # These private methods read the payload only of the following types
     def _read_tag_end(self):
         # Nothing to read
@@ -154,7 +191,7 @@ class NBTFileReader(object):
             l.append(read_method())
         return l
 
-    def _read_tag_compound(self):
+    def _read_tag_compound(self, fields=None):
         # Build a dictionary of all the tag names mapping to their payloads
         tags = {}
         while True:
@@ -165,16 +202,67 @@ class NBTFileReader(object):
                 break
 
             name = self._read_tag_string()
-            payload = self._read_tagmap[tagtype]()
+            if fields is None:
+                payload = self._read_tagmap[tagtype]()
+            elif name not in fields:
+                self._skip_tagmap[tagtype]()
+                continue
+            elif tagtype == 10:
+                payload = self._read_tag_compound(fields[name])
+            else:
+                payload = self._read_tagmap[tagtype]()
             tags[name] = payload
 
         return tags
-    
-    def read_all(self):
+
+    # These private methods skip over the payload of the following types
+    # without decoding it
+    def _skip_bytes(self, length):
+        if length < 0:
+            raise ValueError("negative length")
+        self._file.seek(length, 1)
+
+    def _skip_tag_end(self):
+        pass
+
+    def _skip_tag_byte_array(self):
+        self._skip_bytes(self._read_tag_int())
+
+    def _skip_tag_int_array(self):
+        self._skip_bytes(self._read_tag_int() * 4)
+
+    def _skip_tag_string(self):
+        self._skip_bytes(self._read_tag_short())
+
+    def _skip_tag_list(self):
+        tagid = self._read_tag_byte()
+        length = self._read_tag_int()
+        if tagid in self._fixed_sizes:
+            self._skip_bytes(length * self._fixed_sizes[tagid])
+        else:
+            skip_method = self._skip_tagmap[tagid]
+            for _ in xrange(length):
+                skip_method()
+
+    def _skip_tag_compound(self):
+        while True:
+            tagtype = ord(self._file.read(1))
+            if tagtype == 0:
+                break
+            self._skip_tag_string()
+            self._skip_tagmap[tagtype]()
+
+    def read_all(self, fields=None):
         """Reads the entire file and returns (name, payload)
         name is the name of the root tag, and payload is a dictionary mapping
         names to their payloads
 
+        If fields is given, only the named tags are read and the rest are
+        skipped over. It is a dict mapping tag names of the root compound
+        to either None, to read that whole tag, or another such dict to
+        pick tags out of a nested compound. For example,
+        {'Level': {'Sections': None}} reads only the sections of a chunk.
+
         """
         # Read tag type
         try:
@@ -184,7 +272,7 @@ class NBTFileReader(object):
             
             # Read the tag name
             name = self._read_tag_string()
-            payload = self._read_tag_compound()
+            payload = self._read_tag_compound(fields)
             
             return (name, payload)
         except (struct.error, ValueError), e:
@@ -197,6 +285,17 @@ class MCRFileReader(object):
     Beta 1.3 update. It provides functions for opening individual
     chunks (as (name, data) tuples), getting chunk timestamps, and for
     listing chunks contained in the file.
+
+    The region file is memory-mapped, and chunks are handed to zlib as
+    buffer slices of the mapping, so loading a chunk costs a single fstat()
+    and no copies of the compressed data.
+
+    Reading a page of the mapping that is past the end of the file kills
+    the process with SIGBUS, so each chunk is checked against the file's
+    current size before it's read. A chunk is reported as corrupt if the
+    file was truncated from under it, as Minecraft may do while saving.
+    This can't cover a truncation in the moment between that check and
+    zlib reading the chunk.
     """
     
     _location_table_format = struct.Struct(">1024I")
@@ -205,21 +304,31 @@ class MCRFileReader(object):
     
     def __init__(self, fileobj):
         """This creates a region object from the given file-like
-        object. Chances are you want to use load_region instead."""
-        self._file = fileobj
+        object. Chances are you want to use load_region instead.
+
+        Real files are memory-mapped and the file object is closed right
+        away, since the mapping doesn't need it. Other file-like objects
+        (without a fileno()) are read into memory in their entirety."""
+        try:
+            fileno = fileobj.fileno()
+        except (AttributeError, IOError):
+            self._data = fileobj.read()
+        else:
+            try:
+                self._data = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError), e:
+                # empty files can't be mapped
+                raise CorruptRegionError("could not map region file: %s" % (e,))
+            finally:
+                fileobj.close()
         
-        # read in the location table
-        location_data = self._file.read(4096)
-        if not len(location_data) == 4096:
-            raise CorruptRegionError("invalid location table")
-        # read in the timestamp table
-        timestamp_data = self._file.read(4096)
-        if not len(timestamp_data) == 4096:
-            raise CorruptRegionError("invalid timestamp table")
+        # read in the location and timestamp tables
+        if len(self._data) < 8192:
+            raise CorruptRegionError("invalid location or timestamp table")
 
         # turn this data into a useful list
-        self._locations = self._location_table_format.unpack(location_data)
-        self._timestamps = self._timestamp_table_format.unpack(timestamp_data)
+        self._locations = self._location_table_format.unpack_from(self._data, 0)
+        self._timestamps = self._timestamp_table_format.unpack_from(self._data, 4096)
 
     def close(self):
         """Close the region file and free any resources associated
@@ -227,18 +336,26 @@ class MCRFileReader(object):
         results in undefined behaviour.
         """
         
-        self._file.close()
-        self._file = None
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._data = None
 
     def get_chunks(self):    
         """Return an iterator of all chunks contained in this region
         file, as (x, z) coordinate tuples. To load these chunks,
         provide these coordinates to load_chunk()."""
         
-        for x in xrange(32): 
-            for z in xrange(32): 
-                if self._locations[x + z * 32] >> 8 != 0:
-                    yield (x,z)
+        present = self.get_chunk_table()[0]
+        for i in numpy.flatnonzero(present):
+            yield (int(i) % 32, int(i) // 32)
+
+    def get_chunk_table(self):
+        """Returns the region's header as two numpy arrays of 1024 entries,
+        indexed by x + z * 32: a boolean array of which chunks exist, and
+        an int32 array of the chunk timestamps."""
+        locations = numpy.frombuffer(self._data, dtype=">u4", count=1024, offset=0)
+        timestamps = numpy.frombuffer(self._data, dtype=">i4", count=1024, offset=4096)
+        return (locations >> 8) != 0, timestamps.astype(numpy.int32)
         
     def get_chunk_timestamp(self, x, z):
         """Return the given chunk's modification time. If the given
@@ -249,19 +366,49 @@ class MCRFileReader(object):
         z = z % 32        
         return self._timestamps[x + z * 32]   
     
+    def get_chunk_offset(self, x, z):
+        """Return the sector offset of the given chunk within the region
+        file, or 0 if the chunk doesn't exist. Loading chunks in order of
+        their offset reads the file front to back. Like load_chunk(), this
+        will wrap x and z into the range [0, 31].
+        """
+        x = x % 32
+        z = z % 32
+        return self._locations[x + z * 32] >> 8
+
     def chunk_exists(self, x, z):
         """Determines if a chunk exists."""
         x = x % 32
         z = z % 32
         return self._locations[x + z * 32] >> 8 != 0
 
-    def load_chunk(self, x, z):
+    def load_chunk(self, x, z, decode_sections=False, fields=None, lazy_sections=False):
         """Return a (name, data) tuple for the given chunk, or
         None if the given chunk doesn't exist in this region file. If
         you provide an x or z not between 0 and 31, it will be
         modulo'd into this range (x % 32, etc.) This is so you can
         provide chunk coordinates in global coordinates, and still
-        have the chunks load out of regions properly."""
+        have the chunks load out of regions properly.
+
+        If decode_sections is True, the packed arrays in the Level
+        compound are expanded into numpy arrays:
+
+        * Biomes becomes a 16x16 uint8 array (all zeros if missing)
+        * Blocks becomes a 16x16x16 uint16 array, with the Add array (if
+          any) merged into it and removed
+        * SkyLight, BlockLight and Data become 16x16x16 uint8 arrays
+
+        If lazy_sections is also True, only Biomes is expanded. The sections
+        are left packed, to be expanded by decode_section() when they're
+        actually needed.
+
+        fields restricts which tags are parsed, as for
+        NBTFileReader.read_all(). Skipped tags are never decoded, which
+        saves a lot of work on chunks with many entities. Only the arrays
+        that were read are expanded.
+
+        The C extension is used for parsing if it is available, which is
+        considerably faster than the pure-python NBTFileReader."""
         x = x % 32
         z = z % 32
         location = self._locations[x + z * 32]
@@ -271,14 +418,16 @@ class MCRFileReader(object):
         if offset == 0:
             return None
         
-        # seek to the data
-        self._file.seek(offset)
-        
+        # the file may have been truncated since it was mapped, and only
+        # what's still in the file can be read safely
+        size = len(self._data)
+        if isinstance(self._data, mmap.mmap):
+            size = min(size, self._data.size())
+
         # read in the chunk data header
-        header = self._file.read(5)
-        if len(header) != 5:
+        if offset + 5 > size:
             raise CorruptChunkError("chunk header is invalid")
-        data_length, compression =  self._chunk_header_format.unpack(header)
+        data_length, compression = self._chunk_header_format.unpack_from(self._data, offset)
         
         # figure out the compression
         is_gzip = True
@@ -292,16 +441,103 @@ class MCRFileReader(object):
             # unsupported!
             raise CorruptRegionError("unsupported chunk compression type: %i (should be 1 or 2)" % (compression,))
         
-        # turn the rest of the data into a StringIO object
+        # slice out the rest of the data without copying it
         # (using data_length - 1, as we already read 1 byte for compression)
-        data = self._file.read(data_length - 1)
-        if len(data) != data_length - 1:
+        if data_length < 1 or offset + 4 + data_length > size:
             raise CorruptRegionError("chunk length is invalid")
-        data = StringIO.StringIO(data)
+        data = buffer(self._data, offset + 5, data_length - 1)
         
         try:
-            return NBTFileReader(data, is_gzip=is_gzip).read_all()
+            if _c_read_nbt is not None:
+                if is_gzip:
+                    # zlib handles gzip headers with this wbits value
+                    data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+                else:
+                    data = zlib.decompress(data)
+                if not decode_sections:
+                    expand = _EXPAND_NONE
+                elif lazy_sections:
+                    expand = _EXPAND_LAZY
+                else:
+                    expand = _EXPAND_ALL
+                return _c_read_nbt(data, expand, fields)
+
+            chunk = NBTFileReader(StringIO.StringIO(data[:]), is_gzip=is_gzip).read_all(fields)
+            if decode_sections:
+                _expand_chunk_arrays(chunk[1], fields, lazy_sections)
+            return chunk
         except CorruptionError:
             raise
         except Exception, e:
             raise CorruptChunkError("Misc error parsing chunk: " + str(e))
+
+def decode_section(section):
+    """Expands the packed arrays of a chunk section, as left by
+    MCRFileReader.load_chunk() with lazy_sections, into numpy arrays
+    in-place. Sections that are already expanded are left alone, so this is
+    cheap to call on every access. Returns the section.
+
+    Raises CorruptChunkError if the arrays are missing or the wrong size.
+
+    """
+    blocks = section.get('Blocks')
+    if blocks is not None and not isinstance(blocks, str):
+        return section
+    try:
+        if _c_decode_section is not None:
+            return _c_decode_section(section)
+
+        # Turn the Blocks array into a 16x16x16 numpy matrix of shorts,
+        # adding in the additional block array if included. Blocks can have
+        # up to 12 bits of data
+        blocks = numpy.frombuffer(section['Blocks'], dtype=numpy.uint8)
+        blocks = blocks.astype(numpy.uint16).reshape((16,16,16))
+        if "Add" in section:
+            # Add is a packed array with 4 bits per slot
+            additional = _NIBBLE_LUT[numpy.frombuffer(section['Add'], dtype=numpy.uint8)]
+            blocks |= additional.astype(numpy.uint16).reshape((16,16,16)) << 8
+
+        # The SkyLight, BlockLight and Data arrays come packed 2 elements
+        # per byte
+        expanded = {'Blocks': blocks}
+        for arrayname in ('SkyLight', 'BlockLight', 'Data'):
+            packed = numpy.frombuffer(section[arrayname], dtype=numpy.uint8)
+            expanded[arrayname] = _NIBBLE_LUT[packed].reshape((16,16,16))
+    except (KeyError, ValueError), e:
+        raise CorruptChunkError("could not decode chunk section: %s" % (e,))
+
+    # Swap everything in at once
+    section.update(expanded)
+    section.pop('Add', None) # Save some memory
+    return section
+
+def _expand_chunk_arrays(chunk, fields=None, lazy_sections=False):
+    """Expands the packed arrays in the Level compound of the given chunk
+    payload into numpy arrays, in-place. This is the pure-python counterpart
+    of the expansion done by the C extension's read_nbt(); see
+    MCRFileReader.load_chunk() for the resulting layout. Arrays left out by
+    the fields spec are not touched.
+
+    """
+    level_fields = None
+    if fields is not None:
+        if 'Level' not in fields:
+            return
+        level_fields = fields['Level']
+    level = chunk['Level']
+
+    # Turn the Biomes array into a 16x16 numpy array
+    if level_fields is None or 'Biomes' in level_fields or 'Biomes' in level:
+        try:
+            biomes = numpy.frombuffer(level['Biomes'], dtype=numpy.uint8)
+            biomes = biomes.reshape((16,16))
+        except KeyError:
+            # worlds converted by Jeb's program may be missing the Biomes key
+            biomes = numpy.zeros((16, 16), dtype=numpy.uint8)
+        level['Biomes'] = biomes
+
+    if lazy_sections or (level_fields is not None and 'Sections' not in level_fields):
+        return
+
+    for section in level['Sections']:
+        decode_section(section)
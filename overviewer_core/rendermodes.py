@@ -26,6 +26,15 @@ must be changed simultaneously if you want to make any changes.
 class RenderPrimitive(object):
     options = {}
     name = None
+    # True if this primitive leaves blocks behind a chunk section made entirely
+    # of opaque blocks out of sight: it hides no blocks, and only draws inside
+    # the outline of the block being drawn. Chunk sections that are covered
+    # like this are then skipped without being drawn at all.
+    section_culling = False
+    # True if this primitive draws a chunk section of opaque blocks just the
+    # same into a sprite of its own, to be pasted onto tiles, as straight onto
+    # a tile: it only changes the pixels of the opaque blocks it draws
+    sprite_safe = False
     def __init__(self, **kwargs):
         if self.name is None:
             raise RuntimeError("RenderPrimitive cannot be used directly")
@@ -43,18 +52,24 @@ class RenderPrimitive(object):
 
 class Base(RenderPrimitive):
     name = "base"
+    section_culling = True
+    sprite_safe = True
     options = {
         "biomes": ("whether or not to use biomes", True),
     }
 
 class NetherOld(RenderPrimitive):
     name = "netherold"
+    sprite_safe = True
 
 class Nether(RenderPrimitive):
     name = "nether"
+    sprite_safe = True
 
 class HeightFading(RenderPrimitive):
     name = "height-fading"
+    section_culling = True
+    sprite_safe = True
     options = {
         # 128 is *WRONG*, it should be 64. but we're grandfathered in for now
         "sealevel": ("target sea level", 128),
@@ -65,6 +80,7 @@ class HeightFading(RenderPrimitive):
 
 class Depth(RenderPrimitive):
     name = "depth"
+    sprite_safe = True
     options = {
         "min": ("lowest level of blocks to render", 0),
         "max": ("highest level of blocks to render", 255),
@@ -72,27 +88,33 @@ class Depth(RenderPrimitive):
     
 class Exposed(RenderPrimitive):
     name = "exposed"
+    sprite_safe = True
     options = {
         "mode": ("0 = exposed blocks only, 1 = unexposed blocks only", 0),
     }
     
 class NoFluids(RenderPrimitive):
     name = "no-fluids"
+    sprite_safe = True
 
 class EdgeLines(RenderPrimitive):
     name = "edge-lines"
+    section_culling = True
     options = {
         "opacity": ("darkness of the edge lines, from 0.0 to 1.0", 0.15),
     }
 
 class Cave(RenderPrimitive):
     name = "cave"
+    sprite_safe = True
     options = {
         "only_lit": ("only render lit caves", False),
     }
 
 class DepthTinting(RenderPrimitive):
     name = "depth-tinting"
+    section_culling = True
+    sprite_safe = True
     
     @property
     def depth_colors(self):
@@ -121,6 +143,8 @@ class DepthTinting(RenderPrimitive):
 
 class Lighting(RenderPrimitive):
     name = "lighting"
+    section_culling = True
+    sprite_safe = True
     options = {
         "strength": ("how dark to make the shadows, from 0.0 to 1.0", 1.0),
         "night": ("whether to use nighttime skylight settings", False),
@@ -220,6 +244,7 @@ class BiomeOverlay(Overlay):
 
 class Hide(RenderPrimitive):
     name = "hide"
+    sprite_safe = True
     options = {
         'blocks' : ('a list of blockids or (blockid, data) tuples of blocks to hide', []),
     }
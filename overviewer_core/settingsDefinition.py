@@ -77,6 +77,8 @@ renders = Setting(required=True, default=util.OrderedDict(),
             "texturepath": Setting(required=False, validator=validateTexturePath, default=None),
             "renderchecks": Setting(required=False, validator=validateInt, default=None),
             "rerenderprob": Setting(required=True, validator=validateRerenderprob, default=0),
+            "subtreelevels": Setting(required=True, validator=validateSubtreeLevels, default=0),
+            "renderorder": Setting(required=True, validator=validateRenderOrder, default="spread"),
             "crop": Setting(required=False, validator=validateCrop, default=None),
             "changelist": Setting(required=False, validator=validateStr, default=None),
             "markers": Setting(required=False, validator=validateMarkers, default=[]),
@@ -106,6 +108,21 @@ processes = Setting(required=True, validator=int, default=-1)
 # ends up adding overhead and isn't worth it.
 memcached_host = Setting(required=False, validator=str, default=None)
 
+# how many megabytes of parsed chunks each worker process keeps in memory. If
+# not given, each worker keeps the last 100 chunks
+chunkcache_mb = Setting(required=False, validator=int, default=None)
+
+# megabytes of parsed chunks to share among all the worker processes
+sharedchunkcache_mb = Setting(required=False, validator=int, default=None)
+
+# megabytes of drawn chunk sections each worker process keeps for each render
+spritecache_mb = Setting(required=False, validator=int, default=None)
+
+# a directory to keep parsed chunks in from one run to the next, and how many
+# megabytes it may hold
+diskchunkcache = Setting(required=False, validator=validateCacheDir, default=None)
+diskchunkcache_mb = Setting(required=True, validator=int, default=4096)
+
 # TODO clean up this ugly in sys.argv hack
 if platform.system() == 'Windows' or not sys.stdout.isatty() or "--simple" in sys.argv:
     obs = LoggingObserver()
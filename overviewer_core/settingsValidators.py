@@ -200,6 +200,12 @@ def validateOutputDir(d):
         raise ValidationException("You must specify a valid output directory")
     return expand_path(d)
 
+def validateCacheDir(d):
+    checkBadEscape(d)
+    if not d.strip():
+        raise ValidationException("You must specify a valid chunk cache directory")
+    return expand_path(d)
+
 def validateCrop(value):
     if len(value) != 4:
         raise ValidationException("The value for the 'crop' setting must be a tuple of length 4")
@@ -223,6 +229,17 @@ def validateDefaultZoom(z):
     else:
         raise ValidationException("The default zoom is set below 1")
 
+def validateSubtreeLevels(levels):
+    levels = int(levels)
+    if levels < 0:
+        raise ValidationException("%r is not a valid number of subtree levels. Should be 0 or more." % levels)
+    return levels
+
+def validateRenderOrder(order):
+    if order not in ("spread", "local"):
+        raise ValidationException("%r is not a valid render order. Should be 'spread' or 'local'." % order)
+    return order
+
 def validateWebAssetsPath(p):
     try:
         validatePath(p)
@@ -30,6 +30,10 @@ static PyObject *fluid_blocks = NULL;
 static PyObject *nospawn_blocks = NULL;
 static PyObject *nodata_blocks = NULL;
 
+/* the chunk tags the renderer needs, passed to get_chunk so the rest of the
+ * chunk (entities and so on) is never parsed */
+static PyObject *chunk_render_fields = NULL;
+
 PyObject *init_chunk_render(void) {
    
     PyObject *tmp = NULL;
@@ -46,6 +50,10 @@ PyObject *init_chunk_render(void) {
     if ((!textures)) {
         return NULL;
     }
+
+    chunk_render_fields = Py_BuildValue("(ss)", "Sections", "Biomes");
+    if (!chunk_render_fields)
+        return NULL;
     
     tmp = PyObject_GetAttrString(textures, "max_blockid");
     if (!tmp)
@@ -102,16 +110,37 @@ PyObject *init_chunk_render(void) {
     Py_RETURN_NONE;
 }
 
-/* helper for load_chunk, loads a section into a chunk */
-static inline void load_chunk_section(ChunkData *dest, int i, PyObject *section) {
-    dest->sections[i].blocks = PyDict_GetItemString(section, "Blocks");
-    dest->sections[i].data = PyDict_GetItemString(section, "Data");
-    dest->sections[i].skylight = PyDict_GetItemString(section, "SkyLight");
-    dest->sections[i].blocklight = PyDict_GetItemString(section, "BlockLight");
-    Py_INCREF(dest->sections[i].blocks);
-    Py_INCREF(dest->sections[i].data);
-    Py_INCREF(dest->sections[i].skylight);
-    Py_INCREF(dest->sections[i].blocklight);
+/* decodes section i of a loaded chunk the first time it's needed, and sets
+ * up its arrays. sections of chunks that are only loaded as neighbours are
+ * mostly never looked at, so they stay packed.
+ *
+ * returns true if the section doesn't exist (or is corrupt)
+ */
+int load_chunk_section(ChunkData *chunk, int i) {
+    PyObject *section = chunk->sections[i].section;
+    
+    if (chunk->sections[i].blocks != NULL)
+        return 0;
+    if (section == NULL)
+        return 1;
+    
+    if (!nbt_decode_section(section)) {
+        /* treat a corrupt section as missing */
+        PyErr_Clear();
+        Py_DECREF(section);
+        chunk->sections[i].section = NULL;
+        return 1;
+    }
+    
+    chunk->sections[i].blocks = PyDict_GetItemString(section, "Blocks");
+    chunk->sections[i].data = PyDict_GetItemString(section, "Data");
+    chunk->sections[i].skylight = PyDict_GetItemString(section, "SkyLight");
+    chunk->sections[i].blocklight = PyDict_GetItemString(section, "BlockLight");
+    Py_INCREF(chunk->sections[i].blocks);
+    Py_INCREF(chunk->sections[i].data);
+    Py_INCREF(chunk->sections[i].skylight);
+    Py_INCREF(chunk->sections[i].blocklight);
+    return 0;
 }
 
 /* loads the given chunk into the chunks[] array in the state
@@ -133,6 +162,7 @@ int load_chunk(RenderState* state, int x, int z, unsigned char required) {
     dest->biomes = NULL;
     for (i = 0; i < SECTIONS_PER_CHUNK; i++)
     {
+        dest->sections[i].section = NULL;
         dest->sections[i].blocks = NULL;
         dest->sections[i].data = NULL;
         dest->sections[i].skylight = NULL;
@@ -143,7 +173,7 @@ int load_chunk(RenderState* state, int x, int z, unsigned char required) {
     x += state->chunkx;
     z += state->chunkz;
 
-    chunk = PyObject_CallMethod(state->regionset, "get_chunk", "ii", x, z);
+    chunk = PyObject_CallMethod(state->regionset, "get_chunk", "iiO", x, z, chunk_render_fields);
     if (chunk == NULL) {
         // An exception is already set. RegionSet.get_chunk sets
         // ChunkDoesntExist
@@ -178,8 +208,11 @@ int load_chunk(RenderState* state, int x, int z, unsigned char required) {
             continue;
         
         sectiony = PyInt_AsLong(ycoord);
-        if (sectiony >= 0 && sectiony < SECTIONS_PER_CHUNK)
-            load_chunk_section(dest, sectiony, section);
+        if (sectiony >= 0 && sectiony < SECTIONS_PER_CHUNK && !dest->sections[sectiony].section) {
+            /* decoded later, by load_chunk_section */
+            dest->sections[sectiony].section = section;
+            Py_INCREF(section);
+        }
     }
     Py_DECREF(sections);
     Py_DECREF(chunk);
@@ -196,6 +229,7 @@ unload_all_chunks(RenderState *state) {
             if (state->chunks[i][j].loaded) {
                 Py_XDECREF(state->chunks[i][j].biomes);
                 for (k = 0; k < SECTIONS_PER_CHUNK; k++) {
+                    Py_XDECREF(state->chunks[i][j].sections[k].section);
                     Py_XDECREF(state->chunks[i][j].sections[k].blocks);
                     Py_XDECREF(state->chunks[i][j].sections[k].data);
                     Py_XDECREF(state->chunks[i][j].sections[k].skylight);
@@ -576,7 +610,6 @@ chunk_render(PyObject *self, PyObject *args) {
 
     int xoff, yoff;
     
-    PyObject *imgsize, *imgsize0_py, *imgsize1_py;
     int imgsize0, imgsize1;
     
     PyObject *blocks_py;
@@ -586,6 +619,10 @@ chunk_render(PyObject *self, PyObject *args) {
     PyObject *up_right_blocks_py;
 
     RenderMode *rendermode;
+    /* whether the rendermode was created for this call, rather than taken
+       from a RenderContext */
+    int own_rendermode;
+    Imaging img_i;
     
     int i, j;
 
@@ -594,36 +631,43 @@ chunk_render(PyObject *self, PyObject *args) {
     if (!PyArg_ParseTuple(args, "OOiiiOiiOO",  &state.world, &state.regionset, &state.chunkx, &state.chunky, &state.chunkz, &state.img, &xoff, &yoff, &modeobj, &state.textures))
         return NULL;
     
-    /* set up the render mode */
-    state.rendermode = rendermode = render_mode_create(modeobj, &state);
-    if (rendermode == NULL) {
-        return NULL; // note that render_mode_create will
-                     // set PyErr.  No need to set it here
-    }
-
-    /* get the blockmap from the textures object */
-    blockmap = PyObject_GetAttrString(state.textures, "blockmap");
-    if (blockmap == NULL) {
-        render_mode_destroy(rendermode);
-        return NULL;
-    }
-    if (blockmap == Py_None) {
-        render_mode_destroy(rendermode);
-        PyErr_SetString(PyExc_RuntimeError, "you must call Textures.generate()");
+    /* get the image size */
+    img_i = imaging_python_to_c(state.img);
+    if (img_i == NULL)
         return NULL;
-    }
+    imgsize0 = img_i->xsize;
+    imgsize1 = img_i->ysize;
     
-    /* get the image size */
-    imgsize = PyObject_GetAttrString(state.img, "size");
-
-    imgsize0_py = PySequence_GetItem(imgsize, 0);
-    imgsize1_py = PySequence_GetItem(imgsize, 1);
-    Py_DECREF(imgsize);
+    if (RenderContext_Check(modeobj)) {
+        /* the render mode and blockmap were set up already, the rendermode
+           just needs to know about this call's state */
+        RenderContext *context = (RenderContext *)modeobj;
+        own_rendermode = 0;
+        state.rendermode = rendermode = context->rendermode;
+        rendermode->state = &state;
+        blockmap = context->blockmap;
+        Py_INCREF(blockmap);
+    } else {
+        /* set up the render mode */
+        own_rendermode = 1;
+        state.rendermode = rendermode = render_mode_create(modeobj, &state);
+        if (rendermode == NULL) {
+            return NULL; // note that render_mode_create will
+                         // set PyErr.  No need to set it here
+        }
 
-    imgsize0 = PyInt_AsLong(imgsize0_py);
-    imgsize1 = PyInt_AsLong(imgsize1_py);
-    Py_DECREF(imgsize0_py);
-    Py_DECREF(imgsize1_py);
+        /* get the blockmap from the textures object */
+        blockmap = PyObject_GetAttrString(state.textures, "blockmap");
+        if (blockmap == NULL) {
+            render_mode_destroy(rendermode);
+            return NULL;
+        }
+        if (blockmap == Py_None) {
+            render_mode_destroy(rendermode);
+            PyErr_SetString(PyExc_RuntimeError, "you must call Textures.generate()");
+            return NULL;
+        }
+    }
     
     /* set all block data to unloaded */
     for (i = 0; i < 3; i++) {
@@ -634,13 +678,15 @@ chunk_render(PyObject *self, PyObject *args) {
     
     /* get the block data for the center column, erroring out if needed */
     if (load_chunk(&state, 0, 0, 1)) {
-        render_mode_destroy(rendermode);
+        if (own_rendermode)
+            render_mode_destroy(rendermode);
         Py_DECREF(blockmap);
         return NULL;
     }
-    if (state.chunks[1][1].sections[state.chunky].blocks == NULL) {
+    if (load_chunk_section(&state.chunks[1][1], state.chunky)) {
         /* this section doesn't exist, let's skeddadle */
-        render_mode_destroy(rendermode);
+        if (own_rendermode)
+            render_mode_destroy(rendermode);
         Py_DECREF(blockmap);
         unload_all_chunks(&state);
         Py_RETURN_NONE;
@@ -763,7 +809,8 @@ chunk_render(PyObject *self, PyObject *args) {
     }
 
     /* free up the rendermode info */
-    render_mode_destroy(rendermode);
+    if (own_rendermode)
+        render_mode_destroy(rendermode);
     
     Py_DECREF(blockmap);
     unload_all_chunks(&state);
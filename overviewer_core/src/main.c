@@ -32,6 +32,11 @@ static PyMethodDef COverviewerMethods[] = {
     {"render_loop", chunk_render, METH_VARARGS,
      "Renders stuffs"},
     
+    {"read_nbt", read_nbt, METH_VARARGS,
+     "Parses uncompressed NBT data, optionally filtered and expanding chunk arrays"},
+    {"decode_section", decode_section, METH_VARARGS,
+     "Expands the packed arrays of a chunk section in-place"},
+    
     {"extension_version", get_extension_version, METH_VARARGS, 
         "Returns the extension version"},
     
@@ -45,6 +50,11 @@ initc_overviewer(void)
     PyObject *mod, *numpy;
     mod = Py_InitModule("c_overviewer", COverviewerMethods);
 
+    if (PyType_Ready(&RenderContextType) < 0)
+        return;
+    Py_INCREF(&RenderContextType);
+    PyModule_AddObject(mod, "RenderContext", (PyObject *)&RenderContextType);
+
     /* for numpy
        normally you should use import_array(), but that will break across
        numpy versions. This doesn't, and we don't use enough of numpy to worry
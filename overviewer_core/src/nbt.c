@@ -0,0 +1,707 @@
+/*
+ * This file is part of the Minecraft Overviewer.
+ *
+ * Minecraft Overviewer is free software: you can redistribute it and/or
+ * modify it under the terms of the GNU General Public License as published
+ * by the Free Software Foundation, either version 3 of the License, or (at
+ * your option) any later version.
+ *
+ * Minecraft Overviewer is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License along
+ * with the Overviewer.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+/*
+ * A fast NBT parser for chunk data. This builds exactly the same structure
+ * as nbt.NBTFileReader.read_all(), a (name, payload) tuple, but without
+ * going through python for every tag. Optionally, the packed arrays of an
+ * anvil chunk are expanded into the numpy arrays that world.py and the
+ * renderer expect, either all at once or one section at a time, when the
+ * renderer first looks at it (see nbt_decode_section).
+ *
+ * The pure-python code in nbt.py is the reference implementation; keep the
+ * two in sync!
+ */
+
+#include "overviewer.h"
+#include <string.h>
+
+/* nesting deeper than this is treated as corruption */
+#define NBT_MAX_DEPTH 512
+
+enum {
+    TAG_END = 0,
+    TAG_BYTE,
+    TAG_SHORT,
+    TAG_INT,
+    TAG_LONG,
+    TAG_FLOAT,
+    TAG_DOUBLE,
+    TAG_BYTE_ARRAY,
+    TAG_STRING,
+    TAG_LIST,
+    TAG_COMPOUND,
+    TAG_INT_ARRAY,
+};
+
+typedef struct {
+    const unsigned char *data;
+    Py_ssize_t length;
+    Py_ssize_t pos;
+} NBTReader;
+
+/* numpy.empty, used to create the expanded arrays */
+static PyObject *numpy_empty = NULL;
+
+static PyObject *nbt_read_payload(NBTReader *r, int tagtype, int depth);
+static int nbt_skip_payload(NBTReader *r, int tagtype, int depth);
+
+/* makes sure n more bytes can be read, sets an exception and returns 0 if
+   they can't */
+static inline int nbt_need(NBTReader *r, Py_ssize_t n) {
+    if (n < 0 || r->length - r->pos < n) {
+        PyErr_SetString(PyExc_ValueError, "unexpected end of NBT data");
+        return 0;
+    }
+    return 1;
+}
+
+/* NBT is big-endian. these are built up byte by byte so they work on any
+   host */
+static inline unsigned int nbt_get_u16(const unsigned char *p) {
+    return ((unsigned int)p[0] << 8) | p[1];
+}
+
+static inline unsigned int nbt_get_u32(const unsigned char *p) {
+    return ((unsigned int)p[0] << 24) | ((unsigned int)p[1] << 16) |
+           ((unsigned int)p[2] << 8) | p[3];
+}
+
+static inline unsigned PY_LONG_LONG nbt_get_u64(const unsigned char *p) {
+    return ((unsigned PY_LONG_LONG)nbt_get_u32(p) << 32) | nbt_get_u32(p + 4);
+}
+
+static PyObject *nbt_read_string(NBTReader *r) {
+    unsigned int length;
+    PyObject *ret;
+
+    if (!nbt_need(r, 2))
+        return NULL;
+    length = nbt_get_u16(r->data + r->pos);
+    r->pos += 2;
+
+    if (!nbt_need(r, length))
+        return NULL;
+    ret = PyUnicode_DecodeUTF8((const char *)(r->data + r->pos), length, "strict");
+    r->pos += length;
+    return ret;
+}
+
+static PyObject *nbt_read_list(NBTReader *r, int depth) {
+    int tagid;
+    int length, i;
+    PyObject *ret;
+
+    if (!nbt_need(r, 5))
+        return NULL;
+    tagid = (signed char)r->data[r->pos];
+    length = (int)nbt_get_u32(r->data + r->pos + 1);
+    r->pos += 5;
+
+    if (tagid < TAG_END || tagid > TAG_INT_ARRAY) {
+        PyErr_Format(PyExc_ValueError, "invalid NBT list tag type: %i", tagid);
+        return NULL;
+    }
+
+    /* a negative length reads as an empty list, like xrange() would */
+    if (length < 0)
+        length = 0;
+    /* every item is at least one byte long (except TAG_END, which is
+       zero), so this catches absurd lengths before allocating */
+    if (tagid != TAG_END && !nbt_need(r, length))
+        return NULL;
+
+    ret = PyList_New(length);
+    if (ret == NULL)
+        return NULL;
+
+    for (i = 0; i < length; i++) {
+        PyObject *item = nbt_read_payload(r, tagid, depth + 1);
+        if (item == NULL) {
+            Py_DECREF(ret);
+            return NULL;
+        }
+        PyList_SET_ITEM(ret, i, item);
+    }
+
+    return ret;
+}
+
+/* reads a compound. if fields is not NULL, it is a dict of the tag names to
+   keep (see NBTFileReader.read_all), every other tag is skipped over without
+   creating any python objects */
+static PyObject *nbt_read_compound(NBTReader *r, int depth, PyObject *fields) {
+    PyObject *ret = PyDict_New();
+    if (ret == NULL)
+        return NULL;
+
+    while (1) {
+        int tagtype;
+        PyObject *name, *payload;
+
+        if (!nbt_need(r, 1)) {
+            Py_DECREF(ret);
+            return NULL;
+        }
+        tagtype = r->data[r->pos];
+        r->pos += 1;
+
+        if (tagtype == TAG_END)
+            break;
+
+        name = nbt_read_string(r);
+        if (name == NULL) {
+            Py_DECREF(ret);
+            return NULL;
+        }
+
+        if (fields != NULL) {
+            PyObject *subfields = PyDict_GetItem(fields, name);
+            if (subfields == NULL) {
+                /* not wanted */
+                Py_DECREF(name);
+                if (!nbt_skip_payload(r, tagtype, depth + 1)) {
+                    Py_DECREF(ret);
+                    return NULL;
+                }
+                continue;
+            }
+            if (tagtype == TAG_COMPOUND && subfields != Py_None) {
+                if (!PyDict_Check(subfields)) {
+                    PyErr_SetString(PyExc_TypeError, "nested fields must be a dict or None");
+                    Py_DECREF(name);
+                    Py_DECREF(ret);
+                    return NULL;
+                }
+                payload = nbt_read_compound(r, depth + 1, subfields);
+            } else {
+                payload = nbt_read_payload(r, tagtype, depth + 1);
+            }
+        } else {
+            payload = nbt_read_payload(r, tagtype, depth + 1);
+        }
+        if (payload == NULL || PyDict_SetItem(ret, name, payload) < 0) {
+            Py_DECREF(name);
+            Py_XDECREF(payload);
+            Py_DECREF(ret);
+            return NULL;
+        }
+        Py_DECREF(name);
+        Py_DECREF(payload);
+    }
+
+    return ret;
+}
+
+static PyObject *nbt_read_payload(NBTReader *r, int tagtype, int depth) {
+    const unsigned char *p;
+
+    if (depth > NBT_MAX_DEPTH) {
+        PyErr_SetString(PyExc_ValueError, "NBT data is nested too deeply");
+        return NULL;
+    }
+
+    switch (tagtype) {
+    case TAG_END:
+        return PyInt_FromLong(0);
+    case TAG_BYTE:
+        if (!nbt_need(r, 1))
+            return NULL;
+        p = r->data + r->pos;
+        r->pos += 1;
+        return PyInt_FromLong((signed char)p[0]);
+    case TAG_SHORT:
+        if (!nbt_need(r, 2))
+            return NULL;
+        p = r->data + r->pos;
+        r->pos += 2;
+        return PyInt_FromLong((short)nbt_get_u16(p));
+    case TAG_INT:
+        if (!nbt_need(r, 4))
+            return NULL;
+        p = r->data + r->pos;
+        r->pos += 4;
+        return PyInt_FromLong((int)nbt_get_u32(p));
+    case TAG_LONG:
+        {
+            PY_LONG_LONG value;
+            if (!nbt_need(r, 8))
+                return NULL;
+            p = r->data + r->pos;
+            r->pos += 8;
+            value = (PY_LONG_LONG)nbt_get_u64(p);
+            /* struct.unpack gives an int if it fits, so do we */
+            if (value >= LONG_MIN && value <= LONG_MAX)
+                return PyInt_FromLong((long)value);
+            return PyLong_FromLongLong(value);
+        }
+    case TAG_FLOAT:
+        {
+            unsigned int bits;
+            float value;
+            if (!nbt_need(r, 4))
+                return NULL;
+            bits = nbt_get_u32(r->data + r->pos);
+            r->pos += 4;
+            memcpy(&value, &bits, sizeof(value));
+            return PyFloat_FromDouble(value);
+        }
+    case TAG_DOUBLE:
+        {
+            unsigned PY_LONG_LONG bits;
+            double value;
+            if (!nbt_need(r, 8))
+                return NULL;
+            bits = nbt_get_u64(r->data + r->pos);
+            r->pos += 8;
+            memcpy(&value, &bits, sizeof(value));
+            return PyFloat_FromDouble(value);
+        }
+    case TAG_BYTE_ARRAY:
+        {
+            int length;
+            PyObject *ret;
+            if (!nbt_need(r, 4))
+                return NULL;
+            length = (int)nbt_get_u32(r->data + r->pos);
+            r->pos += 4;
+            if (!nbt_need(r, length))
+                return NULL;
+            ret = PyString_FromStringAndSize((const char *)(r->data + r->pos), length);
+            r->pos += length;
+            return ret;
+        }
+    case TAG_STRING:
+        return nbt_read_string(r);
+    case TAG_LIST:
+        return nbt_read_list(r, depth);
+    case TAG_COMPOUND:
+        return nbt_read_compound(r, depth, NULL);
+    case TAG_INT_ARRAY:
+        {
+            int length, i;
+            PyObject *ret;
+            if (!nbt_need(r, 4))
+                return NULL;
+            length = (int)nbt_get_u32(r->data + r->pos);
+            r->pos += 4;
+            if (length < 0 || !nbt_need(r, (Py_ssize_t)length * 4)) {
+                PyErr_SetString(PyExc_ValueError, "invalid NBT int array length");
+                return NULL;
+            }
+            ret = PyTuple_New(length);
+            if (ret == NULL)
+                return NULL;
+            for (i = 0; i < length; i++) {
+                PyObject *item = PyInt_FromLong((int)nbt_get_u32(r->data + r->pos));
+                r->pos += 4;
+                if (item == NULL) {
+                    Py_DECREF(ret);
+                    return NULL;
+                }
+                PyTuple_SET_ITEM(ret, i, item);
+            }
+            return ret;
+        }
+    }
+
+    PyErr_Format(PyExc_ValueError, "invalid NBT tag type: %i", tagtype);
+    return NULL;
+}
+
+/* the size of the fixed-size tag payloads, or -1 */
+static inline int nbt_fixed_size(int tagtype) {
+    switch (tagtype) {
+    case TAG_END:
+        return 0;
+    case TAG_BYTE:
+        return 1;
+    case TAG_SHORT:
+        return 2;
+    case TAG_INT:
+    case TAG_FLOAT:
+        return 4;
+    case TAG_LONG:
+    case TAG_DOUBLE:
+        return 8;
+    }
+    return -1;
+}
+
+/* advances past a payload without parsing it, returns 0 on error */
+static int nbt_skip_payload(NBTReader *r, int tagtype, int depth) {
+    int size = nbt_fixed_size(tagtype);
+    int length, i;
+
+    if (depth > NBT_MAX_DEPTH) {
+        PyErr_SetString(PyExc_ValueError, "NBT data is nested too deeply");
+        return 0;
+    }
+
+    if (size >= 0) {
+        if (!nbt_need(r, size))
+            return 0;
+        r->pos += size;
+        return 1;
+    }
+
+    switch (tagtype) {
+    case TAG_BYTE_ARRAY:
+    case TAG_INT_ARRAY:
+        if (!nbt_need(r, 4))
+            return 0;
+        length = (int)nbt_get_u32(r->data + r->pos);
+        r->pos += 4;
+        if (length < 0 || (tagtype == TAG_INT_ARRAY && length > (r->length - r->pos) / 4)) {
+            PyErr_SetString(PyExc_ValueError, "invalid NBT array length");
+            return 0;
+        }
+        if (tagtype == TAG_INT_ARRAY)
+            length *= 4;
+        if (!nbt_need(r, length))
+            return 0;
+        r->pos += length;
+        return 1;
+    case TAG_STRING:
+        if (!nbt_need(r, 2))
+            return 0;
+        length = nbt_get_u16(r->data + r->pos);
+        r->pos += 2;
+        if (!nbt_need(r, length))
+            return 0;
+        r->pos += length;
+        return 1;
+    case TAG_LIST:
+        {
+            int tagid;
+            if (!nbt_need(r, 5))
+                return 0;
+            tagid = (signed char)r->data[r->pos];
+            length = (int)nbt_get_u32(r->data + r->pos + 1);
+            r->pos += 5;
+            if (length <= 0)
+                return 1;
+            size = nbt_fixed_size(tagid);
+            if (size >= 0) {
+                /* skip the whole list at once */
+                if (length > (r->length - r->pos) / (size ? size : 1)) {
+                    PyErr_SetString(PyExc_ValueError, "unexpected end of NBT data");
+                    return 0;
+                }
+                r->pos += (Py_ssize_t)length * size;
+                return 1;
+            }
+            for (i = 0; i < length; i++) {
+                if (!nbt_skip_payload(r, tagid, depth + 1))
+                    return 0;
+            }
+            return 1;
+        }
+    case TAG_COMPOUND:
+        while (1) {
+            int type;
+            if (!nbt_need(r, 1))
+                return 0;
+            type = r->data[r->pos];
+            r->pos += 1;
+            if (type == TAG_END)
+                return 1;
+            /* the name */
+            if (!nbt_skip_payload(r, TAG_STRING, depth + 1))
+                return 0;
+            if (!nbt_skip_payload(r, type, depth + 1))
+                return 0;
+        }
+    }
+
+    PyErr_Format(PyExc_ValueError, "invalid NBT tag type: %i", tagtype);
+    return 0;
+}
+
+/* creates a new, uninitialized, C-contiguous numpy array */
+static PyObject *nbt_new_array(PyObject *shape, const char *dtype) {
+    if (numpy_empty == NULL) {
+        PyObject *numpy = PyImport_ImportModule("numpy");
+        if (numpy == NULL)
+            return NULL;
+        numpy_empty = PyObject_GetAttrString(numpy, "empty");
+        Py_DECREF(numpy);
+        if (numpy_empty == NULL)
+            return NULL;
+    }
+    return PyObject_CallFunction(numpy_empty, "Os", shape, dtype);
+}
+
+/* maps a packed byte to its two 4-bit entries, low nibble first, which is the
+   order they're laid out in the expanded arrays */
+static unsigned char nibble_lut[256][2];
+static int nibble_lut_ready = 0;
+
+static void nbt_init_nibble_lut(void) {
+    int i;
+    for (i = 0; i < 256; i++) {
+        nibble_lut[i][0] = i & 0x0F;
+        nibble_lut[i][1] = i >> 4;
+    }
+    nibble_lut_ready = 1;
+}
+
+/* turns a packed 4-bit-per-entry byte string (SkyLight, BlockLight, Data)
+   into a 16x16x16 uint8 array */
+static PyObject *nbt_expand_nibbles(PyObject *packed, const char *name) {
+    PyObject *shape, *ret;
+    const unsigned char *src;
+    unsigned char *dest;
+    int i;
+
+    if (packed == NULL || !PyString_Check(packed) || PyString_GET_SIZE(packed) != 2048) {
+        PyErr_Format(PyExc_ValueError, "chunk section has a missing or invalid %s array", name);
+        return NULL;
+    }
+
+    shape = Py_BuildValue("(iii)", 16, 16, 16);
+    if (shape == NULL)
+        return NULL;
+    ret = nbt_new_array(shape, "uint8");
+    Py_DECREF(shape);
+    if (ret == NULL)
+        return NULL;
+
+    if (!nibble_lut_ready)
+        nbt_init_nibble_lut();
+    src = (const unsigned char *)PyString_AS_STRING(packed);
+    dest = (unsigned char *)PyArray_DATA((PyArrayObject *)ret);
+    for (i = 0; i < 2048; i++)
+        memcpy(dest + 2 * i, nibble_lut[src[i]], 2);
+
+    return ret;
+}
+
+/* turns the Blocks byte string, and the optional packed Add array, into a
+   16x16x16 uint16 array */
+static PyObject *nbt_expand_blocks(PyObject *blocks, PyObject *add) {
+    PyObject *shape, *ret;
+    const unsigned char *src;
+    unsigned short *dest;
+    int i;
+
+    if (blocks == NULL || !PyString_Check(blocks) || PyString_GET_SIZE(blocks) != 4096) {
+        PyErr_SetString(PyExc_ValueError, "chunk section has a missing or invalid Blocks array");
+        return NULL;
+    }
+    if (add != NULL && (!PyString_Check(add) || PyString_GET_SIZE(add) != 2048)) {
+        PyErr_SetString(PyExc_ValueError, "chunk section has an invalid Add array");
+        return NULL;
+    }
+
+    shape = Py_BuildValue("(iii)", 16, 16, 16);
+    if (shape == NULL)
+        return NULL;
+    ret = nbt_new_array(shape, "uint16");
+    Py_DECREF(shape);
+    if (ret == NULL)
+        return NULL;
+
+    src = (const unsigned char *)PyString_AS_STRING(blocks);
+    dest = (unsigned short *)PyArray_DATA((PyArrayObject *)ret);
+    for (i = 0; i < 4096; i++)
+        dest[i] = src[i];
+
+    if (add != NULL) {
+        if (!nibble_lut_ready)
+            nbt_init_nibble_lut();
+        src = (const unsigned char *)PyString_AS_STRING(add);
+        for (i = 0; i < 2048; i++) {
+            dest[2 * i] |= nibble_lut[src[i]][0] << 8;
+            dest[2 * i + 1] |= nibble_lut[src[i]][1] << 8;
+        }
+    }
+
+    return ret;
+}
+
+/* the nibble arrays of a chunk section, in the order they're expanded */
+static const char *nbt_section_nibbles[] = {"SkyLight", "BlockLight", "Data"};
+
+/* expands the packed arrays of a chunk section in-place, unless that was
+   already done. returns 0 on error */
+int nbt_decode_section(PyObject *section) {
+    PyObject *blocks, *add;
+    PyObject *expanded[4] = {NULL, NULL, NULL, NULL};
+    int i, ret;
+
+    if (!PyDict_Check(section)) {
+        PyErr_SetString(PyExc_ValueError, "chunk section is not a compound");
+        return 0;
+    }
+    blocks = PyDict_GetItemString(section, "Blocks");
+    if (blocks != NULL && !PyString_Check(blocks))
+        return 1;
+
+    /* expand everything before touching the section, so a failure leaves
+       it untouched (and still recognizably packed) */
+    add = PyDict_GetItemString(section, "Add");
+    expanded[3] = nbt_expand_blocks(blocks, add);
+    ret = expanded[3] != NULL;
+    for (i = 0; i < 3 && ret; i++) {
+        expanded[i] = nbt_expand_nibbles(PyDict_GetItemString(section, nbt_section_nibbles[i]),
+                                         nbt_section_nibbles[i]);
+        ret = expanded[i] != NULL;
+    }
+
+    for (i = 0; i < 3 && ret; i++)
+        ret = PyDict_SetItemString(section, nbt_section_nibbles[i], expanded[i]) == 0;
+    /* Blocks goes last: it's what marks the section as decoded */
+    if (ret)
+        ret = PyDict_SetItemString(section, "Blocks", expanded[3]) == 0;
+    /* Add has been merged into Blocks, save some memory */
+    if (ret && add != NULL)
+        ret = PyDict_DelItemString(section, "Add") == 0;
+
+    for (i = 0; i < 4; i++)
+        Py_XDECREF(expanded[i]);
+    return ret;
+}
+
+/* whether the given fields spec (see nbt_read_compound) keeps a tag */
+static inline int nbt_wants(PyObject *fields, const char *name) {
+    return fields == NULL || fields == Py_None || PyDict_GetItemString(fields, name) != NULL;
+}
+
+/* expands the arrays in the Level compound of a parsed chunk in-place,
+   only touching the tags that the fields spec asked for. with
+   NBT_EXPAND_LAZY, only Biomes is expanded and the sections are left for
+   nbt_decode_section. returns 0 on error */
+static int nbt_expand_chunk(PyObject *root, PyObject *fields, int expand) {
+    PyObject *level, *biomes, *sections, *expanded, *shape;
+    PyObject *level_fields = NULL;
+    Py_ssize_t i;
+
+    if (fields != NULL) {
+        if (!nbt_wants(fields, "Level"))
+            return 1;
+        level_fields = PyDict_GetItemString(fields, "Level");
+    }
+
+    level = PyDict_GetItemString(root, "Level");
+    if (level == NULL || !PyDict_Check(level)) {
+        PyErr_SetString(PyExc_ValueError, "chunk has no Level compound");
+        return 0;
+    }
+
+    /* Biomes becomes a 16x16 array. worlds converted by Jeb's program may be
+       missing the Biomes key, those get all zeros */
+    biomes = PyDict_GetItemString(level, "Biomes");
+    if (biomes != NULL || nbt_wants(level_fields, "Biomes")) {
+        shape = Py_BuildValue("(ii)", 16, 16);
+        if (shape == NULL)
+            return 0;
+        expanded = nbt_new_array(shape, "uint8");
+        Py_DECREF(shape);
+        if (expanded == NULL)
+            return 0;
+        if (biomes == NULL) {
+            memset(PyArray_DATA((PyArrayObject *)expanded), 0, 256);
+        } else if (PyString_Check(biomes) && PyString_GET_SIZE(biomes) == 256) {
+            memcpy(PyArray_DATA((PyArrayObject *)expanded), PyString_AS_STRING(biomes), 256);
+        } else {
+            Py_DECREF(expanded);
+            PyErr_SetString(PyExc_ValueError, "chunk has an invalid Biomes array");
+            return 0;
+        }
+        if (PyDict_SetItemString(level, "Biomes", expanded) < 0) {
+            Py_DECREF(expanded);
+            return 0;
+        }
+        Py_DECREF(expanded);
+    }
+
+    if (!nbt_wants(level_fields, "Sections"))
+        return 1;
+    sections = PyDict_GetItemString(level, "Sections");
+    if (sections == NULL || !PyList_Check(sections)) {
+        PyErr_SetString(PyExc_ValueError, "chunk has no Sections list");
+        return 0;
+    }
+
+    if (expand == NBT_EXPAND_LAZY)
+        return 1;
+    for (i = 0; i < PyList_GET_SIZE(sections); i++) {
+        if (!nbt_decode_section(PyList_GET_ITEM(sections, i)))
+            return 0;
+    }
+
+    return 1;
+}
+
+PyObject *read_nbt(PyObject *self, PyObject *args) {
+    NBTReader reader;
+    const char *data;
+    int length;
+    int expand = 0;
+    PyObject *fields = Py_None;
+    PyObject *name, *payload;
+
+    if (!PyArg_ParseTuple(args, "s#|iO", &data, &length, &expand, &fields))
+        return NULL;
+    if (fields == Py_None) {
+        fields = NULL;
+    } else if (!PyDict_Check(fields)) {
+        PyErr_SetString(PyExc_TypeError, "fields must be a dict or None");
+        return NULL;
+    }
+
+    reader.data = (const unsigned char *)data;
+    reader.length = length;
+    reader.pos = 0;
+
+    if (!nbt_need(&reader, 1))
+        return NULL;
+    if (reader.data[0] != TAG_COMPOUND) {
+        PyErr_SetString(PyExc_ValueError, "Expected a tag compound");
+        return NULL;
+    }
+    reader.pos = 1;
+
+    name = nbt_read_string(&reader);
+    if (name == NULL)
+        return NULL;
+    payload = nbt_read_compound(&reader, 0, fields);
+    if (payload == NULL) {
+        Py_DECREF(name);
+        return NULL;
+    }
+
+    if (expand && !nbt_expand_chunk(payload, fields, expand)) {
+        Py_DECREF(name);
+        Py_DECREF(payload);
+        return NULL;
+    }
+
+    return Py_BuildValue("(NN)", name, payload);
+}
+
+PyObject *decode_section(PyObject *self, PyObject *args) {
+    PyObject *section;
+
+    if (!PyArg_ParseTuple(args, "O!", &PyDict_Type, &section))
+        return NULL;
+    if (!nbt_decode_section(section))
+        return NULL;
+    Py_INCREF(section);
+    return section;
+}
@@ -26,7 +26,7 @@
 
 // increment this value if you've made a change to the c extesion
 // and want to force users to rebuild
-#define OVERVIEWER_EXTENSION_VERSION 46
+#define OVERVIEWER_EXTENSION_VERSION 51
 
 /* Python PIL, and numpy headers */
 #include <Python.h>
@@ -84,7 +84,10 @@ typedef struct {
     PyObject *biomes;
     /* all the sections in a given chunk */
     struct {
-        /* all there is to know about each section */
+        /* the section compound, NULL if the section doesn't exist */
+        PyObject *section;
+        /* all there is to know about each section, NULL until decoded by
+           load_chunk_section */
         PyObject *blocks, *data, *skylight, *blocklight;
     } sections[SECTIONS_PER_CHUNK];
 } ChunkData;
@@ -120,6 +123,8 @@ typedef struct {
 PyObject *init_chunk_render(void);
 /* returns true on error, x,z relative */
 int load_chunk(RenderState* state, int x, int z, unsigned char required);
+/* returns true if the section doesn't exist */
+int load_chunk_section(ChunkData *chunk, int i);
 PyObject *chunk_render(PyObject *self, PyObject *args);
 typedef enum
 {
@@ -198,6 +203,9 @@ static inline unsigned int get_data(RenderState *state, DataType type, int x, in
             return def;
     }
     
+    if (type != BIOMES && load_chunk_section(&(state->chunks[chunkx][chunkz]), chunky))
+        return def;
+    
     switch (type)
     {
     case BLOCKS:
@@ -229,6 +237,15 @@ static inline unsigned int get_data(RenderState *state, DataType type, int x, in
 /* pull in the rendermode info */
 #include "rendermodes.h"
 
+/* in nbt.c */
+/* values for read_nbt's expand argument */
+#define NBT_EXPAND_NONE 0
+#define NBT_EXPAND_ALL 1
+#define NBT_EXPAND_LAZY 2
+PyObject *read_nbt(PyObject *self, PyObject *args);
+int nbt_decode_section(PyObject *section);
+PyObject *decode_section(PyObject *self, PyObject *args);
+
 /* in endian.c */
 void init_endian(void);
 unsigned short big_endian_ushort(unsigned short in);
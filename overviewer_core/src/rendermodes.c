@@ -169,6 +169,104 @@ void render_mode_draw(RenderMode *self, PyObject *img, PyObject *mask, PyObject
     }
 }
 
+/* RenderContext python type */
+
+static PyObject *
+render_context_new(PyTypeObject *type, PyObject *args, PyObject *kwargs) {
+    RenderContext *self;
+    PyObject *world, *mode, *textures;
+    
+    if (!PyArg_ParseTuple(args, "OOO", &world, &mode, &textures))
+        return NULL;
+    
+    self = (RenderContext *)type->tp_alloc(type, 0);
+    if (self == NULL)
+        return NULL;
+    
+    Py_INCREF(world);
+    self->world = world;
+    Py_INCREF(textures);
+    self->textures = textures;
+    self->state.world = world;
+    self->state.textures = textures;
+    
+    self->blockmap = PyObject_GetAttrString(textures, "blockmap");
+    if (self->blockmap == NULL) {
+        Py_DECREF(self);
+        return NULL;
+    }
+    if (self->blockmap == Py_None) {
+        PyErr_SetString(PyExc_RuntimeError, "you must call Textures.generate()");
+        Py_DECREF(self);
+        return NULL;
+    }
+    
+    self->rendermode = render_mode_create(mode, &(self->state));
+    if (self->rendermode == NULL) {
+        /* render_mode_create has set the error */
+        Py_DECREF(self);
+        return NULL;
+    }
+    self->state.rendermode = self->rendermode;
+    
+    return (PyObject *)self;
+}
+
+static void
+render_context_dealloc(RenderContext *self) {
+    if (self->rendermode) {
+        self->rendermode->state = &(self->state);
+        render_mode_destroy(self->rendermode);
+    }
+    Py_XDECREF(self->blockmap);
+    Py_XDECREF(self->textures);
+    Py_XDECREF(self->world);
+    self->ob_type->tp_free((PyObject *)self);
+}
+
+PyTypeObject RenderContextType = {
+    PyObject_HEAD_INIT(NULL)
+    0,                                  /* ob_size */
+    "c_overviewer.RenderContext",       /* tp_name */
+    sizeof(RenderContext),              /* tp_basicsize */
+    0,                                  /* tp_itemsize */
+    (destructor)render_context_dealloc, /* tp_dealloc */
+    0,                                  /* tp_print */
+    0,                                  /* tp_getattr */
+    0,                                  /* tp_setattr */
+    0,                                  /* tp_compare */
+    0,                                  /* tp_repr */
+    0,                                  /* tp_as_number */
+    0,                                  /* tp_as_sequence */
+    0,                                  /* tp_as_mapping */
+    0,                                  /* tp_hash */
+    0,                                  /* tp_call */
+    0,                                  /* tp_str */
+    0,                                  /* tp_getattro */
+    0,                                  /* tp_setattro */
+    0,                                  /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,                 /* tp_flags */
+    "RenderContext(world, mode, textures): a rendermode set up once, to pass "
+    "to render_loop in place of the mode",  /* tp_doc */
+    0,                                  /* tp_traverse */
+    0,                                  /* tp_clear */
+    0,                                  /* tp_richcompare */
+    0,                                  /* tp_weaklistoffset */
+    0,                                  /* tp_iter */
+    0,                                  /* tp_iternext */
+    0,                                  /* tp_methods */
+    0,                                  /* tp_members */
+    0,                                  /* tp_getset */
+    0,                                  /* tp_base */
+    0,                                  /* tp_dict */
+    0,                                  /* tp_descr_get */
+    0,                                  /* tp_descr_set */
+    0,                                  /* tp_dictoffset */
+    0,                                  /* tp_init */
+    0,                                  /* tp_alloc */
+    render_context_new,                 /* tp_new */
+};
+
 /* options parse helper */
 int render_mode_parse_option(PyObject *support, const char *name, const char *format, ...) {
     va_list ap;
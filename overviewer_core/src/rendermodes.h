@@ -98,6 +98,24 @@ int render_mode_occluded(RenderMode *self, int x, int y, int z);
 int render_mode_hidden(RenderMode *self, int x, int y, int z);
 void render_mode_draw(RenderMode *self, PyObject *img, PyObject *mask, PyObject *mask_light);
 
+/* a rendermode that's set up once and reused for every chunk section, as a
+   python object: RenderContext(world, mode, textures). Passing one to
+   render_loop in place of the mode skips creating the rendermode (which
+   parses every primitive's options and calls back into python) each time */
+typedef struct {
+    PyObject_HEAD
+    PyObject *world;
+    PyObject *textures;
+    /* Textures.blockmap, checked to have been generated */
+    PyObject *blockmap;
+    RenderMode *rendermode;
+    /* the state the primitives were started with. render_loop points the
+       rendermode at its own state while it's drawing */
+    RenderState state;
+} RenderContext;
+extern PyTypeObject RenderContextType;
+#define RenderContext_Check(op) PyObject_TypeCheck(op, &RenderContextType)
+
 /* helper function for reading in rendermode options
    works like PyArg_ParseTuple on a support object */
 int render_mode_parse_option(PyObject *support, const char *name, const char *format, ...);
@@ -23,19 +23,29 @@ import random
 import functools
 import time
 import errno
+import hashlib
 import stat
+import struct
+import zlib
 from collections import namedtuple
 from itertools import product, izip, chain
 
 from PIL import Image
+import numpy
 
 from .util import roundrobin
 from . import nbt
-from .files import FileReplacer, get_fs_caps
+from . import textures
+from .cache import LRUCache
+from .files import FileReplacer, get_fs_caps, default_caps
 from .optimizeimages import optimize_image
 import rendermodes
 import c_overviewer
-from c_overviewer import resize_half
+from c_overviewer import resize_half, alpha_over
+
+# The chunk tags render_loop() asks the regionset for. Chunks are cached by
+# the fields they were loaded with, so preloading must ask for the same ones
+RENDER_FIELDS = ('Sections', 'Biomes')
 
 """
 
@@ -85,6 +95,10 @@ do_work(workobj)
     return anything, so the results of its work should be reflected on the
     filesystem or by sending signals.
 
+work_done(workobj)
+    Called in the main process once the given work object has been done,
+    wherever it was done.
+
 
 """
 
@@ -288,6 +302,31 @@ class TileSet(object):
         self.last_rendertime = config.get('last_rendertime', 0)
         self.forcerendertime = config.get('forcerendertime', 0)
 
+        self.journal = RenderJournal(self.outputdir)
+        self.manifest = TileManifest(os.path.join(self.outputdir, "tile_manifest.dat"))
+        self.rendertile_mtimes = None
+
+        # Chunk sections are drawn on their own and reused for each tile they
+        # overlap, if there's room for them. Only sections of opaque blocks
+        # come out the same that way, and only if every primitive of the
+        # rendermode allows it
+        self.sprites = None
+        if self.options.get('spritecache_mb') and all(getattr(p, "sprite_safe", False)
+                for p in self.options['rendermode']):
+            self.sprites = SpriteCache(self.options['spritecache_mb'] * 1024 * 1024)
+        # What's in each chunk's sections, for skipping those that draw
+        # nothing. Sections covered by others are only skipped if every
+        # primitive of the rendermode allows it
+        self.section_summaries = SectionSummaryCache()
+        self.section_culling = all(getattr(p, "section_culling", False)
+                for p in self.options['rendermode'])
+        # The rendermode, set up for render_loop() the first time a tile is
+        # rendered in each process, by which time the textures have been
+        # generated. See _get_render_context()
+        self.render_context = None
+        # set when picking up an interrupted render from its journal
+        self.resuming = False
+
         if "renderchecks" not in self.options:
             # renderchecks was not given, this indicates it was not specified
             # in either the config file or the command line. The following code
@@ -320,6 +359,13 @@ class TileSet(object):
                         "normally happen. I guess we have no choice but to do a "
                         "--forcerender", self.options['name'])
                 self.options['renderchecks'] = 2
+            elif config.get("render_in_progress", False) and self.journal.exists():
+                # The last render was interrupted, but it left a journal of
+                # what it had done. Do the rest of it.
+                logging.info("The last render for '%s' didn't finish. "
+                        "Picking up where it left off.", self.options['name'])
+                self.resuming = True
+                self.options['renderchecks'] = 0
             elif config.get("render_in_progress", False):
                 # The last render must have been interrupted. The default should be
                 # a check-tiles render then
@@ -373,15 +419,20 @@ class TileSet(object):
         else:
             raise ValueError("imgformat must be one of: 'png' or 'jpg'")
 
-        # This sets self.treedepth, self.xradius, and self.yradius
-        self._set_map_size()
+        # This sets self.treedepth, self.xradius, and self.yradius. When
+        # unpickling in a worker these come along with the pickled state, so
+        # the worker doesn't have to scan the whole world again
+        if not hasattr(self, "treedepth"):
+            self._set_map_size()
 
-    # Only pickle the initial state. Don't pickle anything resulting from the
-    # do_preprocessing step
+    # Only pickle the initial state and the map geometry. Don't pickle
+    # anything resulting from the do_preprocessing step
     def __getstate__(self):
-        return self.world, self.regionset, self.am, self.textures, self.options, self.outputdir
+        return (self.world, self.regionset, self.am, self.textures, self.options, self.outputdir,
+                (self.treedepth, self.xradius, self.yradius))
     def __setstate__(self, state):
-        self.__init__(*state)
+        self.treedepth, self.xradius, self.yradius = state[6]
+        self.__init__(*state[:6])
 
     def do_preprocessing(self):
         """For the preprocessing step of the Worker interface, this does the
@@ -404,8 +455,31 @@ class TileSet(object):
         if self.config:
             self._rearrange_tiles()
 
+        # Now that the tree has its final depth, make sure there's a manifest
+        # to go with it
+        if not self.manifest.open(self.treedepth, create=True):
+            logging.debug("This map is too deep for a tile manifest. Tiles "
+                    "will be checked on disk.")
+
         # Do the chunk scan here
-        self.dirtytree = self._chunk_scan()
+        self.scantime = int(time.time())
+        self.finished = {}
+        if self.resuming:
+            state = self.journal.load(self.treedepth)
+            if state is None:
+                logging.warning("The render journal for '%s' can't be used. "
+                        "I'll be scanning all the tiles to make sure "
+                        "everything's up to date.", self.options['name'])
+                self.resuming = False
+                self.options['renderchecks'] = 1
+        if self.resuming:
+            # Do the tiles the interrupted render didn't get to, and any
+            # tiles whose chunks changed since it started
+            self.dirtytree, self.scantime, self.finished = state
+            self.changedtree = self._chunk_scan(last_rendertime=self.scantime)
+            self.dirtytree.update(self.changedtree)
+        else:
+            self.dirtytree = self._chunk_scan()
 
     def get_num_phases(self):
         """Returns the number of levels in the quadtree, which is equal to the
@@ -420,10 +494,11 @@ class TileSet(object):
         """
         # Yeah functional programming!
         return {
-                0: lambda: self.dirtytree.count_all(),
+                0: lambda: max(0, self._get_work_tree().count_all() -
+                    sum(len(keys) for keys in self.finished.itervalues())),
                 #there is no good way to guess this so just give total count
                 1: lambda: (4**(self.treedepth+1)-1)/3,
-                2: lambda: self.dirtytree.count_all(),
+                2: lambda: self._get_work_tree().count_all(),
                 }[self.options['renderchecks']]()
 
     def iterate_work_items(self, phase):
@@ -455,6 +530,10 @@ class TileSet(object):
                 # many tileset objects, and as soon as this method exists the
                 # file object may be garbage collected, closing the file.
                 os.write(fd, imgpath + "\n")
+                if isinstance(tilepath, SubtreeWork):
+                    for subpath in tilepath.posttraversal(self.treedepth):
+                        if subpath != tilepath:
+                            write_out(subpath)
 
 
         # See note at the top of this file about the rendercheck modes for an
@@ -464,7 +543,18 @@ class TileSet(object):
         # render. Iterate over the tiles in using the posttraversal() method.
         # Yield each item. Easy.
         if self.options['renderchecks'] in (0,2):
-            for tilepath in self.dirtytree.posttraversal(robin=True):
+            # Keep a journal of the work done, in case this render is
+            # interrupted
+            if self.resuming:
+                self.journal.resume()
+            elif self.dirtytree:
+                self.journal.start(self.dirtytree, self.scantime)
+            for tilepath in self._iterate_dirty_work_items():
+                if self.resuming and self._is_finished(tilepath) and \
+                        not self.changedtree.query_path(tilepath):
+                    # done by the interrupted render, and nothing changed
+                    # under it since
+                    continue
                 dependencies = []
                 # These tiles may or may not exist, but the dispatcher won't
                 # care according to the worker interface protocol It will only
@@ -479,6 +569,7 @@ class TileSet(object):
             # For mode 1, self.dirtytree holds every tile that should exist,
             # but invoke _iterate_and_check_tiles() to determine which tiles
             # need rendering.
+            self.journal.discard()
             for tilepath, mtime, needs_rendering in self._iterate_and_check_tiles(()):
                 if needs_rendering:
                     dependencies = []
@@ -488,16 +579,90 @@ class TileSet(object):
                         write_out(tilepath)
                     yield tilepath, dependencies
 
+    def _get_subtree_levels(self):
+        """Returns how many levels of tiles each work item covers, less one"""
+        # There's always at least the base tile on its own
+        return max(0, min(self.options.get('subtreelevels', 0), self.treedepth - 1))
+
+    def _get_work_tree(self):
+        """Returns the tree of tiles that have a work item of their own, for
+        rendercheck modes 0 and 2. With subtreelevels set, that's the top tiles
+        of the subtrees that are rendered in one piece."""
+        levels = self._get_subtree_levels()
+        if not levels:
+            return self.dirtytree
+        tops = ArrayRendertileSet(self.treedepth - levels)
+        tops.add_keys(self.dirtytree.keys >> (2 * levels))
+        return tops
+
+    def _iterate_dirty_work_items(self):
+        """Yields the work items for rendercheck modes 0 and 2 in the order
+        they should be done: a tile path for each tile in self.dirtytree, or
+        SubtreeWork items for the bottom levels if subtreelevels is set"""
+        levels = self._get_subtree_levels()
+        tops = self._get_work_tree()
+        keys = self.dirtytree.keys
+        shift = 2 * levels
+        # Spreading the work over the map keeps parallel renders from all
+        # waiting on the same composite-tiles, but following a curve through
+        # the map has each job use mostly the same chunks as the last
+        local = self.options.get('renderorder') == 'local'
+        for path in tops.posttraversal(robin=not local, hilbert=local):
+            if not levels or len(path) < tops.depth:
+                yield path
+            else:
+                lo = tops._path_key(path) << shift
+                start, end = keys.searchsorted([lo, lo + (1 << shift)])
+                yield SubtreeWork(path, keys[start:end] - lo)
+
+    def _is_finished(self, tilepath):
+        """Returns whether the interrupted render this one is resuming
+        finished the given tile"""
+        keys = self.finished.get(len(tilepath))
+        if keys is None:
+            return False
+        key = 0
+        for pathelement in tilepath:
+            key = key * 4 + pathelement
+        i = keys.searchsorted(key)
+        return bool(i < len(keys) and keys[i] == key)
+
+    def work_done(self, tilepath):
+        """Records a finished tile in the journal. The base tile is always
+        the last one, so the render is done when it is."""
+        self.journal.add(tilepath)
+        if len(tilepath) == 0:
+            self.journal.discard()
+
+    def finish(self):
+        """Called in the main process once every work item is done. Packs
+        the tile manifest, so only the entries in use are left in the output
+        directory."""
+        self.manifest.pack(self.fs_caps)
+
     def do_work(self, tilepath):
         """Renders the given tile.
 
         tilepath is yielded by iterate_work_items and is an iterable of
         integers representing the path of the tile to render.
 
+        """
+        self.manifest.open(self.treedepth)
+        if isinstance(tilepath, SubtreeWork):
+            self._render_subtree(tilepath)
+        else:
+            self._render_tile(tilepath)
+
+    def _render_tile(self, tilepath, images=None):
+        """Renders the given tile, and returns the image, or None if there's
+        no new image. images maps the numbers of any of a composite-tile's
+        children that were just rendered to their images, so they don't have
+        to be read back from disk.
+
         """
         if len(tilepath) == self.treedepth:
             # A render-tile
-            self._render_rendertile(RenderTile.from_path(tilepath))
+            return self._render_rendertile(RenderTile.from_path(tilepath))
         else:
             # A composite-tile
             if len(tilepath) == 0:
@@ -508,7 +673,49 @@ class TileSet(object):
                 # All others
                 dest = os.path.join(self.outputdir, *(str(x) for x in tilepath[:-1]))
                 name = str(tilepath[-1])
-            self._render_compositetile(dest, name)
+            return self._render_compositetile(dest, name, tilepath, images)
+
+    def _render_subtree(self, work):
+        """Renders every tile of a SubtreeWork item. Each tile's image is
+        kept in memory until its parent is made from it, so only tiles that
+        weren't rendered in this job are read from disk."""
+        images = {}
+        for tilepath in work.posttraversal(self.treedepth):
+            children = {}
+            for childnum in xrange(4):
+                img = images.pop(tilepath + (childnum,), None)
+                if img is not None:
+                    children[childnum] = img
+            img = self._render_tile(tilepath, children)
+            if img is not None:
+                images[tilepath] = img
+
+    # how many of a subtree's render-tiles prefetch() loads the chunks of.
+    # The rest are rendered from chunks loaded as they're needed, so that a
+    # big subtree doesn't push its own first chunks out of the cache
+    prefetch_subtree_tiles = 4
+
+    def prefetch(self, tilepath):
+        """Loads the chunks the given work item will need into the
+        regionset's caches, ahead of do_work(). Worker processes call this
+        from a background thread for their next job while rendering the
+        current one. Composite-tiles don't need any chunks, and for a
+        SubtreeWork item only the chunks of the first few render-tiles it
+        renders are loaded.
+
+        """
+        if isinstance(tilepath, SubtreeWork):
+            paths = itertools.islice((p for p in tilepath.posttraversal(self.treedepth)
+                    if len(p) == self.treedepth), self.prefetch_subtree_tiles)
+        elif len(tilepath) == self.treedepth:
+            paths = [tilepath]
+        else:
+            return
+        coords = set()
+        for path in paths:
+            tile = RenderTile.from_path(path)
+            coords.update((c[2], c[4]) for c in get_chunks_by_tile(tile, self.regionset))
+        self.regionset.get_chunks(coords, fields=RENDER_FIELDS)
 
     def get_initial_data(self):
         """This is called similarly to get_persistent_data, but is called after
@@ -576,14 +783,15 @@ class TileSet(object):
         """
         minrow = mincol = maxrow = maxcol = 0
 
-        for c_x, c_z, _ in self.regionset.iterate_chunks():
+        c_x, c_z, _ = self.regionset.chunk_table()
+        if len(c_x):
             # Convert these coordinates to row/col
-            col, row = convert_coords(c_x, c_z)
+            cols, rows = convert_coords(c_x.astype(numpy.int64), c_z.astype(numpy.int64))
 
-            minrow = min(minrow, row)
-            maxrow = max(maxrow, row)
-            mincol = min(mincol, col)
-            maxcol = max(maxcol, col)
+            minrow = min(minrow, int(rows.min()))
+            maxrow = max(maxrow, int(rows.max()))
+            mincol = min(mincol, int(cols.min()))
+            maxcol = max(maxcol, int(cols.max()))
         return Bounds(mincol, maxcol, minrow, maxrow)
 
     def _set_map_size(self):
@@ -717,9 +925,12 @@ class TileSet(object):
                 if e.errno != errno.ENOENT:
                     raise
 
-    def _chunk_scan(self):
+    def _chunk_scan(self, last_rendertime=None):
         """Scans the chunks of this TileSet's world to determine which
-        render-tiles need rendering. Returns a RendertileSet object.
+        render-tiles need rendering. Returns an ArrayRendertileSet object.
+
+        last_rendertime, if given, is used instead of the time of the last
+        render for rendercheck mode 0.
 
         For rendercheck mode 0: only compares chunk mtimes against last render
         time of the map, and marks tiles as dirty if any chunk has a greater
@@ -729,20 +940,20 @@ class TileSet(object):
         unconditionally, does not check any mtimes.
 
         As a side-effect, the scan sets self.max_chunk_mtime to the max of all
-        the chunks' mtimes
+        the chunks' mtimes. For mode 1 it also sets self.rendertile_mtimes to a
+        pair of arrays: the keys of every render-tile, as an ArrayRendertileSet
+        keys them, and the max mtime of each tile's chunks.
 
         """
         # See note at the top of this file about the rendercheck modes for an
         # explanation of what this method does in different situations.
 
-        # Local vars for slightly faster lookups
         depth = self.treedepth
         xradius = self.xradius
         yradius = self.yradius
 
-        dirty = RendertileSet(depth)
+        dirty = ArrayRendertileSet(depth)
 
-        chunkcount = 0
         stime = time.time()
 
         rendercheck = self.options['renderchecks']
@@ -750,68 +961,80 @@ class TileSet(object):
 
         rerender_prob = self.options['rerenderprob']
 
-        last_rendertime = self.last_rendertime
-
-        max_chunk_mtime = 0
-
-
-        # For each chunk, do this:
-        #   For each tile that the chunk touches, do this:
-        #       Compare the last modified time of the chunk and tile. If the
-        #       tile is older, mark it in a RendertileSet object as dirty.
-
-        for chunkx, chunkz, chunkmtime in self.regionset.iterate_chunks():
-
-            chunkcount += 1
-
-            if chunkmtime > max_chunk_mtime:
-                max_chunk_mtime = chunkmtime
-
-            # Convert to diagonal coordinates
-            chunkcol, chunkrow = convert_coords(chunkx, chunkz)
-
-            for c, r in get_tiles_by_chunk(chunkcol, chunkrow):
-
-                # Make sure the tile is in the boundary we're rendering.
-                # This can happen when rendering at lower treedepth than
-                # can contain the entire map, but shouldn't happen if the
-                # treedepth is correctly calculated.
-                if (
-                        c < -xradius or
-                        c >= xradius or
-                        r < -yradius or
-                        r >= yradius
-                        ):
-                    continue
-
-                # Computes the path in the quadtree from the col,row coordinates
-                tile = RenderTile.compute_path(c, r, depth)
-
-                if markall:
-                    # markall mode: Skip all other checks, mark tiles
-                    # as dirty unconditionally
-                    dirty.add(tile.path)
-                    continue
-
-                # Check if this tile has already been marked dirty. If so,
-                # no need to do any of the below.
-                if dirty.query_path(tile.path):
-                    continue
-
-                # Stochastic check. Since we're scanning by chunks and not
-                # by tiles, and the tiles get checked multiple times for
-                # each chunk, this is only an approximation. The given
-                # probability is for a particular tile that needs
-                # rendering, but since a tile gets touched up to 32 times
-                # (once for each chunk in it), divide the probability by
-                # 32.
-                if rerender_prob and rerender_prob/32 > random.random():
-                    dirty.add(tile.path)
-                    continue
+        if last_rendertime is None:
+            last_rendertime = self.last_rendertime
+
+        # For every chunk, find every tile that the chunk touches. The tile is
+        # dirty if any of its chunks is newer than the tile. This is all done
+        # on whole arrays of chunks at a time; tiles are only handled one by
+        # one once the duplicates are gone.
+
+        chunkx, chunkz, chunkmtime = self.regionset.chunk_table()
+        chunkcount = len(chunkx)
+        max_chunk_mtime = int(chunkmtime.max()) if chunkcount else 0
+
+        if not markall:
+            # Stochastic check. Since we're scanning by chunks and not by
+            # tiles, and the tiles get checked multiple times for each chunk,
+            # this is only an approximation. The given probability is for a
+            # particular tile that needs rendering, but since a tile gets
+            # touched up to 32 times (once for each chunk in it), divide the
+            # probability by 32. Each chunk is tried once here, for all of the
+            # tiles it touches.
+            changed = chunkmtime > last_rendertime
+            if rerender_prob:
+                changed |= numpy.random.random(chunkcount) < rerender_prob/32.0
+            chunkx = chunkx[changed]
+            chunkz = chunkz[changed]
+
+        # Tiles are keyed by a single integer while the duplicates are
+        # removed. Chunks are done in batches to bound memory use on big
+        # worlds. For mode 1, also find the newest chunk of every tile, so
+        # tiles can be checked against the manifest without looking up their
+        # chunks one at a time.
+        tilekeys = []
+        tilemtimes = []
+        batch = 65536
+        for start in xrange(0, len(chunkx), batch):
+            cols, rows = convert_coords(chunkx[start:start+batch].astype(numpy.int64),
+                    chunkz[start:start+batch].astype(numpy.int64))
+            if rendercheck == 1:
+                tilecols, tilerows, mtimes = get_tiles_by_chunks(cols, rows,
+                        chunkmtime[start:start+batch])
+            else:
+                tilecols, tilerows = get_tiles_by_chunks(cols, rows)
+
+            # Make sure the tile is in the boundary we're rendering.
+            # This can happen when rendering at lower treedepth than
+            # can contain the entire map, but shouldn't happen if the
+            # treedepth is correctly calculated.
+            inside = ((tilecols >= -xradius) & (tilecols < xradius) &
+                    (tilerows >= -yradius) & (tilerows < yradius))
+            tilecols = tilecols[inside]
+            tilerows = tilerows[inside]
+            keys = (tilecols + xradius) // 2 * (yradius // 2) + (tilerows + yradius) // 4
+            if rendercheck == 1:
+                keys, mtimes = _max_by_key(keys, mtimes[inside])
+                tilemtimes.append(mtimes)
+                tilekeys.append(keys)
+            else:
+                tilekeys.append(numpy.unique(keys))
 
-                # Check mtimes and conditionally add tile to the set
-                if chunkmtime > last_rendertime:
-                    dirty.add(tile.path)
+        self.rendertile_mtimes = None
+        if tilekeys:
+            if rendercheck == 1:
+                tilekeys, tilemtimes = _max_by_key(numpy.concatenate(tilekeys),
+                        numpy.concatenate(tilemtimes))
+            else:
+                tilekeys = numpy.unique(numpy.concatenate(tilekeys))
+            tilecols = tilekeys // (yradius // 2) * 2 - xradius
+            tilerows = tilekeys % (yradius // 2) * 4 - yradius
+            paths = RenderTile.compute_paths(tilecols, tilerows, depth)
+            dirty.add_paths(paths)
+            if rendercheck == 1:
+                # keyed the same way as the dirty tree, for binary searches
+                self.rendertile_mtimes = _max_by_key(
+                        ArrayRendertileSet.path_keys(paths), tilemtimes)
 
         t = int(time.time()-stime)
         logging.debug("Finished chunk scan for %s. %s chunks scanned in %s second%s",
@@ -824,13 +1047,17 @@ class TileSet(object):
     def __str__(self):
         return "<TileSet for %s>" % os.path.basename(self.outputdir)
 
-    def _render_compositetile(self, dest, name):
+    def _render_compositetile(self, dest, name, path, images=None):
         """
         Renders a tile at os.path.join(dest, name)+".ext" by taking tiles from
         os.path.join(dest, name, "{0,1,2,3}.png")
 
         If name is "base" then render tile at os.path.join(dest, "base.png") by
         taking tiles from os.path.join(dest, "{0,1,2,3}.png")
+
+        path is the tile's path, for its entry in the manifest. images maps
+        child numbers to the images of any children that are already in
+        memory. Returns the new image, or None if the tile wasn't remade.
         """
         imgformat = self.imgextension
         imgpath = os.path.join(dest, name) + "." + imgformat
@@ -853,19 +1080,31 @@ class TileSet(object):
                     ]
 
         # Check each of the 4 child tiles, getting their existance and mtime
-        # infomation. Also keep track of the max mtime of all children
+        # infomation from the manifest, or from the disk for tiles it doesn't
+        # know about. Also keep track of the max mtime of all children, and
+        # whether any of them changed since this tile was last made
         max_mtime = 0
         quadPath_filtered = []
-        for path in quadPath:
-            try:
-                quad_mtime = os.stat(path[1])[stat.ST_MTIME]
-            except OSError:
-                # This tile doesn't exist or some other error with the stat
-                # call. Move on.
-                continue
+        children_changed = False
+        for childnum, quad in enumerate(quadPath):
+            childpath = path + (childnum,)
+            if self.manifest.is_changed(childpath):
+                children_changed = True
+            entry = self.manifest.get(childpath)
+            if entry is not None:
+                quad_mtime = entry[0]
+            else:
+                try:
+                    quad_mtime = os.stat(quad[1])[stat.ST_MTIME]
+                except OSError:
+                    # This tile doesn't exist or some other error with the stat
+                    # call. Move on.
+                    continue
+                # No telling whether this one changed
+                children_changed = True
             # The tile exists, so we need to use it in our rendering of this
             # composite tile
-            quadPath_filtered.append(path)
+            quadPath_filtered.append((childnum,) + quad)
             if quad_mtime > max_mtime:
                 max_mtime = quad_mtime
 
@@ -877,9 +1116,18 @@ class TileSet(object):
                 # Ignore errors if it's "file doesn't exist"
                 if e.errno != errno.ENOENT:
                     raise
+            self.manifest.clear(path)
             logging.warning("Tile %s was requested for render, but no children were found! This is probably a bug", imgpath)
             return
 
+        # If none of the children changed, this tile would come out the same
+        # as it is. A forcerender redoes it anyway.
+        forcerender = self.options['renderchecks'] == 2
+        oldentry = self.manifest.get(path)
+        if oldentry is not None and not children_changed and not forcerender:
+            self.manifest.set(path, max_mtime, oldentry[1], changed=False)
+            return None
+
         #logging.debug("writing out compositetile {0}".format(imgpath))
 
         # Create the actual image now
@@ -888,33 +1136,45 @@ class TileSet(object):
         # we'll use paste (NOT alpha_over) for quadtree generation because
         # this is just straight image stitching, not alpha blending
 
-        for path in quadPath_filtered:
+        for childnum, offset, quadpath in quadPath_filtered:
             try:
-                #quad = Image.open(path[1]).resize((192,192), Image.ANTIALIAS)
-                src = Image.open(path[1])
-                src.load()
+                #quad = Image.open(quadpath).resize((192,192), Image.ANTIALIAS)
+                src = images.get(childnum) if images else None
+                if src is None:
+                    src = Image.open(quadpath)
+                    src.load()
                 quad = Image.new("RGBA", (192, 192), self.options['bgcolor'])
                 resize_half(quad, src)
-                img.paste(quad, path[0])
+                img.paste(quad, offset)
             except Exception, e:
-                logging.warning("Couldn't open %s. It may be corrupt. Error was '%s'", path[1], e)
+                logging.warning("Couldn't open %s. It may be corrupt. Error was '%s'", quadpath, e)
                 logging.warning("I'm going to try and delete it. You will need to run the render again and with --check-tiles")
+                self.manifest.clear(path + (childnum,))
                 try:
-                    os.unlink(path[1])
+                    os.unlink(quadpath)
                 except Exception, e:
-                    logging.error("While attempting to delete corrupt image %s, an error was encountered. You will need to delete it yourself. Error was '%s'", path[1], e)
+                    logging.error("While attempting to delete corrupt image %s, an error was encountered. You will need to delete it yourself. Error was '%s'", quadpath, e)
 
-        # Save it
-        with FileReplacer(imgpath, capabilities=self.fs_caps) as tmppath:
-            if imgformat == 'jpg':
-                img.save(tmppath, "jpeg", quality=self.options['imgquality'], subsampling=0)
-            else: # png
-                img.save(tmppath, "png")
+        # Save it, unless it came out the same as before
+        imghash = pixel_hash(img)
+        if oldentry is not None and oldentry[1] == imghash and not forcerender:
+            self.manifest.set(path, max_mtime, imghash, changed=False)
+        else:
+            with FileReplacer(imgpath, capabilities=self.fs_caps) as tmppath:
+                if imgformat == 'jpg':
+                    img.save(tmppath, "jpeg", quality=self.options['imgquality'], subsampling=0)
+                else: # png
+                    img.save(tmppath, "png")
 
-            if self.options['optimizeimg']:
-                optimize_image(tmppath, imgformat, self.options['optimizeimg'])
+                if self.options['optimizeimg']:
+                    optimize_image(tmppath, imgformat, self.options['optimizeimg'])
+
+                os.utime(tmppath, (max_mtime, max_mtime))
+            self.manifest.set(path, max_mtime, imghash)
 
-            os.utime(tmppath, (max_mtime, max_mtime))
+        for childnum in xrange(4):
+            self.manifest.clear_changed(path + (childnum,))
+        return img
 
     def _render_rendertile(self, tile):
         """Renders the given render-tile.
@@ -926,7 +1186,8 @@ class TileSet(object):
         The argument is a RenderTile object
 
         The image is rendered and saved to disk in the place this tileset is
-        configured to save images.
+        configured to save images. Returns the image, or None if there were no
+        chunks to render.
 
         """
 
@@ -939,6 +1200,7 @@ class TileSet(object):
         if not chunks:
             # No chunks were found in this tile
             logging.warning("%s was requested for render, but no chunks found! This may be a bug", tile)
+            self.manifest.clear(tile.path)
             try:
                 os.unlink(imgpath)
             except OSError, e:
@@ -947,7 +1209,7 @@ class TileSet(object):
                     raise
             else:
                 logging.debug("%s deleted", tile)
-            return
+            return None
 
         # Create the directory if not exists
         dirdest = os.path.dirname(imgpath)
@@ -963,6 +1225,17 @@ class TileSet(object):
 
         #logging.debug("writing out worldtile {0}".format(imgpath))
 
+        # Load every chunk of this tile in one batch, so they are read in
+        # disk order rather than render order. The regionset's caches hold
+        # on to them for render_loop(), which asks for the same fields
+        loaded = self.regionset.get_chunks(set((c[2], c[4]) for c in chunks),
+                fields=RENDER_FIELDS)
+        summaries = {}
+        for c in chunks:
+            if (c[2], c[4]) in loaded and (c[2], c[4]) not in summaries:
+                summaries[c[2], c[4]] = self._get_section_summary(
+                        loaded[c[2], c[4]], c[2], c[4], c[5])
+
         # Compile this image
         tileimg = Image.new("RGBA", (384, 384), self.options['bgcolor'])
 
@@ -970,19 +1243,21 @@ class TileSet(object):
         rowstart = tile.row
         # col colstart will get drawn on the image starting at x coordinates -(384/2)
         # row rowstart will get drawn on the image starting at y coordinates -(192/2)
-        max_chunk_mtime = 0
-        for col, row, chunkx, chunky, chunkz, chunk_mtime in chunks:
+        max_chunk_mtime = max(c[5] for c in chunks)
+        neighbours = {}
+        # sections that don't exist or are all air have nothing to draw
+        for col, row, chunkx, chunky, chunkz, chunk_mtime in get_chunks_by_tile(
+                tile, self.regionset, present_only=True):
             xpos = -192 + (col-colstart)*192
             ypos = -96 + (row-rowstart)*96 + (16-1 - chunky)*192
 
-            if chunk_mtime > max_chunk_mtime:
-                max_chunk_mtime = chunk_mtime
+            if self._is_section_hidden(summaries, chunkx, chunky, chunkz):
+                continue
 
             # draw the chunk!
             try:
-                c_overviewer.render_loop(self.world, self.regionset, chunkx, chunky,
-                        chunkz, tileimg, xpos, ypos,
-                        self.options['rendermode'], self.textures)
+                self._draw_section(tileimg, chunkx, chunky, chunkz, xpos, ypos,
+                        neighbours, summaries)
             except nbt.CorruptionError:
                 # A warning and traceback was already printed by world.py's
                 # get_chunk()
@@ -1008,7 +1283,15 @@ class TileSet(object):
             #draw.text((96,48), "C: %s,%s" % (chunkx, chunkz), fill='red')
             #draw.text((96,96), "c,r: %s,%s" % (col, row), fill='red')
 
-        # Save them
+        # Save them, unless the chunks changed in ways that don't show. A
+        # forcerender writes them anyway.
+        imghash = pixel_hash(tileimg)
+        oldentry = self.manifest.get(tile.path)
+        if oldentry is not None and oldentry[1] == imghash and \
+                self.options['renderchecks'] != 2:
+            self.manifest.set(tile.path, max_chunk_mtime, imghash, changed=False)
+            return tileimg
+
         with FileReplacer(imgpath, capabilities=self.fs_caps) as tmppath:
             if self.imgextension == 'jpg':
                 tileimg.save(tmppath, "jpeg", quality=self.options['imgquality'], subsampling=0)
@@ -1019,6 +1302,111 @@ class TileSet(object):
                 optimize_image(tmppath, self.imgextension, self.options['optimizeimg'])
 
             os.utime(tmppath, (max_chunk_mtime, max_chunk_mtime))
+        self.manifest.set(tile.path, max_chunk_mtime, imghash)
+        return tileimg
+
+    def _get_render_context(self):
+        """Returns a c_overviewer.RenderContext for this tileset's rendermode,
+        creating it on first use. render_loop() takes it in place of the list
+        of primitives, and then doesn't need to set them up again for every
+        chunk section it draws.
+
+        """
+        if self.render_context is None:
+            self.render_context = c_overviewer.RenderContext(self.world,
+                    self.options['rendermode'], self.textures)
+        return self.render_context
+
+    def _get_section_summary(self, chunk, chunkx, chunkz, mtime):
+        """Returns get_section_summary() for the given chunk, remembering it
+        for the other tiles the chunk is in"""
+        key = (chunkx, chunkz, mtime)
+        try:
+            return self.section_summaries[key]
+        except KeyError:
+            summary = self.section_summaries[key] = get_section_summary(chunk)
+            return summary
+
+    def _is_section_hidden(self, summaries, chunkx, chunky, chunkz):
+        """Returns True if render_loop() wouldn't draw anything that shows
+        for the given chunk section. summaries maps the (x, z) coordinates of
+        the tile's chunks to get_section_summary() tuples.
+
+        A block in the isometric view is drawn over exactly by the block one
+        step closer to the viewer in x, one up and one towards the viewer in
+        z. So a section is covered by the section one chunk over in -x and +z
+        and one up, if that section is all opaque blocks, since it's drawn
+        later on.
+
+        """
+        summary = summaries.get((chunkx, chunkz))
+        if summary is None:
+            # render_loop() deals with chunks that couldn't be loaded
+            return False
+        opaque, jitter, top, plain = summary
+        if chunky > top:
+            return True
+        if not self.section_culling or jitter & (1 << chunky):
+            return False
+        front = summaries.get((chunkx - 1, chunkz + 1))
+        return front is not None and bool(front[0] & (1 << (chunky + 1)))
+
+    def _draw_section(self, tileimg, chunkx, chunky, chunkz, xpos, ypos, neighbours, summaries):
+        """Draws a chunk section onto a tile at the given position, from the
+        sprite cache if it's in use and the section can be drawn on its own.
+        neighbours is as for _draw_section_sprite(), and summaries as for
+        _is_section_hidden().
+
+        A see-through block tints what's behind it as it's drawn, which
+        it can't do in a sprite, so sections with any are always drawn
+        straight onto the tile.
+
+        """
+        summary = summaries.get((chunkx, chunkz))
+        if self.sprites is not None and summary is not None and \
+                summary[3] & (1 << chunky):
+            self._draw_section_sprite(tileimg, chunkx, chunky, chunkz, xpos, ypos, neighbours)
+        else:
+            c_overviewer.render_loop(self.world, self.regionset, chunkx, chunky,
+                    chunkz, tileimg, xpos, ypos,
+                    self._get_render_context(), self.textures)
+
+    def _draw_section_sprite(self, tileimg, chunkx, chunky, chunkz, xpos, ypos, neighbours):
+        """Draws a chunk section onto a tile as render_loop() would, from the
+        sprite cache if the section was drawn for another tile already.
+        neighbours is a dict for remembering the chunk mtimes around each
+        chunk for the length of one tile."""
+        # The section looks different if it or the chunks around it change
+        mtimes = neighbours.get((chunkx, chunkz))
+        if mtimes is None:
+            mtimes = neighbours[chunkx, chunkz] = tuple(
+                    self.regionset.get_chunk_mtime(chunkx + dx, chunkz + dz)
+                    for dx in (-1, 0, 1) for dz in (-1, 0, 1))
+        key = (chunkx, chunky, chunkz, mtimes)
+        try:
+            sprite = self.sprites[key]
+        except KeyError:
+            sprite = self.sprites[key] = self._render_section_sprite(chunkx, chunky, chunkz)
+        if sprite is not None:
+            img, x, y = sprite
+            alpha_over(tileimg, img, (xpos + x, ypos + y), img)
+
+    def _render_section_sprite(self, chunkx, chunky, chunkz):
+        """Draws a chunk section into a sprite of its own. Returns (image, x,
+        y), where the image is cropped to what was drawn and x, y is where it
+        goes relative to the position given to render_loop(). Returns None if
+        nothing was drawn."""
+        # render_loop() draws a section within a 384 pixel square, but tall
+        # grass is moved by up to 3 pixels
+        margin = SpriteCache.margin
+        img = Image.new("RGBA", (384 + 2*margin, 384 + 2*margin), (0, 0, 0, 0))
+        c_overviewer.render_loop(self.world, self.regionset, chunkx, chunky,
+                chunkz, img, margin, margin,
+                self._get_render_context(), self.textures)
+        bbox = img.getbbox()
+        if bbox is None:
+            return None
+        return img.crop(bbox), bbox[0] - margin, bbox[1] - margin
 
     def _iterate_and_check_tiles(self, path):
         """A generator function over all tiles that should exist in the subtree
@@ -1054,21 +1442,36 @@ class TileSet(object):
             # Render this tile if any of its chunks are greater than its mtime
             tileobj = RenderTile.from_path(path)
             imgpath = tileobj.get_filepath(self.outputdir, self.imgextension)
-            try:
-                tile_mtime = os.stat(imgpath)[stat.ST_MTIME]
-            except OSError, e:
-                if e.errno != errno.ENOENT:
-                    raise
-                tile_mtime = 0
-            
-            try:
-                max_chunk_mtime = max(c[5] for c in get_chunks_by_tile(tileobj, self.regionset))
-            except ValueError:
-                # max got an empty sequence! something went horribly wrong
-                logging.warning("tile %s expected contains no chunks! this may be a bug", path)
-                max_chunk_mtime = 0
+            entry = self.manifest.get(path)
+            if entry is not None:
+                tile_mtime = entry[0]
+            else:
+                try:
+                    tile_mtime = os.stat(imgpath)[stat.ST_MTIME]
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    tile_mtime = 0
+
+            if self.rendertile_mtimes is not None:
+                # The chunk scan found the newest chunk of every tile
+                keys, mtimes = self.rendertile_mtimes
+                key = self.dirtytree._path_key(path)
+                i = keys.searchsorted(key)
+                if i < len(keys) and keys[i] == key:
+                    max_chunk_mtime = int(mtimes[i])
+                else:
+                    logging.warning("tile %s expected contains no chunks! this may be a bug", path)
+                    max_chunk_mtime = 0
+            else:
+                try:
+                    max_chunk_mtime = max(c[5] for c in get_chunks_by_tile(tileobj, self.regionset))
+                except ValueError:
+                    # max got an empty sequence! something went horribly wrong
+                    logging.warning("tile %s expected contains no chunks! this may be a bug", path)
+                    max_chunk_mtime = 0
 
-            if tile_mtime > 120 + max_chunk_mtime:
+            if entry is None and tile_mtime > 120 + max_chunk_mtime:
                 # If a tile has been modified more recently than any of its
                 # chunks, then this could indicate a potential issue with
                 # this or future renders.
@@ -1135,15 +1538,19 @@ class TileSet(object):
                 yield path, None, True
             else:
                 # Check this tile's mtime
-                imgpath = os.path.join(self.outputdir, *(str(x) for x in path))
-                imgpath += "." + self.imgextension
-                logging.debug("Testing mtime for composite-tile %s", imgpath)
-                try:
-                    tile_mtime = os.stat(imgpath)[stat.ST_MTIME]
-                except OSError, e:
-                    if e.errno != errno.ENOENT:
-                        raise
-                    tile_mtime = 0
+                entry = self.manifest.get(path)
+                if entry is not None:
+                    tile_mtime = entry[0]
+                else:
+                    imgpath = os.path.join(self.outputdir, *(str(x) for x in path))
+                    imgpath += "." + self.imgextension
+                    logging.debug("Testing mtime for composite-tile %s", imgpath)
+                    try:
+                        tile_mtime = os.stat(imgpath)[stat.ST_MTIME]
+                    except OSError, e:
+                        if e.errno != errno.ENOENT:
+                            raise
+                        tile_mtime = 0
 
                 if tile_mtime < max_child_mtime:
                     # If any child was updated more recently than ourself, then
@@ -1158,6 +1565,7 @@ class TileSet(object):
         _iterate_and_check_tiles() as a helper-method.
 
         """
+        self.manifest.clear(path)
         if len(path) == self.treedepth:
             # path referrs to a single tile
             tileobj = RenderTile.from_path(path)
@@ -1231,11 +1639,115 @@ def get_tiles_by_chunk(chunkcol, chunkrow):
 
     return product(colrange, rowrange)
 
-def get_chunks_by_tile(tile, regionset):
+def get_tiles_by_chunks(chunkcols, chunkrows, values=None):
+    """Does what get_tiles_by_chunk() does, for numpy arrays of chunk columns
+    and rows at once. Returns arrays of the (tilecol, tilerow) of every tile
+    that each chunk touches, in no particular order.
+
+    If values is given, it's an array of something for each chunk, and a third
+    array is returned with the value of the chunk for each of the tiles.
+
+    """
+    tilecol = chunkcols - chunkcols % 2
+    tilerow = chunkrows - chunkrows % 4
+
+    colsets = []
+    rowsets = []
+    valuesets = []
+    # each chunk touches the tile its column is in, and the one to the left
+    # too if it's in an even column. Likewise it touches the next 9 tiles
+    # down, and the one above as well if its row is divisible by 4
+    for coloffset, colmask in ((0, None), (-2, chunkcols % 2 == 0)):
+        for rowoffset in xrange(-4, 32+1, 4):
+            if rowoffset < 0:
+                mask = chunkrows % 4 == 0
+                if colmask is not None:
+                    mask &= colmask
+            else:
+                mask = colmask
+            if mask is None:
+                colsets.append(tilecol + coloffset)
+                rowsets.append(tilerow + rowoffset)
+                if values is not None:
+                    valuesets.append(values)
+            else:
+                colsets.append(tilecol[mask] + coloffset)
+                rowsets.append(tilerow[mask] + rowoffset)
+                if values is not None:
+                    valuesets.append(values[mask])
+    if values is not None:
+        return (numpy.concatenate(colsets), numpy.concatenate(rowsets),
+                numpy.concatenate(valuesets))
+    return numpy.concatenate(colsets), numpy.concatenate(rowsets)
+
+def _max_by_key(keys, values):
+    """Given equal length arrays, returns the sorted unique keys and the
+    largest value given for each"""
+    order = numpy.argsort(keys, kind="mergesort")
+    keys = keys[order]
+    starts = numpy.flatnonzero(numpy.concatenate(([True], keys[1:] != keys[:-1])))
+    return keys[starts], numpy.maximum.reduceat(values[order], starts)
+
+# Blocks that hide everything behind them, indexed by block id. Unknown
+# blocks are taken to be transparent, as the C code does
+OPAQUE_BLOCKS = numpy.zeros(4096, dtype=bool)
+OPAQUE_BLOCKS[[b for b in textures.known_blocks - textures.transparent_blocks
+        if 0 < b < 4096]] = True
+
+def get_section_summary(chunk):
+    """Summarizes the sections of a chunk, as returned by
+    RegionSet.get_chunk(), for telling which of them can't be seen in a tile.
+    Returns a tuple (opaque, jitter, top, plain):
+
+    opaque
+        A bitmask of the sections made entirely of opaque blocks. Bit y is set
+        for section y.
+
+    jitter
+        A bitmask of the sections with blocks drawn a little outside their own
+        outline. Tall grass is moved about by a few pixels.
+
+    top
+        The highest section with any blocks in it, or -1 if there are none.
+
+    plain
+        A bitmask of the sections with nothing but opaque blocks and air.
+        These can be drawn into sprites.
+
+    """
+    opaque = jitter = plain = 0
+    top = -1
+    for section in chunk.get('Sections', ()):
+        y = section['Y']
+        if not 0 <= y < 16:
+            continue
+        try:
+            blocks = nbt.decode_section(section)['Blocks']
+        except nbt.CorruptChunkError:
+            # leave it to render_loop() to give up on
+            top = max(top, y)
+            continue
+        if not blocks.any():
+            continue
+        top = max(top, y)
+        opaque_blocks = OPAQUE_BLOCKS[blocks]
+        if opaque_blocks.all():
+            opaque |= 1 << y
+        if (opaque_blocks | (blocks == 0)).all():
+            plain |= 1 << y
+        if (blocks == 31).any():
+            jitter |= 1 << y
+    return opaque, jitter, top, plain
+
+def get_chunks_by_tile(tile, regionset, present_only=False):
     """Get chunk sections that are relevant to the given render-tile. Only
     returns chunk sections that are in chunks that actually exist according to
-    the given regionset object. (Does not check to see if the chunk section
-    itself within the chunk exists)
+    the given regionset object.
+
+    If present_only is True, only chunk sections that exist and have blocks in
+    them are returned, according to the regionset's get_section_mask(). This
+    loads the chunks, with the fields render_loop() uses. Otherwise the chunk
+    sections within the chunks aren't checked.
 
     This function is expected to return the chunk sections in the correct order
     for rendering, i.e. back to front.
@@ -1250,6 +1762,7 @@ def get_chunks_by_tile(tile, regionset):
         get_mtime = lambda x,y: True
     else:
         get_mtime = regionset.get_chunk_mtime
+    masks = {}
 
     # Each tile has two even columns and an odd column of chunks.
 
@@ -1283,8 +1796,17 @@ def get_chunks_by_tile(tile, regionset):
             )):
         chunkx, chunkz = unconvert_coords(col, row)
         mtime = get_mtime(chunkx, chunkz)
-        if mtime:
-            yield (col, row, chunkx, y, chunkz, mtime)
+        if not mtime:
+            continue
+        if present_only:
+            try:
+                mask = masks[chunkx, chunkz]
+            except KeyError:
+                mask = masks[chunkx, chunkz] = regionset.get_section_mask(
+                        chunkx, chunkz, fields=RENDER_FIELDS)
+            if not mask & (1 << y):
+                continue
+        yield (col, row, chunkx, y, chunkz, mtime)
 
 class RendertileSet(object):
     """This object holds a set of render-tiles using a quadtree data structure.
@@ -1512,6 +2034,625 @@ class RendertileSet(object):
             logging.error("Please report this to the developers: RendertileSet num_tiles_all=%r, count_all=%r, children=%r", self.num_tiles, num, self.children)
         return num
 
+class ArrayRendertileSet(object):
+    """A set of render-tiles with the same interface as RendertileSet, but
+    kept as a sorted numpy array of tile keys instead of a tree of Python
+    lists. A tile's key is its quadtree path read as a base 4 number, so the
+    tiles under any upper-tile have consecutive keys, and questions about a
+    whole subtree are a binary search away.
+
+    Tiles added one at a time are buffered and merged into the array the
+    next time it's needed, and whole arrays of paths can be added at once
+    with add_paths(). The set can be written to and read from a file with
+    save() and load().
+
+    This takes 8 bytes per render-tile, so even trees with millions of dirty
+    tiles only take a few MB.
+
+    """
+    __slots__ = ("depth", "_keys", "_pending")
+
+    # written at the start of saved files
+    _magic = "OVRTSET1"
+
+    def __init__(self, depth):
+        # keys are int64, two bits per level
+        assert depth <= 31
+        self.depth = depth
+        self._keys = numpy.zeros(0, dtype=numpy.int64)
+        self._pending = []
+
+    def __getstate__(self):
+        return self.depth, self.keys
+    def __setstate__(self, state):
+        self.__init__(state[0])
+        self._keys = state[1]
+
+    @property
+    def keys(self):
+        """The sorted array of the keys of the render-tiles in this set"""
+        if self._pending:
+            pending = [numpy.asarray(p, dtype=numpy.int64).ravel() for p in self._pending]
+            self._keys = numpy.unique(numpy.concatenate([self._keys] + pending))
+            self._pending = []
+        return self._keys
+
+    def _path_key(self, path):
+        key = 0
+        for pathelement in path:
+            key = key * 4 + pathelement
+        return key
+
+    def add(self, path):
+        """Marks the requested leaf node as in this set
+
+        Path is an iterable of integers representing the path to the leaf node
+        that is to be added to the set
+
+        """
+        path = list(path)
+        assert len(path) == self.depth
+        self._pending.append(self._path_key(path))
+
+    def add_paths(self, paths):
+        """Adds every render-tile in a (tiles, depth) array of paths, as
+        returned by RenderTile.compute_paths()"""
+        paths = numpy.asarray(paths)
+        assert paths.ndim == 2 and paths.shape[1] == self.depth
+        self._pending.append(self.path_keys(paths))
+
+    def add_keys(self, keys):
+        """Adds every render-tile in an array of keys. They needn't be sorted
+        or distinct."""
+        self._pending.append(keys)
+
+    @staticmethod
+    def path_keys(paths):
+        """Returns the keys of each of a (tiles, depth) array of paths"""
+        keys = numpy.zeros(len(paths), dtype=numpy.int64)
+        for level in xrange(paths.shape[1]):
+            keys = keys * 4 + paths[:, level]
+        return keys
+
+    def update(self, other):
+        """Adds every render-tile of another ArrayRendertileSet of the same
+        depth to this one"""
+        assert other.depth == self.depth
+        self._pending.append(other.keys)
+
+    def __iter__(self):
+        return self.iterate()
+
+    def iterate(self, level=None, robin=False, offset=(0,0)):
+        """Returns an iterator over every tile in this set, in the same order
+        as RendertileSet.iterate(), which describes the arguments.
+
+        """
+        if level is None:
+            todepth = 1
+        else:
+            if not (level > 0 and level <= self.depth):
+                raise ValueError("Level parameter must be between 1 and %s" % self.depth)
+            todepth = self.depth - level + 1
+
+        keys = self.keys
+        return (tuple(path) for path in self._iterate_helper(keys, [], 0, 0, len(keys), self.depth, onlydepth=todepth, robin=robin, offset=offset))
+
+    def posttraversal(self, robin=False, offset=(0,0), hilbert=False):
+        """Returns an iterator over tile paths for every tile in the set,
+        including the implicitly marked upper-tiles, in the same order as
+        RendertileSet.posttraversal()
+
+        If hilbert is set, the other arguments are ignored, and the
+        render-tiles come in the order of a Hilbert curve instead, so that
+        each one is next to the one before. Upper-tiles still come right after
+        the last tile under them.
+
+        """
+        keys = self.keys
+        if hilbert:
+            return (tuple(path) for path in self._hilbert_helper(keys, [], 0, 0, len(keys), self.depth, (False, False)))
+        return (tuple(path) for path in self._iterate_helper(keys, [], 0, 0, len(keys), self.depth, robin=robin, offset=offset))
+
+    # The Hilbert curve visits the quadrants of a tile in this order, given
+    # as (x, y), with the way each quadrant's curve is transformed: whether x
+    # and y are swapped, and whether both are flipped
+    _hilbert_children = (
+            ((0, 0), (True, False)),
+            ((0, 1), (False, False)),
+            ((1, 1), (False, False)),
+            ((1, 0), (True, True)),
+            )
+
+    def _hilbert_helper(self, keys, path, lo, start, end, depth, transform):
+        """Like _iterate_helper(), but yields the tiles of the subtree in the
+        order of a Hilbert curve transformed as given"""
+        span = 4 ** (depth - 1)
+        bounds = [start] + (keys[start:end].searchsorted([lo + span, lo + 2*span, lo + 3*span]) + start).tolist() + [end]
+        swap, flip = transform
+
+        for (x, y), (childswap, childflip) in self._hilbert_children:
+            if swap:
+                x, y = y, x
+            if flip:
+                x, y = 1 - x, 1 - y
+            childnum = x + 2*y
+            s, e = bounds[childnum], bounds[childnum + 1]
+            if e > s:
+                if depth == 1:
+                    yield path + [childnum]
+                else:
+                    for p in self._hilbert_helper(keys, path + [childnum], lo + childnum*span, s, e, depth-1,
+                            (swap != childswap, flip != childflip)):
+                        yield p
+
+        if end > start:
+            yield path
+
+    def _iterate_helper(self, keys, path, lo, start, end, depth, onlydepth=None, robin=False, offset=(0,0)):
+        """Yields tile paths for every tile in the subtree at path. That
+        subtree has depth levels, its keys start at lo, and its render-tiles
+        are keys[start:end]."""
+
+        # the slices of keys under each of the four children
+        span = 4 ** (depth - 1)
+        bounds = [start] + (keys[start:end].searchsorted([lo + span, lo + 2*span, lo + 3*span]) + start).tolist() + [end]
+        children_list = zip(bounds[:-1], bounds[1:])
+
+        targetdepth = 1 if onlydepth is None else onlydepth
+
+        if depth == targetdepth:
+            # Base case
+            for (childnum, (s, e)), _ in distance_sort(enumerate(children_list), offset):
+                if e > s:
+                    yield path + [childnum]
+        else:
+            gens = []
+            for (childnum, (s, e)), childoffset in distance_sort(enumerate(children_list), offset):
+                if e > s:
+                    gens.append(self._iterate_helper(keys, path + [childnum], lo + childnum*span, s, e, depth-1, onlydepth=onlydepth, offset=childoffset))
+
+            for p in roundrobin(gens) if robin else chain(*gens):
+                yield p
+
+        if onlydepth is None and end > start:
+            yield path
+
+    def query_path(self, path):
+        """Queries for the state of the given tile in the tree.
+
+        Returns True for items in the set, False otherwise. Works for
+        rendertiles as well as upper tiles (which are True if they have a
+        descendent that is in the set)
+
+        """
+        keys = self.keys
+        span = 4 ** (self.depth - len(path))
+        lo = self._path_key(path) * span
+        i = keys.searchsorted(lo)
+        return bool(i < len(keys) and keys[i] < lo + span)
+
+    def __nonzero__(self):
+        return bool(len(self.keys))
+
+    def count(self):
+        """Returns the total number of render-tiles in this set.
+
+        """
+        return len(self.keys)
+
+    def count_all(self):
+        """Returns the total number of render-tiles plus implicitly marked
+        upper-tiles in this set
+
+        """
+        keys = self.keys
+        if not len(keys):
+            return 0
+        # the upper-tiles at each level are the distinct prefixes of the keys
+        num = 0
+        for level in xrange(self.depth + 1):
+            prefixes = keys >> (2 * (self.depth - level))
+            num += 1 + numpy.count_nonzero(numpy.diff(prefixes))
+        return num
+
+    def save(self, filename):
+        """Writes this set to the given file. The keys are stored as the
+        compressed differences between consecutive keys, which are small
+        numbers for the clustered sets of tiles real maps have."""
+        keys = self.keys
+        deltas = numpy.diff(numpy.concatenate(([0], keys))).astype("<i8")
+        with open(filename, "wb") as f:
+            f.write(self._magic)
+            f.write(struct.pack("<BQ", self.depth, len(keys)))
+            f.write(zlib.compress(deltas.tostring(), 6))
+
+    @classmethod
+    def load(cls, filename):
+        """Reads a set written by save(). Raises ValueError if the file isn't
+        one."""
+        with open(filename, "rb") as f:
+            data = f.read()
+        header = len(cls._magic) + struct.calcsize("<BQ")
+        if not data.startswith(cls._magic) or len(data) < header:
+            raise ValueError("%s is not a saved tile set" % filename)
+        depth, count = struct.unpack_from("<BQ", data, len(cls._magic))
+        try:
+            deltas = numpy.frombuffer(zlib.decompress(data[header:]), dtype="<i8")
+        except zlib.error, e:
+            raise ValueError("%s is corrupt: %s" % (filename, e))
+        if len(deltas) != count:
+            raise ValueError("%s is truncated" % filename)
+        tiles = cls(depth)
+        tiles._keys = numpy.cumsum(deltas).astype(numpy.int64)
+        return tiles
+
+class SubtreeWork(tuple):
+    """A work item covering a whole subtree of tiles. It's the path of the
+    subtree's top tile, and stands in for that tile as far as dependencies
+    go. The tiles attribute holds the keys of the render-tiles under it that
+    need rendering, relative to the top tile.
+
+    """
+    def __new__(cls, path, tiles):
+        self = tuple.__new__(cls, path)
+        self.tiles = tiles
+        return self
+
+    def __reduce__(self):
+        return (SubtreeWork, (tuple(self), self.tiles))
+
+    def posttraversal(self, depth):
+        """Yields the paths of every tile to render in this subtree of a tree
+        of the given depth, in the order to render them"""
+        tiles = ArrayRendertileSet(depth - len(self))
+        tiles.add_keys(self.tiles)
+        top = tuple(self)
+        for path in tiles.posttraversal():
+            yield top + path
+
+class RenderJournal(object):
+    """A record of the progress of a render, so that an interrupted render
+    can pick up exactly where it left off. It consists of two files in the
+    tileset's output directory: the tree of render-tiles the render set out
+    to do, saved with ArrayRendertileSet.save(), and an append-only journal
+    of the work items finished so far.
+
+    Journal entries are written as work items finish, and synced to disk in
+    batches. A crash may lose the last batch, and those tiles are simply
+    rendered again.
+
+    """
+    _magic = "OVJRNL1\n"
+    # tree depth, time of the chunk scan that made the tree
+    _header = struct.Struct("<BQ")
+    # length of the work item's path, path as a base 4 number
+    _record = struct.Struct("<Bq")
+
+    # sync after this many entries or this many seconds, whichever is first
+    sync_entries = 256
+    sync_seconds = 5
+
+    def __init__(self, outputdir):
+        self.journalfile = os.path.join(outputdir, "render_journal.dat")
+        self.treefile = os.path.join(outputdir, "render_tree.dat")
+        self._f = None
+        self._unsynced = 0
+        self._lastsync = 0
+
+    def exists(self):
+        return os.path.exists(self.journalfile) and os.path.exists(self.treefile)
+
+    def load(self, depth):
+        """Reads the journal of an interrupted render. Returns (tree, scan
+        time, finished), where finished maps path lengths to sorted arrays of
+        the finished work items of that length, as base 4 numbers. Returns
+        None if there's no usable journal for a tree of the given depth."""
+        try:
+            tree = ArrayRendertileSet.load(self.treefile)
+            with open(self.journalfile, "rb") as f:
+                data = f.read()
+        except (IOError, ValueError), e:
+            logging.debug("Couldn't read the render journal: %s", e)
+            return None
+        start = len(self._magic) + self._header.size
+        if not data.startswith(self._magic) or len(data) < start:
+            return None
+        journaldepth, scantime = self._header.unpack_from(data, len(self._magic))
+        if journaldepth != depth or tree.depth != depth:
+            return None
+
+        # a partly written last entry is ignored
+        count = (len(data) - start) // self._record.size
+        records = numpy.frombuffer(data, dtype=[("len", "u1"), ("key", "<i8")],
+                count=count, offset=start)
+        finished = {}
+        for length in numpy.unique(records["len"]).tolist():
+            finished[length] = numpy.unique(records["key"][records["len"] == length])
+        return tree, scantime, finished
+
+    def start(self, tree, scantime):
+        """Begins a new journal for a render of the given tree"""
+        self.discard()
+        tree.save(self.treefile)
+        self._f = open(self.journalfile, "wb")
+        self._f.write(self._magic)
+        self._f.write(self._header.pack(tree.depth, scantime))
+        self._sync()
+
+    def resume(self):
+        """Continues the journal of an interrupted render"""
+        self._f = open(self.journalfile, "ab")
+        self._lastsync = time.time()
+
+    def add(self, workitem):
+        """Records a finished work item"""
+        if self._f is None:
+            return
+        key = 0
+        for pathelement in workitem:
+            key = key * 4 + pathelement
+        self._f.write(self._record.pack(len(workitem), key))
+        self._unsynced += 1
+        if self._unsynced >= self.sync_entries or time.time() - self._lastsync >= self.sync_seconds:
+            self._sync()
+
+    def _sync(self):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._unsynced = 0
+        self._lastsync = time.time()
+
+    def discard(self):
+        """Closes and removes the journal, once the render is finished"""
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        for filename in (self.journalfile, self.treefile):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+class TileManifest(object):
+    """A table of every tile of a tileset, recording the max mtime of the
+    chunks (or child tiles) each one was rendered from and a hash of its
+    pixels. It stands in for the mtimes of the image files themselves, so
+    deciding what to render doesn't take a stat() call for every tile, and
+    still works after the tiles have been copied somewhere that doesn't keep
+    mtimes.
+
+    While a render runs, the table is a file of its own next to the
+    manifest, mapped into memory by every process. Each tile has a fixed
+    place in it, found from its path: the tiles of each zoom level are
+    together, in the order of their keys as base 4 numbers. Since every tile
+    is rendered by exactly one process, and after all of its children, no
+    locking is needed. Tiles that haven't been rendered since the table was
+    made read as unknown, and the tile on disk is checked instead.
+
+    The table is sparse, but its apparent size is that of a full tree: about
+    1.4GB at depth 13. Copying it to a web server would copy all of that, so
+    once a render is finished, pack() writes the entries in use to the
+    manifest file proper and removes the table. The table of an interrupted
+    render is kept, for the next render to carry on with.
+
+    """
+    _magic = "OVTMAN01"
+    # magic, tree depth, padding to keep the entries aligned
+    _header = struct.Struct("<8sB7x")
+    dtype = numpy.dtype([("mtime", "<i4"), ("flags", "<u4"), ("hash", "<u8")])
+
+    # the packed manifest: magic, tree depth, number of entries, then the
+    # compressed entries in use, each with the difference from the last
+    # one's index
+    _packed_magic = "OVTMAN02"
+    _packed_header = struct.Struct("<BQ")
+    packed_dtype = numpy.dtype([("delta", "<i8"), ("mtime", "<i4"), ("flags", "<u4"),
+            ("hash", "<u8")])
+    # entries of the table looked at at once while packing it
+    pack_batch = 1 << 20
+
+    # set for every tile the table knows about
+    EXISTS = 1
+    # set when a tile's pixels change or it's deleted, until its parent is
+    # rendered again
+    CHANGED = 2
+
+    # a depth 14 table is 5.7GB, mostly holes. Deeper trees do without
+    max_depth = 14
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.tablefilename = os.path.splitext(filename)[0] + ".work"
+        self.depth = None
+        self.entries = None
+
+    def open(self, depth, create=False):
+        """Maps the table for a tree of the given depth. If create is set, a
+        missing table, or one for a different depth, is replaced by one
+        filled in from the packed manifest. Returns whether the table is
+        usable. Calling this again with the same depth does nothing, unless
+        it's to create a missing table."""
+        if self.depth == depth and (self.entries is not None or not create):
+            return self.entries is not None
+        self.close()
+        self.depth = depth
+        if depth > self.max_depth:
+            return False
+
+        count = (4 ** (depth + 1) - 1) // 3
+        size = self._header.size + count * self.dtype.itemsize
+        header = self._header.pack(self._magic, depth)
+        try:
+            with open(self.tablefilename, "rb") as f:
+                valid = f.read(self._header.size) == header and \
+                        os.fstat(f.fileno()).st_size == size
+        except IOError:
+            valid = False
+        if not valid:
+            if not create:
+                return False
+            with open(self.tablefilename, "wb") as f:
+                f.write(header)
+                f.truncate(size)
+        self.entries = numpy.memmap(self.tablefilename, dtype=self.dtype, mode="r+",
+                offset=self._header.size, shape=(count,))
+        if not valid:
+            self._unpack()
+        return True
+
+    def _unpack(self):
+        """Fills in a new table from the packed manifest, if there's one for
+        the same depth"""
+        try:
+            with open(self.filename, "rb") as f:
+                data = f.read()
+            start = len(self._packed_magic) + self._packed_header.size
+            if not data.startswith(self._packed_magic) or len(data) < start:
+                raise ValueError("not a packed tile manifest")
+            depth, count = self._packed_header.unpack_from(data, len(self._packed_magic))
+            if depth != self.depth:
+                return
+            records = numpy.frombuffer(zlib.decompress(data[start:]),
+                    dtype=self.packed_dtype)
+            if len(records) != count:
+                raise ValueError("the tile manifest is truncated")
+        except IOError:
+            return
+        except (ValueError, zlib.error), e:
+            logging.warning("The tile manifest %s can't be read (%s). Tiles "
+                    "will be checked on disk.", self.filename, e)
+            return
+        indices = numpy.cumsum(records["delta"])
+        for name in self.dtype.names:
+            self.entries[name][indices] = records[name]
+
+    def pack(self, capabilities=default_caps):
+        """Writes the entries in use to the packed manifest, and removes the
+        table. Called once a render is finished. Does nothing if the table
+        isn't open."""
+        if self.entries is None:
+            return
+        compressor = zlib.compressobj(6)
+        count = 0
+        last = 0
+        with FileReplacer(self.filename, capabilities=capabilities) as tmpname:
+            with open(tmpname, "wb") as f:
+                f.write(self._packed_magic)
+                # the count is filled in at the end
+                f.write(self._packed_header.pack(self.depth, 0))
+                for start in xrange(0, len(self.entries), self.pack_batch):
+                    batch = self.entries[start:start + self.pack_batch]
+                    used = numpy.flatnonzero(batch["flags"])
+                    if not len(used):
+                        continue
+                    records = numpy.empty(len(used), dtype=self.packed_dtype)
+                    indices = used + start
+                    records["delta"] = numpy.diff(numpy.concatenate(([last], indices)))
+                    for name in self.dtype.names:
+                        records[name] = batch[name][used]
+                    f.write(compressor.compress(records.tostring()))
+                    count += len(used)
+                    last = indices[-1]
+                f.write(compressor.flush())
+                f.seek(len(self._packed_magic))
+                f.write(self._packed_header.pack(self.depth, count))
+        self.close()
+        os.remove(self.tablefilename)
+
+    def close(self):
+        if self.entries is not None:
+            self.entries.flush()
+            self.entries = None
+        self.depth = None
+
+    def _index(self, path):
+        key = 0
+        for pathelement in path:
+            key = key * 4 + pathelement
+        return (4 ** len(path) - 1) // 3 + key
+
+    def get(self, path):
+        """Returns the (mtime, hash) recorded for the given tile, or None if
+        the table doesn't know about it"""
+        if self.entries is None:
+            return None
+        mtime, flags, hash = self.entries[self._index(path)].tolist()
+        if not flags & self.EXISTS:
+            return None
+        return mtime, hash
+
+    def is_changed(self, path):
+        """Returns whether the given tile changed since its parent was last
+        rendered"""
+        if self.entries is None:
+            return False
+        return bool(self.entries["flags"][self._index(path)] & self.CHANGED)
+
+    def set(self, path, mtime, hash, changed=True):
+        """Records a freshly rendered tile. changed is whether its pixels are
+        different from before."""
+        if self.entries is None:
+            return
+        index = self._index(path)
+        flags = self.EXISTS | (self.entries["flags"][index] & self.CHANGED)
+        if changed:
+            flags |= self.CHANGED
+        self.entries[index] = (mtime, flags, hash)
+
+    def clear_changed(self, path):
+        """Notes that the parent of the given tile has seen its changes"""
+        if self.is_changed(path):
+            self.entries["flags"][self._index(path)] &= ~self.CHANGED
+
+    def clear(self, path):
+        """Forgets the given tile and every tile under it. If the table knew
+        about the tile, it's marked as changed, for its parent."""
+        if self.entries is None:
+            return
+        index = self._index(path)
+        existed = self.entries["flags"][index] & self.EXISTS
+        key = index - (4 ** len(path) - 1) // 3
+        for level in xrange(len(path), self.depth + 1):
+            span = 4 ** (level - len(path))
+            start = (4 ** level - 1) // 3 + key * span
+            # only write to the entries in use, so the holes stay holes
+            flags = self.entries["flags"][start:start + span]
+            self.entries[start + numpy.flatnonzero(flags)] = (0, 0, 0)
+        if existed:
+            self.entries[index] = (0, self.CHANGED, 0)
+
+class SpriteCache(LRUCache):
+    """An LRUCache of chunk sections drawn on their own, as returned by
+    TileSet._render_section_sprite(), limited to the given number of bytes"""
+    # the extra room around a section's 384 pixel square
+    margin = 3
+
+    def __init__(self, maxbytes):
+        super(SpriteCache, self).__init__(size=None, maxbytes=maxbytes,
+                sizeof=sprite_size)
+
+    def __getstate__(self):
+        return self.maxbytes
+    def __setstate__(self, state):
+        self.__init__(state)
+
+class SectionSummaryCache(LRUCache):
+    """An LRUCache of get_section_summary() tuples, by chunk coordinates and
+    mtime"""
+    def __init__(self, size=4096):
+        super(SectionSummaryCache, self).__init__(size=size)
+
+def sprite_size(sprite):
+    """Estimates the memory a sprite takes up"""
+    if sprite is None:
+        return 64
+    return 4 * sprite[0].size[0] * sprite[0].size[1] + 256
+
+def pixel_hash(img):
+    """Returns a 64 bit hash of the pixels of an image, for the manifest"""
+    return struct.unpack("<Q", hashlib.md5(img.tobytes()).digest()[:8])[0]
+
 def distance_sort(children, (off_x, off_y)):
     order = []
     for child, (dx, dy) in izip(children, [(-1,-1), (1,-1), (-1,1), (1,1)]):
@@ -1643,3 +2784,21 @@ class RenderTile(object):
                     rowbounds[0] = ymid
 
         return cls(col, row, path)
+
+    @staticmethod
+    def compute_paths(cols, rows, depth):
+        """Computes the paths of many tiles at once, as compute_path() does,
+        from numpy arrays of their cols and rows. Returns a (tiles, depth)
+        array with a path in each row.
+
+        """
+        # Each level of the path halves the bounds. Offset from the lower
+        # bounds, the tile's position within them is a binary number, and
+        # each level of the path is one bit of the col and one of the row
+        colbits = (numpy.asarray(cols, dtype=numpy.int64) + 2**depth) // 2
+        rowbits = (numpy.asarray(rows, dtype=numpy.int64) + 2*2**depth) // 4
+        paths = numpy.empty((len(colbits), depth), dtype=numpy.uint8)
+        for level in xrange(depth):
+            shift = depth - 1 - level
+            paths[:, level] = ((colbits >> shift) & 1) + 2 * ((rowbits >> shift) & 1)
+        return paths
@@ -14,19 +14,22 @@
 #    with the Overviewer.  If not, see <http://www.gnu.org/licenses/>.
 
 import functools
+import itertools
 import os
 import os.path
 import logging
 import hashlib
-import time
 import random
 import re
 import locale
+import cPickle
 
 import numpy
 
 from . import nbt
 from . import cache
+from .files import FileReplacer, get_fs_caps
+from .signals import Signal
 
 """
 This module has routines for extracting information about available worlds
@@ -198,7 +201,7 @@ class World(object):
         if not regionset:
             return None
         try:
-            chunk = regionset.get_chunk(chunkX, chunkZ)
+            chunk = regionset.get_chunk(chunkX, chunkZ, fields=('Sections',))
         except ChunkDoesntExist:
             return (spawnX, spawnY, spawnZ)
     
@@ -207,7 +210,7 @@ class World(object):
             targetSection = spawnY//16
             for section in chunk['Sections']:
                 if section['Y'] == targetSection:
-                    blockArray = section['Blocks']
+                    blockArray = nbt.decode_section(section)['Blocks']
                     return blockArray[inChunkX, inChunkZ, y % 16]
             return 0
 
@@ -235,7 +238,11 @@ class RegionSet(object):
 
     """
 
-    def __init__(self, regiondir, rel):
+    # emitted with (regiondir, x, z) the first time each process finds a
+    # chunk to be corrupt
+    corrupt_chunk = Signal('RegionSet', 'corrupt_chunk')
+
+    def __init__(self, regiondir, rel, regionfiles=None):
         """Initialize a new RegionSet to access the region files in the given
         directory.
 
@@ -244,6 +251,11 @@ class RegionSet(object):
         rel is the relative path of this directory, with respect to the
         world directory.
 
+        regionfiles, if given, is the mapping from (x,y) region coords to
+        region filenames, which is otherwise found by listing regiondir. It
+        is passed along when unpickling, so worker processes don't list the
+        directory again.
+
         cachesize, if specified, is the number of chunks to keep parsed and
         in-memory.
 
@@ -267,20 +279,41 @@ class RegionSet(object):
         
         # This is populated below. It is a mapping from (x,y) region coords to filename
         self.regionfiles = {}
-
-        # This holds a cache of open regionfile objects
-        self.regioncache = cache.LRUCache(size=16, destructor=lambda regionobj: regionobj.close())
+        if regionfiles is not None:
+            self.regionfiles.update(regionfiles)
+
+        # This holds a cache of regionfile objects. Each holds a memory
+        # mapping of its region file, not an open file handle. Evicted
+        # regions are not closed explicitly: a worker's prefetch thread may
+        # still be inflating a slice of the mapping, which keeps it alive
+        # until that's done
+        self.regioncache = cache.LRUCache(size=16)
         
-        for x, y, regionfile in self._iterate_regionfiles():
-            # regionfile is a pathname
-            self.regionfiles[(x,y)] = regionfile
+        if regionfiles is None:
+            for x, y, regionfile in self._iterate_regionfiles():
+                # regionfile is a pathname
+                self.regionfiles[(x,y)] = regionfile
 
         self.empty_chunk = [None,None]
         logging.debug("Done scanning regions")
 
+        # The chunk timestamp index, if enabled with use_timestamp_index().
+        # Maps region filenames to (file mtime, file size, packed bitmask of
+        # existing chunks, array of the 1024 chunk timestamps)
+        self.timestamp_index = None
+        self._indexfile = None
+        self._index_dirty = False
+        # region files found to be up to date in the index this run
+        self._index_checked = set()
+
+        # Chunks that failed to load, so they aren't tried again every time
+        # they're asked for. Maps (x, z) to (chunk timestamp, region file
+        # mtime, exception class)
+        self._corrupt = {}
+
     # Re-initialize upon unpickling
     def __getstate__(self):
-        return (self.regiondir, self.rel)
+        return (self.regiondir, self.rel, self.regionfiles)
     def __setstate__(self, state):
         return self.__init__(*state)
 
@@ -308,7 +341,7 @@ class RegionSet(object):
             return region
     
     #@log_other_exceptions
-    def get_chunk(self, x, z):
+    def get_chunk(self, x, z, fields=None):
         """Returns a dictionary object representing the "Level" NBT Compound
         structure for a chunk given its x, z coordinates. The coordinates given
         are chunk coordinates. Raises ChunkDoesntExist exception if the given
@@ -319,16 +352,30 @@ class RegionSet(object):
 
         * The Biomes array is transformed into a 16x16 numpy array
 
-        * For each chunk section:
+        * Each chunk section is left packed until it's passed to
+          nbt.decode_section(), which must be done before using its arrays.
+          Most sections of most chunks are never looked at by the renderer.
+          Decoding a section changes it in-place:
 
           * The "Blocks" byte string is transformed into a 16x16x16 numpy array
           * The Add array, if it exists, is bitshifted left 8 bits and
             added into the Blocks array
-          * The "SkyLight" byte string is transformed into a 16x16x128 numpy
+          * The "SkyLight" byte string is transformed into a 16x16x16 numpy
             array
-          * The "BlockLight" byte string is transformed into a 16x16x128 numpy
+          * The "BlockLight" byte string is transformed into a 16x16x16 numpy
             array
-          * The "Data" byte string is transformed into a 16x16x128 numpy array
+          * The "Data" byte string is transformed into a 16x16x16 numpy array
+
+        If fields is given, it is a sequence of the names of the tags in the
+        "Level" structure that the caller needs, and only those are parsed.
+        Everything else (such as the often large Entities and TileEntities
+        lists) is skipped over without being decoded, and is missing from
+        the returned dictionary. A missing Biomes array is still filled in
+        with zeros if it was asked for.
+
+        A chunk that can't be read raises an nbt.CorruptionError. It is
+        remembered as corrupt, and fails straight away after that until its
+        timestamp in the region header changes.
 
         Warning: the returned data may be cached and thus should not be
         modified, lest it affect the return values of future calls for the same
@@ -338,135 +385,232 @@ class RegionSet(object):
         if regionfile is None:
             raise ChunkDoesntExist("Chunk %s,%s doesn't exist (and neither does its region)" % (x,z))
 
-        # Try a few times to load and parse this chunk before giving up and
-        # raising an error
-        tries = 5
+        if fields is not None:
+            fields = {'Level': dict.fromkeys(fields)}
+
+        if (x, z) in self._corrupt:
+            self._check_corrupt(regionfile, x, z)
+
+        # If loading fails, read the region header again and retry once, in
+        # case the region was being written to when we first read it
+        retried = False
         while True:
             try:
                 region = self._get_regionobj(regionfile)
-                data = region.load_chunk(x, z)
+                data = region.load_chunk(x, z, decode_sections=True, fields=fields,
+                        lazy_sections=True)
             except nbt.CorruptionError, e:
-                tries -= 1
-                if tries > 0:
-                    # Flush the region cache to possibly read a new region file
-                    # header
+                if not retried:
                     logging.debug("Encountered a corrupt chunk at %s,%s. Flushing cache and retrying", x, z)
-                    #logging.debug("Error was:", exc_info=1)
-                    del self.regioncache[regionfile]
-                    time.sleep(0.5)
+                    self._flush_region(regionfile)
+                    retried = True
                     continue
+                if isinstance(e, nbt.CorruptRegionError):
+                    logging.warning("Could not read chunk %d,%d. Its region (%d,%d) may be corrupt. Skipping it.",
+                            x, z,x//32,z//32)
+                elif isinstance(e, nbt.CorruptChunkError):
+                    logging.warning("Could not read chunk %d,%d. It may be corrupt. Skipping it.",
+                            x, z)
                 else:
-                    if isinstance(e, nbt.CorruptRegionError):
-                        logging.warning("Tried several times to read chunk %d,%d. Its region (%d,%d) may be corrupt. Giving up.",
-                                x, z,x//32,z//32)
-                    elif isinstance(e, nbt.CorruptChunkError):
-                        logging.warning("Tried several times to read chunk %d,%d. It may be corrupt. Giving up.",
-                                x, z)
-                    else:
-                        logging.warning("Tried several times to read chunk %d,%d. Unknown error. Giving up.",
-                                x, z)
-                    logging.debug("Full traceback:", exc_info=1)
-                    # Let this exception propagate out through the C code into
-                    # tileset.py, where it is caught and gracefully continues
-                    # with the next chunk
-                    raise
+                    logging.warning("Could not read chunk %d,%d. Unknown error. Skipping it.",
+                            x, z)
+                logging.debug("Full traceback:", exc_info=1)
+                self._corrupt[(x, z)] = (self._get_chunk_timestamp(regionfile, x, z),
+                        self._get_region_mtime(regionfile), e.__class__)
+                self.corrupt_chunk(self.regiondir, x, z)
+                # Let this exception propagate out through the C code into
+                # tileset.py, where it is caught and gracefully continues
+                # with the next chunk
+                raise
             else:
                 # no exception raised: break out of the loop
                 break
 
-
         if data is None:
             raise ChunkDoesntExist("Chunk %s,%s doesn't exist" % (x,z))
 
-        level = data[1]['Level']
-        chunk_data = level
+        # The region reader has already expanded the Biomes array into a
+        # numpy array for us
+        chunk_data = data[1]['Level']
+
+        return chunk_data      
 
-        # Turn the Biomes array into a 16x16 numpy array
+    def _flush_region(self, regionfile):
+        """Drops the cached region object, so its header is read again"""
         try:
-            biomes = numpy.frombuffer(chunk_data['Biomes'], dtype=numpy.uint8)
-            biomes = biomes.reshape((16,16))
+            del self.regioncache[regionfile]
         except KeyError:
-            # worlds converted by Jeb's program may be missing the Biomes key
-            biomes = numpy.zeros((16, 16), dtype=numpy.uint8)
-        chunk_data['Biomes'] = biomes
+            # never made it into the cache, or the prefetch thread already
+            # flushed it
+            pass
 
-        for section in chunk_data['Sections']:
+    def _get_region_mtime(self, regionfile):
+        try:
+            return os.path.getmtime(regionfile)
+        except OSError:
+            return None
 
-            # Turn the Blocks array into a 16x16x16 numpy matrix of shorts,
-            # adding in the additional block array if included.
-            blocks = numpy.frombuffer(section['Blocks'], dtype=numpy.uint8)
-            # Cast up to uint16, blocks can have up to 12 bits of data
-            blocks = blocks.astype(numpy.uint16)
-            blocks = blocks.reshape((16,16,16))
-            if "Add" in section:
-                # This section has additional bits to tack on to the blocks
-                # array. Add is a packed array with 4 bits per slot, so
-                # it needs expanding
-                additional = numpy.frombuffer(section['Add'], dtype=numpy.uint8)
-                additional = additional.astype(numpy.uint16).reshape((16,16,8))
-                additional_expanded = numpy.empty((16,16,16), dtype=numpy.uint16)
-                additional_expanded[:,:,::2] = (additional & 0x0F) << 8
-                additional_expanded[:,:,1::2] = (additional & 0xF0) << 4
-                blocks += additional_expanded
-                del additional
-                del additional_expanded
-                del section['Add'] # Save some memory
-            section['Blocks'] = blocks
-
-            # Turn the skylight array into a 16x16x16 matrix. The array comes
-            # packed 2 elements per byte, so we need to expand it.
-            try:
-                skylight = numpy.frombuffer(section['SkyLight'], dtype=numpy.uint8)
-                skylight = skylight.reshape((16,16,8))
-                skylight_expanded = numpy.empty((16,16,16), dtype=numpy.uint8)
-                skylight_expanded[:,:,::2] = skylight & 0x0F
-                skylight_expanded[:,:,1::2] = (skylight & 0xF0) >> 4
-                del skylight
-                section['SkyLight'] = skylight_expanded
-
-                # Turn the BlockLight array into a 16x16x16 matrix, same as SkyLight
-                blocklight = numpy.frombuffer(section['BlockLight'], dtype=numpy.uint8)
-                blocklight = blocklight.reshape((16,16,8))
-                blocklight_expanded = numpy.empty((16,16,16), dtype=numpy.uint8)
-                blocklight_expanded[:,:,::2] = blocklight & 0x0F
-                blocklight_expanded[:,:,1::2] = (blocklight & 0xF0) >> 4
-                del blocklight
-                section['BlockLight'] = blocklight_expanded
-
-                # Turn the Data array into a 16x16x16 matrix, same as SkyLight
-                data = numpy.frombuffer(section['Data'], dtype=numpy.uint8)
-                data = data.reshape((16,16,8))
-                data_expanded = numpy.empty((16,16,16), dtype=numpy.uint8)
-                data_expanded[:,:,::2] = data & 0x0F
-                data_expanded[:,:,1::2] = (data & 0xF0) >> 4
-                del data
-                section['Data'] = data_expanded
-            except ValueError:
-                # iv'e seen at least 1 case where numpy raises a value error during the reshapes.  i'm not
-                # sure what's going on here, but let's treat this as a corrupt chunk error
-                logging.warning("There was a problem reading chunk %d,%d.  It might be corrupt.  I am giving up and will not render this particular chunk.", x, z)
+    def _get_chunk_timestamp(self, regionfile, x, z):
+        """Returns a chunk's timestamp from its region header, or None if
+        the region can't be read. Unlike get_chunk_mtime(), this doesn't use
+        the timestamp index or warn about corrupt regions."""
+        try:
+            return self._get_regionobj(regionfile).get_chunk_timestamp(x, z)
+        except nbt.CorruptionError:
+            return None
 
-                logging.debug("Full traceback:", exc_info=1)
-                raise nbt.CorruptChunkError()
-        
-        return chunk_data      
+    def _check_corrupt(self, regionfile, x, z):
+        """Raises the error a chunk that was found to be corrupt failed with,
+        unless the chunk has been written since. The region file is only
+        read again if it was modified."""
+        timestamp, regionmtime, error = self._corrupt[(x, z)]
+        newmtime = self._get_region_mtime(regionfile)
+        if newmtime == regionmtime:
+            raise error("Chunk %d,%d is known to be corrupt" % (x, z))
+        self._flush_region(regionfile)
+        if self._get_chunk_timestamp(regionfile, x, z) == timestamp:
+            self._corrupt[(x, z)] = (timestamp, newmtime, error)
+            raise error("Chunk %d,%d is known to be corrupt" % (x, z))
+        # the chunk was rewritten; give it another go
+        del self._corrupt[(x, z)]
+
+    def get_chunks(self, coords, fields=None):
+        """Loads several chunks at once. coords is an iterable of (x, z)
+        chunk coordinates, and fields is as for get_chunk(). Returns a dict
+        mapping each (x, z) to the chunk as get_chunk() would return it.
+        Chunks that don't exist, or that are corrupt, are left out.
+
+        The chunks are grouped by region and loaded in order of their offset
+        in the region file, regardless of the order they were asked for in,
+        so the region files are read front to back instead of seeking
+        around.
+
+        """
+        byregion = {}
+        for x, z in coords:
+            regionfile = self._get_region_path(x, z)
+            if regionfile is not None:
+                byregion.setdefault(regionfile, []).append((x, z))
+
+        chunks = {}
+        for regionfile, regioncoords in sorted(byregion.iteritems()):
+            try:
+                region = self._get_regionobj(regionfile)
+            except nbt.CorruptionError:
+                # get_chunk() will retry and warn about this below
+                pass
+            else:
+                regioncoords.sort(key=lambda c: region.get_chunk_offset(*c))
+            for x, z in regioncoords:
+                try:
+                    chunks[(x, z)] = self.get_chunk(x, z, fields=fields)
+                except (ChunkDoesntExist, nbt.CorruptionError):
+                    pass
+        return chunks
     
 
-    def iterate_chunks(self):
-        """Returns an iterator over all chunk metadata in this world. Iterates
-        over tuples of integers (x,z,mtime) for each chunk.  Other chunk data
-        is not returned here.
-        
+    def use_timestamp_index(self, indexdir):
+        """Keeps a persistent index of the chunk timestamps of every region
+        file in the given directory. Region files that haven't changed (by
+        mtime and size) since the index was written are then served from
+        the index by iterate_chunks() and get_chunk_mtime(), without being
+        opened at all.
+
+        """
+        filename = "chunkindex.%s.dat" % hashlib.md5(self.regiondir).hexdigest()
+        self._indexfile = os.path.join(indexdir, filename)
+        self._index_caps = get_fs_caps(indexdir)
+        self._index_checked = set()
+        self._index_dirty = False
+        try:
+            with open(self._indexfile, "rb") as f:
+                self.timestamp_index = cPickle.load(f)
+        except IOError:
+            self.timestamp_index = {}
+        except Exception:
+            logging.warning("The chunk timestamp index %s is corrupt, rebuilding it", self._indexfile)
+            logging.debug("Full traceback:", exc_info=1)
+            self.timestamp_index = {}
+
+    def save_timestamp_index(self):
+        """Writes out the chunk timestamp index, if it's enabled and has
+        changed since it was loaded"""
+        if self._indexfile is None or not self._index_dirty:
+            return
+        # forget regions that have since been deleted
+        existing = set(os.path.basename(f) for f in self.regionfiles.itervalues())
+        for name in self.timestamp_index.keys():
+            if name not in existing:
+                del self.timestamp_index[name]
+        with FileReplacer(self._indexfile, capabilities=self._index_caps) as tmpname:
+            with open(tmpname, "wb") as f:
+                cPickle.dump(self.timestamp_index, f, cPickle.HIGHEST_PROTOCOL)
+        self._index_dirty = False
+
+    def _get_indexed_region(self, regionfile):
+        """Returns the (packed chunk bitmask, timestamp array) index entry
+        for the given region file, reading the region's header and updating
+        the index if the file changed since it was indexed. May raise
+        nbt.CorruptRegionError
+
         """
+        name = os.path.basename(regionfile)
+        entry = self.timestamp_index.get(name)
+        if name in self._index_checked:
+            return entry[2], entry[3]
+
+        st = os.stat(regionfile)
+        if entry is None or entry[0] != st.st_mtime or entry[1] != st.st_size:
+            present, timestamps = self._get_regionobj(regionfile).get_chunk_table()
+            # chunks that don't exist may have nonsense timestamps
+            timestamps = numpy.where(present, timestamps, 0).astype(numpy.int32)
+            entry = (st.st_mtime, st.st_size, numpy.packbits(present), timestamps)
+            self.timestamp_index[name] = entry
+            self._index_dirty = True
+        self._index_checked.add(name)
+        return entry[2], entry[3]
+
+    def chunk_table(self):
+        """Returns all of the chunks in this world at once, as three parallel
+        int32 numpy arrays: the chunk x coordinates, the chunk z coordinates,
+        and the chunk mtimes. The region headers are read as arrays, and no
+        Python objects are made per chunk, so this is the fast way to look
+        over a whole world.
 
+        """
+        xs, zs, mtimes = [], [], []
         for (regionx, regiony), regionfile in self.regionfiles.iteritems():
             try:
-                mcr = self._get_regionobj(regionfile)
+                if self.timestamp_index is not None:
+                    present, timestamps = self._get_indexed_region(regionfile)
+                    present = numpy.unpackbits(present)
+                else:
+                    present, timestamps = self._get_regionobj(regionfile).get_chunk_table()
             except nbt.CorruptRegionError:
                 logging.warning("Found a corrupt region file at %s,%s. Skipping it.", regionx, regiony)
                 continue
-            for chunkx, chunky in mcr.get_chunks():
-                yield chunkx+32*regionx, chunky+32*regiony, mcr.get_chunk_timestamp(chunkx, chunky)
+            i = numpy.flatnonzero(present).astype(numpy.int32)
+            xs.append(i % 32 + 32*regionx)
+            zs.append(i // 32 + 32*regiony)
+            mtimes.append(timestamps[i])
+        if self.timestamp_index is not None:
+            self.save_timestamp_index()
+
+        if not xs:
+            empty = numpy.zeros(0, dtype=numpy.int32)
+            return empty, empty, empty
+        return (numpy.concatenate(xs).astype(numpy.int32),
+                numpy.concatenate(zs).astype(numpy.int32),
+                numpy.concatenate(mtimes).astype(numpy.int32))
+
+    def iterate_chunks(self):
+        """Returns an iterator over all chunk metadata in this world. Iterates
+        over tuples of integers (x,z,mtime) for each chunk.  Other chunk data
+        is not returned here.
+        
+        """
+        xs, zs, mtimes = self.chunk_table()
+        return itertools.izip(xs.tolist(), zs.tolist(), mtimes.tolist())
 
     def get_chunk_mtime(self, x, z):
         """Returns a chunk's mtime, or False if the chunk does not exist.  This
@@ -478,6 +622,17 @@ class RegionSet(object):
         regionfile = self._get_region_path(x,z)
         if regionfile is None:
             return None
+        if self.timestamp_index is not None:
+            try:
+                present, timestamps = self._get_indexed_region(regionfile)
+            except nbt.CorruptRegionError:
+                logging.warning("Ignoring request for chunk %s,%s; region %s,%s seems to be corrupt",
+                        x,z, x//32,z//32)
+                return None
+            i = (x % 32) + (z % 32)*32
+            if present[i >> 3] & (0x80 >> (i & 7)):
+                return int(timestamps[i])
+            return None
         try:
             data = self._get_regionobj(regionfile)
         except nbt.CorruptRegionError:
@@ -488,6 +643,21 @@ class RegionSet(object):
             return data.get_chunk_timestamp(x,z)
         return None
 
+    def get_section_mask(self, x, z, fields=None):
+        """Returns a bitmask of the sections of a chunk that exist and have
+        blocks other than air in them, with bit y set for section y, or 0 if
+        the chunk does not exist. See chunk_section_mask().
+
+        The chunk is loaded with get_chunk(), with the given fields. Callers
+        that are about to load the chunk anyway should ask for the same
+        fields, so that it's only read once from a cached regionset.
+
+        """
+        try:
+            return chunk_section_mask(self.get_chunk(x, z, fields=fields))
+        except (ChunkDoesntExist, nbt.CorruptionError):
+            return 0
+
     def _get_region_path(self, chunkX, chunkY):
         """Returns the path to the region that contains chunk (chunkX, chunkY)
         Coords can be either be global chunk coords, or local to a region
@@ -533,12 +703,23 @@ class RegionSetWrapper(object):
         return self._r.get_type()
     def get_biome_data(self, x, z):
         return self._r.get_biome_data(x,z)
-    def get_chunk(self, x, z):
-        return self._r.get_chunk(x,z)
+    def get_chunk(self, x, z, fields=None):
+        return self._r.get_chunk(x,z, fields=fields)
+    def get_chunks(self, coords, fields=None):
+        return self._r.get_chunks(coords, fields=fields)
     def iterate_chunks(self):
         return self._r.iterate_chunks()
+    def chunk_table(self):
+        return self._r.chunk_table()
     def get_chunk_mtime(self, x, z):
         return self._r.get_chunk_mtime(x,z)
+    def get_section_mask(self, x, z, fields=None):
+        # loaded through this wrapper's get_chunk(), so that its caching or
+        # cropping applies
+        try:
+            return chunk_section_mask(self.get_chunk(x, z, fields=fields))
+        except (ChunkDoesntExist, nbt.CorruptionError):
+            return 0
     
 # see RegionSet.rotate.  These values are chosen so that they can be
 # passed directly to rot90; this means that they're the number of
@@ -590,12 +771,33 @@ class RotatedRegionSet(RegionSetWrapper):
     def __setstate__(self, args):
         self.__init__(args[0], args[1])
     
-    def get_chunk(self, x, z):
+    def get_chunk(self, x, z, fields=None):
         x,z = self.unrotate(x,z)
-        chunk_data = dict(super(RotatedRegionSet, self).get_chunk(x,z))
+        return self._rotate_chunk(super(RotatedRegionSet, self).get_chunk(x,z, fields=fields))
+
+    def get_chunks(self, coords, fields=None):
+        unrotated = dict((self.unrotate(x,z), (x,z)) for x,z in coords)
+        chunks = super(RotatedRegionSet, self).get_chunks(unrotated.keys(), fields=fields)
+        return dict((unrotated[coord], self._rotate_chunk(chunk))
+                for coord, chunk in chunks.iteritems())
+
+    def _rotate_chunk(self, chunk_data):
+        chunk_data = dict(chunk_data)
+        if 'Sections' in chunk_data:
+            self._rotate_sections(chunk_data)
+        if 'Biomes' in chunk_data:
+            # same as for the sections, for biomes (Z/X indexed)
+            biomes = numpy.swapaxes(chunk_data['Biomes'], 0, 1)
+            biomes = numpy.rot90(biomes, self.north_dir)
+            chunk_data['Biomes'] = numpy.swapaxes(biomes, 0, 1)
+        return chunk_data
+
+    def _rotate_sections(self, chunk_data):
         newsections = []
         for section in chunk_data['Sections']:
-            section = dict(section)
+            # rotating needs the arrays. This decodes the section in the
+            # (cached) chunk we were given, so it's only done once
+            section = dict(nbt.decode_section(section))
             newsections.append(section)
             for arrayname in ['Blocks', 'Data', 'SkyLight', 'BlockLight']:
                 array = section[arrayname]
@@ -607,22 +809,28 @@ class RotatedRegionSet(RegionSetWrapper):
                 array = numpy.swapaxes(array, 0,2)
                 section[arrayname] = array
         chunk_data['Sections'] = newsections
-        
-        # same as above, for biomes (Z/X indexed)
-        biomes = numpy.swapaxes(chunk_data['Biomes'], 0, 1)
-        biomes = numpy.rot90(biomes, self.north_dir)
-        chunk_data['Biomes'] = numpy.swapaxes(biomes, 0, 1)
-        return chunk_data
 
     def get_chunk_mtime(self, x, z):
         x,z = self.unrotate(x,z)
         return super(RotatedRegionSet, self).get_chunk_mtime(x, z)
 
+    def get_section_mask(self, x, z, fields=None):
+        # rotating a chunk doesn't move blocks between sections, so there's
+        # no need to rotate it just for this
+        x,z = self.unrotate(x,z)
+        return self._r.get_section_mask(x, z, fields=fields)
+
     def iterate_chunks(self):
         for x,z,mtime in super(RotatedRegionSet, self).iterate_chunks():
             x,z = self.rotate(x,z)
             yield x,z,mtime
 
+    def chunk_table(self):
+        # the rotation functions work just as well on whole arrays
+        xs, zs, mtimes = super(RotatedRegionSet, self).chunk_table()
+        xs, zs = self.rotate(xs, zs)
+        return xs, zs, mtimes
+
 class CroppedRegionSet(RegionSetWrapper):
     def __init__(self, rsetobj, xmin, zmin, xmax, zmax):
         super(CroppedRegionSet, self).__init__(rsetobj)
@@ -631,21 +839,34 @@ class CroppedRegionSet(RegionSetWrapper):
         self.zmin = zmin//16
         self.zmax = zmax//16
 
-    def get_chunk(self,x,z):
+    def get_chunk(self,x,z, fields=None):
         if (
                 self.xmin <= x <= self.xmax and
                 self.zmin <= z <= self.zmax
                 ):
-            return super(CroppedRegionSet, self).get_chunk(x,z)
+            return super(CroppedRegionSet, self).get_chunk(x,z, fields=fields)
         else:
             raise ChunkDoesntExist("This chunk is out of the requested bounds")
 
+    def get_chunks(self, coords, fields=None):
+        return super(CroppedRegionSet, self).get_chunks(
+                [(x,z) for (x,z) in coords
+                    if
+                        self.xmin <= x <= self.xmax and
+                        self.zmin <= z <= self.zmax
+                    ], fields=fields)
+
     def iterate_chunks(self):
         return ((x,z,mtime) for (x,z,mtime) in super(CroppedRegionSet,self).iterate_chunks()
                 if
                     self.xmin <= x <= self.xmax and
                     self.zmin <= z <= self.zmax
                 )
+    def chunk_table(self):
+        xs, zs, mtimes = super(CroppedRegionSet, self).chunk_table()
+        inside = ((self.xmin <= xs) & (xs <= self.xmax) &
+                (self.zmin <= zs) & (zs <= self.zmax))
+        return xs[inside], zs[inside], mtimes[inside]
     def get_chunk_mtime(self,x,z):
         if (
                 self.xmin <= x <= self.xmax and
@@ -655,6 +876,65 @@ class CroppedRegionSet(RegionSetWrapper):
         else:
             return None
 
+# Bytes taken by a section once decoded: Blocks as uint16, plus Data, SkyLight
+# and BlockLight as uint8, all 16x16x16
+DECODED_SECTION_BYTES = 16 * 16 * 16 * (2 + 1 + 1 + 1)
+
+def estimate_chunk_size(chunk):
+    """Estimates the memory held by a chunk as returned by get_chunk(), for
+    use as the sizeof of a byte-budgeted cache.LRUCache. Sections that are
+    still packed are counted at their decoded size, since the renderer
+    decodes them in place while the chunk sits in the cache.
+
+    """
+    size = 0
+    for name, value in chunk.iteritems():
+        if name == "Sections":
+            for section in value:
+                if isinstance(section.get("Blocks"), (str, buffer)):
+                    size += DECODED_SECTION_BYTES
+                else:
+                    size += cache.estimate_size(section)
+        else:
+            size += cache.estimate_size(value)
+    return size
+
+def chunk_section_mask(chunk):
+    """Returns a bitmask of the sections of a chunk, as returned by
+    get_chunk(), that have blocks other than air in them. Bit y is set for
+    section y. Sections that are still packed are looked at as they are,
+    without decoding them.
+
+    """
+    mask = 0
+    for section in chunk.get("Sections", ()):
+        y = section.get("Y")
+        blocks = section.get("Blocks")
+        if y is None or not 0 <= y < 16 or blocks is None:
+            continue
+        if isinstance(blocks, str):
+            # block ids above 255 have their high bits in Add
+            present = blocks.strip("\x00") or section.get("Add", "").strip("\x00")
+        else:
+            present = blocks.any()
+        if present:
+            mask |= 1 << y
+    return mask
+
+def decode_chunk_sections(chunk):
+    """Decodes every section of a chunk in place, as the renderer would, and
+    returns the chunk. Corrupt sections are left for the renderer to skip.
+    Used to prepare chunks for a cache.SharedMemoryCache, so workers share
+    decoded sections rather than each decoding them again.
+
+    """
+    for section in chunk.get("Sections", ()):
+        try:
+            nbt.decode_section(section)
+        except nbt.CorruptChunkError:
+            pass
+    return chunk
+
 class CachedRegionSet(RegionSetWrapper):
     """A regionset wrapper that implements caching of the results from
     get_chunk()
@@ -688,27 +968,99 @@ class CachedRegionSet(RegionSetWrapper):
         s = hashlib.md5(s).hexdigest()
 
         self.key = s
+        self._fields_keys = {}
 
-    def get_chunk(self, x, z):
-        key = hashlib.md5(repr((self.key, x, z))).hexdigest()
-        for i, cache in enumerate(self.caches):
+    def _get_cache_key(self, x, z, fields):
+        # chunks parsed with different fields are different objects, so the
+        # fields are part of the key. The C code asks for the same fields
+        # tuple every time, so remember how it sorts
+        if fields is not None:
+            try:
+                fields = self._fields_keys[fields]
+            except KeyError:
+                fields = self._fields_keys[fields] = tuple(sorted(fields))
+            except TypeError:
+                fields = tuple(sorted(fields))
+        return (self.key, x, z, fields)
+
+    def _get_tier_key(self, c, key, memo):
+        """Returns the key to use with cache c: the key itself for
+        in-process caches, with the chunk's mtime added for persistent ones,
+        and digested for those with string keys. memo holds the keys worked
+        out so far for this lookup, so each is only computed once."""
+        persistent = getattr(c, "persistent", False)
+        digest = getattr(c, "digest_keys", False)
+        if not (persistent or digest):
+            return key
+        try:
+            return memo[persistent, digest]
+        except KeyError:
+            pass
+        k = key
+        if persistent:
+            k += (self.get_chunk_mtime(key[1], key[2]),)
+        if digest:
+            k = cache.digest_key(k)
+        memo[persistent, digest] = k
+        return k
+
+    def _get_cached(self, key):
+        """Looks up key in the caches in order, adding it to the caches
+        before the one that had it. Raises KeyError if none of them do"""
+        memo = {}
+        for i, c in enumerate(self.caches):
             try:
-                retval = cache[key]
-                # This did have it, no need to re-add it to this cache, just
-                # the ones before it
-                i -= 1
+                retval = c[self._get_tier_key(c, key, memo)]
                 break
             except KeyError:
                 pass
         else:
-            retval = super(CachedRegionSet, self).get_chunk(x,z)
+            raise KeyError(key)
+
+        # This did have it, no need to re-add it to this cache, just the
+        # ones before it
+        self._add_cached(key, retval, self.caches[:i], memo)
+        return retval
+
+    def _add_cached(self, key, value, caches=None, memo=None):
+        """Adds value to the given caches, all of them by default"""
+        if caches is None:
+            caches = self.caches
+        if memo is None:
+            memo = {}
+        for c in caches:
+            c[self._get_tier_key(c, key, memo)] = value
+
+    def get_chunk(self, x, z, fields=None):
+        key = self._get_cache_key(x, z, fields)
+        try:
+            return self._get_cached(key)
+        except KeyError:
+            pass
 
-        # Now add retval to all the caches that didn't have it, all the caches
-        # up to and including index i
-        for cache in self.caches[:i+1]:
-            cache[key] = retval
+        retval = super(CachedRegionSet, self).get_chunk(x,z, fields=fields)
+
+        # Now add retval to all the caches
+        self._add_cached(key, retval)
 
         return retval
+
+    def get_chunks(self, coords, fields=None):
+        chunks = {}
+        missing = []
+        for x, z in coords:
+            try:
+                chunks[(x,z)] = self._get_cached(self._get_cache_key(x, z, fields))
+            except KeyError:
+                missing.append((x,z))
+
+        if missing:
+            loaded = super(CachedRegionSet, self).get_chunks(missing, fields=fields)
+            for (x,z), retval in loaded.iteritems():
+                self._add_cached(self._get_cache_key(x, z, fields), retval)
+            chunks.update(loaded)
+
+        return chunks
         
 
 def get_save_dir():
@@ -8,10 +8,12 @@ sys.path.insert(0, os.path.join(os.getcwd(), os.pardir))
 
 # Import unit test cases or suites here
 from test_tileobj import TileTest
-from test_rendertileset import RendertileSetTest
+from test_rendertileset import RendertileSetTest, ArrayRendertileSetTest
 from test_settings import SettingsTest
-from test_tileset import TilesetTest
-from test_cache import TestLRU
+from test_tileset import TilesetTest, RenderContextTest
+from test_cache import TestLRU, TestSharedMemory, TestDiskCache
+from test_nbt import NBTTest
+from test_world import RegionSetTest
 
 # DISABLE THIS BLOCK TO GET LOG OUTPUT FROM TILESET FOR DEBUGGING
 if 0:
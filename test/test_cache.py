@@ -54,3 +54,181 @@ class TestLRU(unittest.TestCase):
         self.assertEquals(self.lru[4], 'asdf')
         self.assertEquals(self.lru[5], 'asdf')
         self.assertEquals(self.lru[6], 'asdf')
+
+    def test_byte_budget(self):
+        lru = cache.LRUCache(size=None, maxbytes=10, sizeof=len)
+        lru[1] = 'aaaa'
+        lru[2] = 'bbbb'
+        self.assertEquals(lru.bytes, 8)
+        self.assertEquals(lru[1], 'aaaa')
+
+        # 2 is the least recently used, and has to go to fit 3 in
+        lru[3] = 'cccc'
+        self.assertRaises(KeyError, lru.__getitem__, 2)
+        self.assertEquals(lru.bytes, 8)
+        self.assertEquals(lru.evictions, 1)
+
+        # replacing an item updates its size
+        lru[1] = 'a'
+        self.assertEquals(lru.bytes, 5)
+
+        # an item bigger than the whole budget still gets cached on its own
+        lru[4] = 'd' * 20
+        self.assertEquals(lru[4], 'd' * 20)
+        self.assertEquals(lru.bytes, 20)
+        self.assertEquals(len(lru.cache), 1)
+        self.assertEquals(lru.evictions, 3)
+
+    def test_estimate_size(self):
+        import numpy
+        value = {'a': numpy.zeros((16, 16), dtype=numpy.uint16),
+                'b': [{'c': "x" * 10}, 5], 'd': (None, "yy")}
+        self.assertEquals(cache.estimate_size(value), 512 + 10 + 2)
+
+    def test_pickle(self):
+        import cPickle
+        lru = cache.LRUCache(size=None, maxbytes=100, sizeof=len)
+        lru[1] = 'asdf'
+        lru2 = cPickle.loads(cPickle.dumps(lru, -1))
+        self.assertEquals((lru2.size, lru2.maxbytes, lru2.sizeof), (None, 100, len))
+        self.assertEquals(lru2.bytes, 0)
+        self.assertRaises(KeyError, lru2.__getitem__, 1)
+
+    def test_hit_rates(self):
+        lru = cache.LRUCache(size=5)
+        before = cache.get_counts().get('LRUCache', (0, 0))
+        lru[1] = 'asdf'
+        lru[1]
+        self.assertRaises(KeyError, lru.__getitem__, 2)
+        after = cache.get_counts()['LRUCache']
+        self.assertEquals((after[0] - before[0], after[1] - before[1]), (1, 1))
+
+class TestSharedMemory(unittest.TestCase):
+
+    def setUp(self):
+        self.shared = cache.SharedMemoryCache(4 * 4096, slotsize=4096)
+
+    def tearDown(self):
+        self.shared.close()
+
+    def test_roundtrip(self):
+        import numpy
+        blocks = numpy.arange(16 * 16 * 16, dtype=numpy.uint16).reshape((16, 16, 16))
+        value = {'Sections': [{'Y': 0, 'Blocks': blocks[:, :8, ::2]}],
+                'Biomes': numpy.ones((4, 4), dtype=numpy.uint8), 'Name': "abc"}
+        self.assertRaises(KeyError, self.shared.__getitem__, "a" * 32)
+        self.shared["a" * 32] = value
+
+        # another process maps the same file
+        import cPickle
+        other = cPickle.loads(cPickle.dumps(self.shared, -1))
+        got = other["a" * 32]
+        self.assertEquals(got['Name'], "abc")
+        self.assertEquals(got['Sections'][0]['Y'], 0)
+        self.assertTrue((got['Sections'][0]['Blocks'] == blocks[:, :8, ::2]).all())
+        self.assertTrue((got['Biomes'] == 1).all())
+        self.assertFalse(got['Biomes'].flags.writeable)
+        self.assertEquals((other.hits, other.misses), (1, 0))
+        other.close()
+
+    def test_full(self):
+        import numpy
+        # too big for a slot
+        self.shared["b" * 32] = numpy.zeros(8192, dtype=numpy.uint8)
+        self.assertRaises(KeyError, self.shared.__getitem__, "b" * 32)
+        # slots are never reused, so once every slot is taken nothing more
+        # is stored
+        for i in xrange(5):
+            self.shared["%032x" % i] = "x"
+        self.assertEquals(self.shared.stores, 4)
+        self.assertEquals(self.shared.full, 2)
+        self.assertEquals(self.shared["%032x" % 0], "x")
+        self.assertRaises(KeyError, self.shared.__getitem__, "%032x" % 4)
+
+    def test_file_unlinked(self):
+        import os
+        import os.path
+        import cPickle
+        # nothing is left behind, even if the process is killed
+        self.assertFalse(os.path.exists(self.shared.path))
+        self.shared["a" * 32] = "x"
+        data = cPickle.dumps(self.shared, -1)
+
+        # a forked worker still maps it
+        pid = os.fork()
+        if pid == 0:
+            try:
+                other = cPickle.loads(data)
+                other["b" * 32] = other["a" * 32] + "y"
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEquals(self.shared["b" * 32], "xy")
+
+        self.shared.close()
+        self.assertRaises(RuntimeError, cPickle.loads, data)
+
+    def test_dead_writer(self):
+        # a slot claimed by a writer that died before publishing it doesn't
+        # hold up its key
+        offset = next(self.shared._probe("c" * 32))
+        self.shared._entry.pack_into(self.shared.mmap, offset, "\x01" * 32, 0)
+        self.assertRaises(KeyError, self.shared.__getitem__, "c" * 32)
+        self.shared["c" * 32] = "z"
+        self.assertEquals(self.shared["c" * 32], "z")
+        self.assertEquals(self.shared._entry.unpack_from(self.shared.mmap, offset)[0], "\x01" * 32)
+
+class TestDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp(prefix="OVTEST")
+        self.disk = cache.DiskCache(self.tmpdir, 16 * 1024 * 1024)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def test_roundtrip(self):
+        import numpy
+        blocks = numpy.arange(16 * 16 * 16, dtype=numpy.uint16).reshape((16, 16, 16))
+        value = {'Sections': [{'Y': 3, 'Blocks': blocks[::-1]}], 'Name': u"abc"}
+        self.assertRaises(KeyError, self.disk.__getitem__, "a" * 32)
+        self.disk["a" * 32] = value
+
+        # a fresh cache on the same directory, as in a later run
+        import cPickle
+        disk = cPickle.loads(cPickle.dumps(self.disk, -1))
+        got = disk["a" * 32]
+        self.assertEquals(got['Name'], u"abc")
+        self.assertEquals(got['Sections'][0]['Y'], 3)
+        self.assertEquals(got['Sections'][0]['Blocks'].dtype, numpy.uint16)
+        self.assertTrue((got['Sections'][0]['Blocks'] == blocks[::-1]).all())
+        self.assertEquals((disk.hits, disk.misses), (1, 0))
+
+    def test_unreadable(self):
+        import os
+        self.disk["b" * 32] = "x"
+        path = self.disk._path("b" * 32)
+        with open(path, "wb") as f:
+            f.write("garbage")
+        self.assertRaises(KeyError, self.disk.__getitem__, "b" * 32)
+        self.assertFalse(os.path.exists(path))
+
+    def test_trim(self):
+        import numpy, os
+        data = numpy.zeros(10000, dtype=numpy.uint8)
+        for i in xrange(8):
+            self.disk["%032x" % i] = data
+            # make the order of use unambiguous
+            os.utime(self.disk._path("%032x" % i), (i, i))
+        # touching it on a hit makes it the most recently used
+        self.disk["%032x" % 0]
+        self.assertEquals(self.disk.evictions, 0)
+        self.disk.maxbytes = 64 * 1024
+        self.disk.trim()
+        self.assertEquals(self.disk.evictions, 2)
+        self.assertEquals(self.disk["%032x" % 0].shape, (10000,))
+        self.assertRaises(KeyError, self.disk.__getitem__, "%032x" % 1)
+        self.assertRaises(KeyError, self.disk.__getitem__, "%032x" % 2)
+        self.assertEquals(self.disk["%032x" % 3].shape, (10000,))
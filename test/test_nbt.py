@@ -0,0 +1,296 @@
+import unittest
+import tempfile
+import shutil
+import struct
+import zlib
+import os
+import os.path
+import StringIO
+
+import numpy
+
+from overviewer_core import nbt
+
+# Supporting resources
+######################
+
+def encode_string(s):
+    s = s.encode("UTF-8")
+    return struct.pack(">h", len(s)) + s
+
+def encode_payload(tagtype, value):
+    """A tiny NBT encoder, just enough to build test chunks. value is given
+    in the same form NBTFileReader returns it, with lists given as
+    (tagtype, [items]) and compounds as a list of (name, tagtype, value)
+
+    """
+    if tagtype == 1:
+        return struct.pack(">b", value)
+    elif tagtype == 2:
+        return struct.pack(">h", value)
+    elif tagtype == 3:
+        return struct.pack(">i", value)
+    elif tagtype == 4:
+        return struct.pack(">q", value)
+    elif tagtype == 5:
+        return struct.pack(">f", value)
+    elif tagtype == 6:
+        return struct.pack(">d", value)
+    elif tagtype == 7:
+        return struct.pack(">i", len(value)) + value
+    elif tagtype == 8:
+        return encode_string(value)
+    elif tagtype == 9:
+        itemtype, items = value
+        return struct.pack(">bi", itemtype, len(items)) + "".join(
+                encode_payload(itemtype, item) for item in items)
+    elif tagtype == 10:
+        return "".join(struct.pack(">b", t) + encode_string(name) +
+                encode_payload(t, v) for name, t, v in value) + "\x00"
+    elif tagtype == 11:
+        return struct.pack(">i%ii" % len(value), len(value), *value)
+    raise ValueError(tagtype)
+
+def make_section(y, seed, add=False):
+    rand = numpy.random.RandomState(seed)
+    def packed(size):
+        return rand.randint(0, 256, size).astype(numpy.uint8).tostring()
+    tags = [
+            ("Y", 1, y),
+            ("Blocks", 7, packed(4096)),
+            ("Data", 7, packed(2048)),
+            ("SkyLight", 7, packed(2048)),
+            ("BlockLight", 7, packed(2048)),
+            ]
+    if add:
+        tags.append(("Add", 7, packed(2048)))
+    return tags
+
+def make_chunk(x, z, biomes=True):
+    level = [
+            ("xPos", 3, x),
+            ("zPos", 3, z),
+            ("LastUpdate", 4, 1234567890123),
+            ("Sections", 9, (10, [make_section(0, 1), make_section(1, 2, add=True)])),
+            ("Entities", 9, (10, [[("id", 8, u"Pig"), ("Pos", 9, (6, [0.5, 64.0, -3.25]))]])),
+            ("TileEntities", 9, (0, [])),
+            ("HeightMap", 11, range(-5, 251)),
+            ("Weight", 5, 0.5),
+            ]
+    if biomes:
+        level.append(("Biomes", 7, "".join(chr(i % 23) for i in xrange(256))))
+    return "\x0a" + encode_string("") + encode_payload(10, [("Level", 10, level)])
+
+def write_region(path, chunks, compression=2):
+    """Writes a region file. chunks maps local (x, z) coords to a (timestamp,
+    uncompressed nbt data) tuple"""
+    locations = [0] * 1024
+    timestamps = [0] * 1024
+    body = ""
+    for (x, z), (timestamp, data) in sorted(chunks.iteritems()):
+        if compression == 2:
+            data = zlib.compress(data)
+        else:
+            c = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            data = c.compress(data) + c.flush()
+        data = struct.pack(">IB", len(data) + 1, compression) + data
+        data += "\x00" * (-len(data) % 4096)
+        offset = 2 + len(body) // 4096
+        locations[x + z * 32] = (offset << 8) | (len(data) // 4096)
+        timestamps[x + z * 32] = timestamp
+        body += data
+    with open(path, "wb") as f:
+        f.write(struct.pack(">1024I", *locations))
+        f.write(struct.pack(">1024i", *timestamps))
+        f.write(body)
+
+class NBTTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="OVTEST")
+        self.regionpath = os.path.join(self.tmpdir, "r.0.0.mca")
+        write_region(self.regionpath, {
+            (0, 0): (100, make_chunk(0, 0)),
+            (5, 3): (200, make_chunk(5, 3, biomes=False)),
+            })
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def without_c(self, func, *args, **kwargs):
+        old = nbt._c_read_nbt, nbt._c_decode_section
+        nbt._c_read_nbt = nbt._c_decode_section = None
+        try:
+            return func(*args, **kwargs)
+        finally:
+            nbt._c_read_nbt, nbt._c_decode_section = old
+
+    def load(self, x, z, use_c, **kwargs):
+        if not use_c:
+            return self.without_c(self.load, x, z, True, **kwargs)
+        region = nbt.load_region(self.regionpath)
+        try:
+            return region.load_chunk(x, z, **kwargs)
+        finally:
+            region.close()
+
+    def assertSameTree(self, a, b):
+        self.assertEquals(type(a), type(b))
+        if isinstance(a, dict):
+            self.assertEquals(sorted(a.keys()), sorted(b.keys()))
+            for key in a:
+                self.assertSameTree(a[key], b[key])
+        elif isinstance(a, (list, tuple)):
+            self.assertEquals(len(a), len(b))
+            for itema, itemb in zip(a, b):
+                self.assertSameTree(itema, itemb)
+        elif isinstance(a, numpy.ndarray):
+            self.assertEquals(a.dtype, b.dtype)
+            self.assertEquals(a.shape, b.shape)
+            self.assertTrue((a == b).all())
+        else:
+            self.assertEquals(a, b)
+
+    def test_c_extension_available(self):
+        self.assertTrue(nbt._c_read_nbt is not None)
+
+    def test_raw_parity(self):
+        for coords in [(0, 0), (5, 3)]:
+            self.assertSameTree(self.load(*coords, use_c=True),
+                    self.load(*coords, use_c=False))
+
+    def test_decoded_parity(self):
+        for coords in [(0, 0), (5, 3)]:
+            self.assertSameTree(self.load(*coords, use_c=True, decode_sections=True),
+                    self.load(*coords, use_c=False, decode_sections=True))
+
+    def test_decoded_arrays(self):
+        raw = self.load(0, 0, use_c=True)[1]['Level']
+        level = self.load(0, 0, use_c=True, decode_sections=True)[1]['Level']
+
+        self.assertEquals(level['Biomes'].shape, (16, 16))
+        self.assertEquals(level['Biomes'][1, 2], 18)
+
+        section = level['Sections'][1]
+        rawsection = raw['Sections'][1]
+        self.assertFalse("Add" in section)
+        self.assertEquals(section['Blocks'].dtype, numpy.uint16)
+        self.assertEquals(section['Blocks'].shape, (16, 16, 16))
+        # y=3, z=4, x=4 and 5 share one byte of the packed arrays
+        index = 3*256 + 4*16 + 4
+        add = ord(rawsection['Add'][index // 2])
+        self.assertEquals(section['Blocks'][3, 4, 4],
+                ord(rawsection['Blocks'][index]) + ((add & 0x0F) << 8))
+        self.assertEquals(section['Blocks'][3, 4, 5],
+                ord(rawsection['Blocks'][index + 1]) + ((add & 0xF0) << 4))
+        skylight = ord(rawsection['SkyLight'][index // 2])
+        self.assertEquals(section['SkyLight'][3, 4, 4], skylight & 0x0F)
+        self.assertEquals(section['SkyLight'][3, 4, 5], skylight >> 4)
+
+    def test_lazy_sections(self):
+        full = self.load(0, 0, use_c=True, decode_sections=True)[1]['Level']
+        raw = self.load(0, 0, use_c=True)[1]['Level']
+        for use_c in (True, False):
+            level = self.load(0, 0, use_c=use_c, decode_sections=True, lazy_sections=True)[1]['Level']
+            self.assertSameTree(level['Biomes'], full['Biomes'])
+            self.assertSameTree(level['Sections'], raw['Sections'])
+
+            for section in level['Sections']:
+                if use_c:
+                    self.assertTrue(nbt.decode_section(section) is section)
+                else:
+                    self.without_c(nbt.decode_section, section)
+            self.assertSameTree(level['Sections'], full['Sections'])
+            # decoding again is a no-op
+            nbt.decode_section(level['Sections'][1])
+            self.assertSameTree(level['Sections'], full['Sections'])
+
+    def test_corrupt_section(self):
+        # a failure leaves the whole section as it was, whichever array is bad
+        for bad in ('SkyLight', 'BlockLight', 'Data', 'Blocks'):
+            results = []
+            for use_c in (True, False):
+                section = {'Y': 0, 'Blocks': "\x00" * 4096, 'Data': "\x00" * 2048,
+                        'SkyLight': "\x00" * 2048, 'BlockLight': "\x00" * 2048}
+                section[bad] = "\x00" * 100
+                original = dict(section)
+                if use_c:
+                    self.assertRaises(nbt.CorruptChunkError, nbt.decode_section, section)
+                else:
+                    self.assertRaises(nbt.CorruptChunkError, self.without_c, nbt.decode_section, section)
+                self.assertEqual(section, original)
+                results.append(section)
+            self.assertEqual(results[0], results[1])
+
+    def test_missing_biomes(self):
+        level = self.load(5, 3, use_c=True, decode_sections=True)[1]['Level']
+        self.assertEquals(level['Biomes'].shape, (16, 16))
+        self.assertFalse(level['Biomes'].any())
+
+    def test_gzip_chunk(self):
+        write_region(self.regionpath, {(1, 1): (1, make_chunk(1, 1))}, compression=1)
+        self.assertSameTree(self.load(1, 1, use_c=True, decode_sections=True),
+                self.load(1, 1, use_c=False, decode_sections=True))
+
+    def test_truncated_chunk(self):
+        write_region(self.regionpath, {(1, 1): (1, make_chunk(1, 1)[:-20])})
+        for use_c in (True, False):
+            self.assertRaises(nbt.CorruptionError, self.load, 1, 1, use_c=use_c)
+
+    def test_fields_parity(self):
+        specs = [
+                {'Level': {'Sections': None, 'Biomes': None}},
+                {'Level': {'Entities': None, 'TileEntities': None}},
+                {'Level': None},
+                {},
+                ]
+        for fields in specs:
+            for coords in [(0, 0), (5, 3)]:
+                for decode in (True, False):
+                    self.assertSameTree(
+                            self.load(*coords, use_c=True, decode_sections=decode, fields=fields),
+                            self.load(*coords, use_c=False, decode_sections=decode, fields=fields))
+
+    def test_fields_skipped(self):
+        full = self.load(0, 0, use_c=True, decode_sections=True)[1]['Level']
+        fields = {'Level': {'Sections': None, 'Biomes': None}}
+        for use_c in (True, False):
+            level = self.load(0, 0, use_c=use_c, decode_sections=True, fields=fields)[1]['Level']
+            self.assertEquals(sorted(level.keys()), ['Biomes', 'Sections'])
+            self.assertSameTree(level['Sections'], full['Sections'])
+
+            level = self.load(5, 3, use_c=use_c, fields={'Level': {'Entities': None}})[1]['Level']
+            self.assertEquals(level.keys(), ['Entities'])
+            self.assertEquals(level['Entities'][0]['id'], u"Pig")
+
+    def test_unmapped_region(self):
+        # file-like objects without a fileno() are read into memory
+        with open(self.regionpath, "rb") as f:
+            region = nbt.MCRFileReader(StringIO.StringIO(f.read()))
+        self.assertSameTree(region.load_chunk(0, 0, decode_sections=True),
+                self.load(0, 0, use_c=True, decode_sections=True))
+        region.close()
+
+    def test_truncated_region(self):
+        with open(self.regionpath, "r+b") as f:
+            f.truncate(8192 + 100)
+        self.assertRaises(nbt.CorruptRegionError, self.load, 0, 0, use_c=True)
+        with open(self.regionpath, "r+b") as f:
+            f.truncate(0)
+        self.assertRaises(nbt.CorruptRegionError, self.load, 0, 0, use_c=True)
+
+    def test_region_truncated_after_mapping(self):
+        region = nbt.load_region(self.regionpath)
+        try:
+            with open(self.regionpath, "r+b") as f:
+                f.truncate(8192 + 100)
+            # reading the mapping past the new end would be a SIGBUS
+            for x, z in [(0, 0), (5, 3)]:
+                self.assertRaises(nbt.CorruptionError, region.load_chunk, x, z)
+        finally:
+            region.close()
+
+    def test_missing_chunk(self):
+        self.assertEquals(self.load(7, 7, use_c=True), None)
+
+if __name__ == "__main__":
+    unittest.main()
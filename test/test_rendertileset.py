@@ -2,10 +2,15 @@ import unittest
 
 from itertools import chain, izip
 
-from overviewer_core.tileset import iterate_base4, RendertileSet
+import os
+import tempfile
+
+from overviewer_core.tileset import iterate_base4, RendertileSet, ArrayRendertileSet
 from overviewer_core.util import roundrobin
 
 class RendertileSetTest(unittest.TestCase):
+    tileset_class = RendertileSet
+
     # If you change this definition, you must also change the hard-coded
     # results list in test_posttraverse()
     tile_paths = frozenset([
@@ -94,7 +99,7 @@ class RendertileSetTest(unittest.TestCase):
     tile_paths_posttraversal_robin = list(roundrobin(tile_paths_posttraversal_lists)) + [()]
 
     def setUp(self):
-        self.tree = RendertileSet(3)
+        self.tree = self.tileset_class(3)
         for t in self.tile_paths:
             self.tree.add(t)
 
@@ -139,7 +144,7 @@ class RendertileSetTest(unittest.TestCase):
         self.assertRaises(AssertionError, self.test_iterate)
 
         # If something was supposed to be returned but wasn't
-        tree = RendertileSet(3)
+        tree = self.tileset_class(3)
         c = len(self.tile_paths) // 2
         for t in self.tile_paths:
             tree.add(t)
@@ -155,7 +160,7 @@ class RendertileSetTest(unittest.TestCase):
     def test_bool(self):
         "Tests the boolean status of a node"
         self.assertTrue(self.tree)
-        t = RendertileSet(3)
+        t = self.tileset_class(3)
         self.assertFalse(t)
         t.add((0,0,0))
         self.assertTrue(t)
@@ -223,5 +228,55 @@ class RendertileSetTest(unittest.TestCase):
         c = self.tree.count_all()
         self.assertEqual(c, 35)
 
+class ArrayRendertileSetTest(RendertileSetTest):
+    tileset_class = ArrayRendertileSet
+
+    def test_add_paths(self):
+        tree = ArrayRendertileSet(3)
+        tree.add_paths(sorted(self.tile_paths, reverse=True))
+        tree.add((0,0,0))
+        self.assertEquals(list(tree.posttraversal()), self.tile_paths_posttraversal)
+
+    def test_save_load(self):
+        fd, filename = tempfile.mkstemp(prefix="OVTEST")
+        os.close(fd)
+        try:
+            self.tree.save(filename)
+            tree = ArrayRendertileSet.load(filename)
+            self.assertEquals(tree.depth, 3)
+            self.assertEquals(list(tree.posttraversal()), self.tile_paths_posttraversal)
+
+            with open(filename, "r+b") as f:
+                f.truncate(20)
+            self.assertRaises(ValueError, ArrayRendertileSet.load, filename)
+        finally:
+            os.remove(filename)
+
+    def test_posttraverse_hilbert(self):
+        """Tests that a Hilbert curve post-traversal moves between adjacent
+        render-tiles, and still puts each upper-tile after its children"""
+        tree = ArrayRendertileSet(4)
+        tree.add_paths(list(iterate_base4(4)))
+        paths = list(tree.posttraversal(hilbert=True))
+        self.assertEqual(len(paths), tree.count_all())
+        for i, path in enumerate(paths):
+            if path:
+                self.assertTrue(paths.index(path[:-1]) > i)
+
+        def position(path):
+            x = y = 0
+            for p in path:
+                x, y = x*2 + p % 2, y*2 + p // 2
+            return x, y
+        rendertiles = [position(p) for p in paths if len(p) == 4]
+        self.assertEqual(len(set(rendertiles)), 4**4)
+        for (x1, y1), (x2, y2) in izip(rendertiles, rendertiles[1:]):
+            self.assertEqual(abs(x1 - x2) + abs(y1 - y2), 1)
+
+        # only the tiles in the set
+        paths = list(self.tree.posttraversal(hilbert=True))
+        self.assertEqual(sorted(paths), sorted(self.tile_paths_posttraversal))
+        self.assertEqual(paths[:5], [(0,0,0), (0,0,2), (0,0,3), (0,0,1), (0,0)])
+
 if __name__ == "__main__":
     unittest.main()
@@ -5,8 +5,17 @@ from collections import defaultdict
 import os
 import os.path
 import random
+import cPickle
+
+from PIL import Image
+
+import numpy
 
 from overviewer_core import tileset
+from overviewer_core import rendermodes
+from overviewer_core import textures
+from overviewer_core import world
+from overviewer_core import c_overviewer
 
 # Supporing data
 # chunks list: chunkx, chunkz mapping to chunkmtime
@@ -46,25 +55,42 @@ class FakeRegionset(object):
     def __init__(self, chunks):
         self.chunks = dict(chunks)
 
-    def get_chunk(self, x,z):
+    def get_chunk(self, x,z, fields=None):
+        return NotImplementedError()
+
+    def get_chunks(self, coords, fields=None):
         return NotImplementedError()
 
     def iterate_chunks(self):
         for (x,z),mtime in self.chunks.iteritems():
             yield x,z,mtime
 
+    def chunk_table(self):
+        table = numpy.array([(x, z, mtime) for (x, z), mtime in self.chunks.iteritems()],
+                dtype=numpy.int32).reshape((-1, 3))
+        return table[:, 0], table[:, 1], table[:, 2]
+
     def get_chunk_mtime(self, x, z):
         try:
             return self.chunks[x,z]
         except KeyError:
             return None
 
+    def get_section_mask(self, x, z, fields=None):
+        # every chunk has blocks in its bottom five sections
+        if (x, z) in self.chunks:
+            return 0b11111
+        return 0
+
 class FakeAssetmanager(object):
-    def __init__(self, lastrendertime):
+    def __init__(self, lastrendertime, **config):
         self.lrm = lastrendertime
+        self.config = config
 
     def get_tileset_config(self, _):
-        return {'lastrendertime': self.lrm}
+        config = {'lastrendertime': self.lrm}
+        config.update(self.config)
+        return config
 
 def get_tile_set(chunks):
     """Given the dictionary mapping chunk coordinates their mtimes, returns a
@@ -128,7 +154,7 @@ class TilesetTest(unittest.TestCase):
         self.tempdirs.append(d)
         return d
 
-    def get_tileset(self, options, outputdir, preprocess=None):
+    def get_tileset(self, options, outputdir, preprocess=None, config={}):
         """Returns a newly created TileSet object and return it.
         A set of default options are provided. Any options passed in will
         override the defaults. The output directory is passed in and it is
@@ -146,7 +172,7 @@ class TilesetTest(unittest.TestCase):
                 'rerenderprob': 0
                 }
         defoptions.update(options)
-        ts = tileset.TileSet(None, self.rs, FakeAssetmanager(0), None, defoptions, outputdir)
+        ts = tileset.TileSet(None, self.rs, FakeAssetmanager(0, **config), None, defoptions, outputdir)
         if preprocess:
             preprocess(ts)
         ts.do_preprocessing()
@@ -174,6 +200,46 @@ class TilesetTest(unittest.TestCase):
         for tilepath in expected.iterkeys():
             self.assertTrue(tilepath in paths, "%s was expected to be returned but wasn't: %s" % (tilepath, paths))
 
+    def test_pickle_keeps_map_size(self):
+        """Tests that unpickling a tileset, as the worker processes do, doesn't
+        scan the world again
+
+        """
+        ts = self.get_tileset({'renderchecks': 2}, self.get_outputdir())
+        data = cPickle.dumps(ts, -1)
+        def fail():
+            raise AssertionError("the chunk range was scanned again")
+        oldfind = tileset.TileSet._find_chunk_range
+        tileset.TileSet._find_chunk_range = fail
+        try:
+            ts2 = cPickle.loads(data)
+        finally:
+            tileset.TileSet._find_chunk_range = oldfind
+        self.assertEqual((ts2.treedepth, ts2.xradius, ts2.yradius),
+                (ts.treedepth, ts.xradius, ts.yradius))
+
+    def test_bulk_tile_mapping(self):
+        """Tests that the array versions of get_tiles_by_chunk() and
+        compute_path() agree with the originals"""
+        cols = numpy.array([self.r.randint(-200, 200) for _ in xrange(300)])
+        rows = numpy.array([self.r.randint(-200, 200) for _ in xrange(300)])
+        tilecols, tilerows = tileset.get_tiles_by_chunks(cols, rows)
+        expected = set()
+        for col, row in zip(cols, rows):
+            expected.update(tileset.get_tiles_by_chunk(col, row))
+        got = zip(tilecols.tolist(), tilerows.tolist())
+        self.assertEquals(len(got), sum(len(list(tileset.get_tiles_by_chunk(c, r)))
+                for c, r in zip(cols, rows)))
+        self.assertEquals(set(got), expected)
+
+        depth = 9
+        tiles = sorted(t for t in expected
+                if -2**depth <= t[0] < 2**depth and -2*2**depth <= t[1] < 2*2**depth)
+        paths = tileset.RenderTile.compute_paths(
+                [c for c, r in tiles], [r for c, r in tiles], depth)
+        for (col, row), path in zip(tiles, paths.tolist()):
+            self.assertEquals(tuple(path), tileset.RenderTile.compute_path(col, row, depth).path)
+
     def test_get_phase_length(self):
         ts = self.get_tileset({'renderchecks': 2}, self.get_outputdir())
         self.assertEqual(ts.get_num_phases(), 1)
@@ -271,3 +337,457 @@ class TilesetTest(unittest.TestCase):
 
         for tilepath in expected:
             self.assertTrue(tilepath in paths, "%s was expected to be returned but wasn't: %s" % (tilepath, paths))
+
+    def interrupt_render(self, outputdir, count):
+        """Starts a full render and records the first count work items as
+        done, as if it was interrupted. Returns the items done."""
+        ts = self.get_tileset({'renderchecks': 2}, outputdir)
+        done = []
+        for tilepath, _ in ts.iterate_work_items(0):
+            if len(done) == count:
+                break
+            ts.work_done(tilepath)
+            done.append(tilepath)
+        ts.journal._f.close()
+        return done
+
+    def test_resume_render(self):
+        """Tests that a render interrupted partway is picked up from its
+        journal without rendering the finished tiles again"""
+        outputdir = self.get_outputdir()
+        done = self.interrupt_render(outputdir, 20)
+
+        ts = self.get_tileset({}, outputdir, config={'render_in_progress': True})
+        self.assertTrue(ts.resuming)
+        self.assertEqual(ts.options['renderchecks'], 0)
+        expected = set(get_tile_set(chunks)) - set(done)
+        self.assertEqual(ts.get_phase_length(0), len(expected))
+        paths = [x[0] for x in ts.iterate_work_items(0)]
+        self.assertEqual(set(paths), expected)
+
+        # finishing the render removes the journal
+        for tilepath in paths:
+            ts.work_done(tilepath)
+        self.assertFalse(ts.journal.exists())
+
+    def test_resume_changed_chunk(self):
+        """Tests that tiles finished by an interrupted render are done again
+        if their chunks changed since"""
+        outputdir = self.get_outputdir()
+        done = self.interrupt_render(outputdir, 20)
+
+        tile = tileset.RenderTile.compute_path(0, 0, 5)
+        self.rs.chunks[0, 0] = 2**31 - 1
+        ts = self.get_tileset({}, outputdir, config={'render_in_progress': True})
+        paths = set(x[0] for x in ts.iterate_work_items(0))
+        self.assertTrue(tile.path in done)
+        self.assertTrue(tile.path in paths)
+        self.assertEqual(paths, set(get_tile_set(chunks)) - set(done) |
+                set(get_tile_set({(0, 0): 1})))
+
+    def test_resume_bad_journal(self):
+        """Tests that an unreadable journal falls back to checking tiles"""
+        outputdir = self.get_outputdir()
+        self.interrupt_render(outputdir, 5)
+        with open(os.path.join(outputdir, "render_journal.dat"), "wb") as f:
+            f.write("garbage")
+        ts = self.get_tileset({}, outputdir, config={'render_in_progress': True})
+        self.assertFalse(ts.resuming)
+        self.assertEqual(ts.options['renderchecks'], 1)
+
+    def test_manifest(self):
+        """Tests recording, forgetting, and reopening tile manifest entries"""
+        filename = os.path.join(self.get_outputdir(), "tile_manifest.dat")
+        manifest = tileset.TileManifest(filename)
+        self.assertFalse(manifest.open(3))
+        self.assertTrue(manifest.open(3, create=True))
+        self.assertEqual(manifest.get((1, 2, 3)), None)
+        manifest.set((1, 2, 3), 10, 2**64 - 1)
+        manifest.set((1, 2), 10, 5)
+        manifest.set((1, 3), 11, 6)
+        manifest.set((), 11, 7)
+        self.assertEqual(manifest.get((1, 2, 3)), (10, 2**64 - 1))
+        manifest.close()
+
+        manifest = tileset.TileManifest(filename)
+        self.assertTrue(manifest.open(3))
+        self.assertEqual(manifest.get((1, 2)), (10, 5))
+        manifest.clear((1, 2))
+        self.assertEqual(manifest.get((1, 2)), None)
+        self.assertEqual(manifest.get((1, 2, 3)), None)
+        # the parent of a removed tile needs to know
+        self.assertTrue(manifest.is_changed((1, 2)))
+        manifest.clear_changed((1, 2))
+        self.assertFalse(manifest.is_changed((1, 2)))
+        manifest.clear((0, 0))
+        self.assertFalse(manifest.is_changed((0, 0)))
+        self.assertEqual(manifest.get((1, 3)), (11, 6))
+        self.assertEqual(manifest.get(()), (11, 7))
+        manifest.close()
+
+        # a manifest for another depth is thrown out
+        self.assertFalse(manifest.open(4))
+        self.assertTrue(manifest.open(4, create=True))
+        self.assertEqual(manifest.get(()), None)
+
+    def test_manifest_pack(self):
+        """Tests that a finished render's manifest is packed down to the
+        entries in use, and unpacked for the next render"""
+        filename = os.path.join(self.get_outputdir(), "tile_manifest.dat")
+        manifest = tileset.TileManifest(filename)
+        manifest.pack_batch = 64
+        self.assertTrue(manifest.open(5, create=True))
+        manifest.set((1, 2, 3, 0, 1), 10, 2**64 - 1)
+        manifest.set((3, 3, 3, 3, 3), 12, 8, changed=False)
+        manifest.set((1, 2), 11, 5)
+        manifest.set((), 11, 7)
+        manifest.set((2,), 9, 1)
+        manifest.clear((2,))
+        manifest.pack()
+        self.assertFalse(os.path.exists(manifest.tablefilename))
+        self.assertTrue(os.path.getsize(filename) < 200)
+        manifest.pack()
+
+        # workers only use a table that's already there
+        manifest = tileset.TileManifest(filename)
+        self.assertFalse(manifest.open(5))
+        self.assertTrue(manifest.open(5, create=True))
+        self.assertEqual(manifest.get((1, 2, 3, 0, 1)), (10, 2**64 - 1))
+        self.assertEqual(manifest.get((3, 3, 3, 3, 3)), (12, 8))
+        self.assertFalse(manifest.is_changed((3, 3, 3, 3, 3)))
+        self.assertEqual(manifest.get((1, 2)), (11, 5))
+        self.assertTrue(manifest.is_changed((1, 2)))
+        self.assertEqual(manifest.get((2,)), None)
+        self.assertTrue(manifest.is_changed((2,)))
+        self.assertEqual(manifest.get((1, 2, 3)), None)
+        self.assertEqual(numpy.count_nonzero(manifest.entries["flags"]), 5)
+        manifest.close()
+
+        # a packed manifest for another depth is thrown out
+        os.remove(manifest.tablefilename)
+        self.assertTrue(manifest.open(4, create=True))
+        self.assertEqual(manifest.get(()), None)
+
+    def test_rendercheckmode_1_manifest(self):
+        """Tests that check-tiles mode goes by the manifest for tiles it
+        knows about, instead of the tiles' mtimes"""
+        outputdir = self.get_outputdir()
+        all_tiles = get_tile_set(self.rs.chunks)
+        # every tile on disk looks out of date
+        create_fakedir(outputdir, dict((x, 3) for x in all_tiles))
+
+        ts = self.get_tileset({'renderchecks': 1}, outputdir)
+        for tilepath, mtime in all_tiles.iteritems():
+            if tilepath not in ((0,3,3,3,3), (2,1,1)):
+                ts.manifest.set(tilepath, mtime, 0)
+
+        paths = set(x[0] for x in ts.iterate_work_items(0))
+        self.assertEqual(paths, set([(0,3,3,3,3), (0,3,3,3), (0,3,3), (0,3), (0,),
+            (2,1,1), (2,1), (2,), ()]))
+
+    def test_unchanged_composite(self):
+        """Tests that composite-tiles are only remade and rewritten when
+        their children's pixels changed"""
+        outputdir = self.get_outputdir()
+        ts = self.get_tileset({'renderchecks': 0}, outputdir)
+        os.mkdir(os.path.join(outputdir, "0"))
+        imgpath = os.path.join(outputdir, "0.png")
+        def write_child(childnum, color):
+            Image.new("RGBA", (384, 384), color).save(
+                    os.path.join(outputdir, "0", "%s.png" % childnum))
+        def render():
+            if os.path.exists(imgpath):
+                os.utime(imgpath, (1, 1))
+            ts._render_compositetile(outputdir, "0", (0,))
+            return os.stat(imgpath).st_mtime != 1
+        for childnum in xrange(4):
+            write_child(childnum, "red")
+
+        # children the manifest doesn't know about might have changed
+        self.assertTrue(render())
+        self.assertTrue(ts.manifest.is_changed((0,)))
+        for childnum in xrange(4):
+            ts.manifest.set((0, childnum), 5, 0, changed=False)
+        ts.manifest.clear_changed((0,))
+
+        # nothing changed
+        self.assertFalse(render())
+        self.assertEqual(ts.manifest.get((0,))[0], 5)
+
+        # a child changed, but looks the same
+        ts.manifest.set((0, 1), 6, 0)
+        self.assertFalse(render())
+        self.assertFalse(ts.manifest.is_changed((0, 1)))
+        self.assertFalse(ts.manifest.is_changed((0,)))
+        self.assertEqual(ts.manifest.get((0,))[0], 6)
+
+        # a child really changed
+        write_child(2, "blue")
+        ts.manifest.set((0, 2), 7, 1)
+        self.assertTrue(render())
+        self.assertFalse(ts.manifest.is_changed((0, 2)))
+        self.assertTrue(ts.manifest.is_changed((0,)))
+        self.assertEqual(ts.manifest.get((0,))[0], 7)
+
+    def test_subtree_iterate(self):
+        """Tests that with subtreelevels set, the work items cover the same
+        tiles, with the bottom levels grouped into subtrees"""
+        ts = self.get_tileset({'renderchecks': 2, 'subtreelevels': 2}, self.get_outputdir())
+        items = [x[0] for x in ts.iterate_work_items(0)]
+        self.assertEqual(ts.get_phase_length(0), len(items))
+
+        paths = []
+        for item in items:
+            if isinstance(item, tileset.SubtreeWork):
+                self.assertEqual(len(item), ts.treedepth - 2)
+                subpaths = list(item.posttraversal(ts.treedepth))
+                self.assertEqual(subpaths[-1], item)
+                paths.extend(subpaths)
+                # survives the trip to a worker process
+                self.assertEqual(list(cPickle.loads(cPickle.dumps(item, -1))
+                        .posttraversal(ts.treedepth)), subpaths)
+            else:
+                self.assertTrue(len(item) < ts.treedepth - 2)
+                paths.append(item)
+        self.assertEqual(len(paths), len(set(paths)))
+        self.assertEqual(set(paths), set(get_tile_set(chunks)))
+        # children always come before their parents
+        for i, path in enumerate(paths):
+            if path:
+                self.assertTrue(paths.index(path[:-1]) > i)
+
+    def test_subtree_render(self):
+        """Tests that a subtree's composite-tiles are made from the images
+        of the tiles just rendered, without reading them back"""
+        outputdir = self.get_outputdir()
+        ts = self.get_tileset({'renderchecks': 2, 'subtreelevels': 1}, outputdir)
+        rendered = []
+        def render(tile):
+            rendered.append(tile.path)
+            ts.manifest.set(tile.path, 5, len(rendered))
+            dirpath = os.path.dirname(tile.get_filepath(outputdir, "png"))
+            if not os.path.exists(dirpath):
+                os.makedirs(dirpath)
+            return Image.new("RGBA", (384, 384), "blue")
+        ts._render_rendertile = render
+
+        item = [x[0] for x in ts.iterate_work_items(0)
+                if isinstance(x[0], tileset.SubtreeWork)][0]
+        ts.do_work(item)
+        self.assertEqual(len(rendered), len(item.tiles))
+        self.assertEqual(set(rendered), set(p for p in item.posttraversal(ts.treedepth)
+                if len(p) == ts.treedepth))
+        # none of the render-tiles were written, so the composite must have
+        # come from memory
+        imgpath = os.path.join(outputdir, *(str(x) for x in item)) + ".png"
+        img = Image.open(imgpath)
+        colors = set(color for count, color in img.convert("RGBA").getcolors())
+        self.assertTrue((0, 0, 255, 255) in colors)
+
+    def test_prefetch(self):
+        """Tests that prefetch() loads the chunks of render-tiles, and of the
+        first render-tiles of a subtree"""
+        ts = self.get_tileset({'renderchecks': 2, 'subtreelevels': 1}, self.get_outputdir())
+        fetched = []
+        ts.regionset.get_chunks = lambda coords, fields=None: fetched.append(set(coords))
+
+        item = [x[0] for x in ts.iterate_work_items(0)
+                if isinstance(x[0], tileset.SubtreeWork)][0]
+        ts.prefetch(item)
+        self.assertEqual(len(fetched), 1)
+        first = [p for p in item.posttraversal(ts.treedepth)
+                if len(p) == ts.treedepth][:ts.prefetch_subtree_tiles]
+        expected = set()
+        for path in first:
+            expected.update((c[2], c[4]) for c in tileset.get_chunks_by_tile(
+                tileset.RenderTile.from_path(path), ts.regionset))
+        self.assertTrue(expected)
+        self.assertEqual(fetched[0], expected)
+
+        del fetched[:]
+        ts.prefetch(first[0])
+        self.assertTrue(fetched[0] and fetched[0] <= expected)
+        # composite-tiles need no chunks
+        del fetched[:]
+        ts.prefetch(first[0][:-2])
+        self.assertEqual(fetched, [])
+
+    def test_section_sprites(self):
+        """Tests that a chunk section is drawn once and pasted into each tile
+        it's in"""
+        ts = self.get_tileset({'renderchecks': 2, 'spritecache_mb': 1,
+            'rendermode': [rendermodes.Base()]}, self.get_outputdir())
+        # render_loop() is replaced below, and doesn't need a real rendermode
+        ts.render_context = object()
+        calls = []
+        def render_loop(world, regionset, x, y, z, img, xoff, yoff, mode, textures):
+            calls.append((x, y, z))
+            if y == 0:
+                img.paste((255, 0, 0, 255), (xoff + 10, yoff + 20, xoff + 15, yoff + 22))
+        old = tileset.c_overviewer.render_loop
+        tileset.c_overviewer.render_loop = render_loop
+        try:
+            for xpos, ypos in ((0, 0), (100, 50)):
+                img = Image.new("RGBA", (384, 384), (0, 0, 0, 255))
+                for y in (0, 1):
+                    ts._draw_section_sprite(img, 1, y, 2, xpos, ypos, {})
+                self.assertEqual(img.getpixel((xpos + 10, ypos + 20)), (255, 0, 0, 255))
+                self.assertEqual(img.getpixel((xpos + 15, ypos + 20)), (0, 0, 0, 255))
+        finally:
+            tileset.c_overviewer.render_loop = old
+        self.assertEqual(calls, [(1, 0, 2), (1, 1, 2)])
+
+        # the sprites are redrawn if a neighbouring chunk changes
+        self.rs.chunks[2, 2] = 6
+        tileset.c_overviewer.render_loop = render_loop
+        try:
+            ts._draw_section_sprite(img, 1, 0, 2, 0, 0, {})
+        finally:
+            tileset.c_overviewer.render_loop = old
+        self.assertEqual(len(calls), 3)
+
+        sprites = cPickle.loads(cPickle.dumps(ts.sprites, -1))
+        self.assertEqual((sprites.maxbytes, len(sprites.cache)), (1024 * 1024, 0))
+
+    def test_present_sections(self):
+        """Tests that get_chunks_by_tile() leaves out sections that don't
+        exist if asked to"""
+        tile = tileset.RenderTile.compute_path(0, 28, 5)
+        everything = list(tileset.get_chunks_by_tile(tile, self.rs))
+        present = list(tileset.get_chunks_by_tile(tile, self.rs, present_only=True))
+        self.assertTrue(present)
+        self.assertEqual(present, [c for c in everything if c[3] < 5])
+
+    def test_sprites_match_direct(self):
+        """Tests that drawing through the sprite cache gives the same pixels
+        as drawing straight onto the tile, with water over stone"""
+        mode = [rendermodes.Base(), rendermodes.Lighting()]
+        ts = self.get_tileset({'renderchecks': 2, 'spritecache_mb': 1,
+            'rendermode': mode}, self.get_outputdir())
+        ts.regionset = WaterRegionset()
+        ts.textures = FakeTextures()
+        summary = tileset.get_section_summary(ts.regionset.get_chunk(0, 0))
+        # the stone can be a sprite, the water can't
+        self.assertEqual(summary[3], 0b01)
+
+        def draw(sprites, summary):
+            ts.sprites = sprites
+            img = Image.new("RGBA", (384, 384), (40, 200, 40, 255))
+            for y in (0, 1):
+                ts._draw_section(img, 0, y, 0, 0, 0, {}, {(0, 0): summary})
+            return img.tobytes()
+
+        direct = draw(None, summary)
+        sprites = tileset.SpriteCache(1024 * 1024)
+        self.assertEqual(draw(sprites, summary), direct)
+        self.assertEqual(len(sprites.cache), 1)
+        # the water tints the stone behind it, which it couldn't do if the
+        # stone were pasted in after
+        everything = summary[:3] + (0b11,)
+        self.assertNotEqual(draw(tileset.SpriteCache(1024 * 1024), everything), direct)
+
+        # primitives that draw outside of the opaque blocks don't use sprites
+        ts = self.get_tileset({'renderchecks': 2, 'spritecache_mb': 1,
+            'rendermode': [rendermodes.Base(), rendermodes.EdgeLines()]}, self.get_outputdir())
+        self.assertEqual(ts.sprites, None)
+
+    def test_section_summary(self):
+        def section(y, blockid, extra=None):
+            blocks = numpy.empty((16, 16, 16), dtype=numpy.uint16)
+            blocks.fill(blockid)
+            if extra is not None:
+                blocks[3, 4, 5] = extra
+            return {'Y': y, 'Blocks': blocks}
+        # stone, stone with tall grass, air, glass
+        chunk = {'Sections': [section(0, 1), section(1, 1, 31),
+                section(2, 0), section(3, 20)]}
+        self.assertEqual(tileset.get_section_summary(chunk), (1, 2, 3, 1))
+        self.assertEqual(tileset.get_section_summary({'Sections': []}), (0, 0, -1, 0))
+
+    def test_hidden_sections(self):
+        """Tests that a chunk section is skipped if it's empty, or covered by
+        an opaque section in front of it"""
+        ts = self.get_tileset({'renderchecks': 2}, self.get_outputdir())
+        summaries = {(1, 1): (0, 0b100, 5, 0), (0, 2): (0b1110, 0, 3, 0b1110)}
+        ts.section_culling = True
+        hidden = [y for y in xrange(16) if ts._is_section_hidden(summaries, 1, y, 1)]
+        # sections 0 and 1 are covered, 2 has tall grass that could show
+        self.assertEqual(hidden, [0, 1] + range(6, 16))
+        # chunks that couldn't be loaded are left to render_loop()
+        self.assertFalse(ts._is_section_hidden(summaries, 5, 0, 5))
+
+        ts.section_culling = False
+        hidden = [y for y in xrange(16) if ts._is_section_hidden(summaries, 1, y, 1)]
+        self.assertEqual(hidden, range(6, 16))
+
+class FakeTextures(object):
+    """Just enough of a Textures object for render_loop(), with textures for
+    stone and half see-through water only"""
+    def __init__(self):
+        block = Image.new("RGBA", (24, 24), (255, 0, 0, 255))
+        water = Image.new("RGBA", (24, 24), (0, 0, 255, 128))
+        self.blockmap = [None] * (textures.max_blockid * textures.max_data)
+        self.blockmap[1 * textures.max_data] = (block, block)
+        self.blockmap[9 * textures.max_data] = (water, water)
+        self.biome_grass_texture = block
+
+    def load_color(self):
+        return [(100, 150, 250)] * (256 * 256)
+    load_grass_color = load_foliage_color = load_water_color = load_color
+
+class StoneRegionset(object):
+    """A regionset with one section of stone, at chunk 0,0, with holes in it
+    so that some blocks behind others show"""
+    def get_chunk(self, x, z, fields=None):
+        if (x, z) != (0, 0):
+            raise world.ChunkDoesntExist("no chunk here")
+        blocks = numpy.ones((16, 16, 16), dtype=numpy.uint16)
+        blocks[::3, ::2, 5:] = 0
+        empty = numpy.zeros((16, 16, 16), dtype=numpy.uint8)
+        return {'Biomes': numpy.zeros((16, 16), dtype=numpy.uint8),
+                'Sections': [{'Y': 0, 'Blocks': blocks, 'Data': empty,
+                    'SkyLight': empty, 'BlockLight': empty}]}
+
+class WaterRegionset(StoneRegionset):
+    """StoneRegionset, with a section of water on top of the stone"""
+    def get_chunk(self, x, z, fields=None):
+        chunk = super(WaterRegionset, self).get_chunk(x, z, fields)
+        blocks = numpy.empty((16, 16, 16), dtype=numpy.uint16)
+        blocks.fill(9)
+        empty = numpy.zeros((16, 16, 16), dtype=numpy.uint8)
+        chunk['Sections'].append({'Y': 1, 'Blocks': blocks, 'Data': empty,
+            'SkyLight': empty, 'BlockLight': empty})
+        return chunk
+
+    def get_chunk_mtime(self, x, z):
+        if (x, z) == (0, 0):
+            return 1
+        return None
+
+class RenderContextTest(unittest.TestCase):
+    def render(self, mode, tex, y=0):
+        # edge lines only darken what's under them
+        img = Image.new("RGBA", (384, 384), (255, 255, 255, 255))
+        c_overviewer.render_loop(None, StoneRegionset(), 0, y, 0, img, 0, 0,
+                mode, tex)
+        return img
+
+    def test_same_as_mode(self):
+        """Tests that a render context draws exactly what the list of
+        primitives it was made from does, call after call"""
+        tex = FakeTextures()
+        mode = [rendermodes.EdgeLines(opacity=0.5)]
+        expected = self.render(mode, tex)
+        self.assertTrue(len(expected.getcolors()) > 1)
+        context = c_overviewer.RenderContext(None, mode, tex)
+        for i in xrange(3):
+            self.assertEqual(self.render(context, tex).tobytes(), expected.tobytes())
+        # sections that don't exist are skipped as before
+        self.assertEqual(len(self.render(context, tex, y=1).getcolors()), 1)
+
+    def test_errors(self):
+        tex = FakeTextures()
+        self.assertRaises(TypeError, c_overviewer.RenderContext, None,
+                [rendermodes.EdgeLines(opacity="dark")], tex)
+        tex.blockmap = None
+        self.assertRaises(RuntimeError, c_overviewer.RenderContext, None, [], tex)
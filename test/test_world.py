@@ -1,8 +1,17 @@
 import unittest
 
 import os
+import tempfile
+import shutil
+import cPickle
+
+import numpy
 
 from overviewer_core import world
+from overviewer_core import cache
+from overviewer_core import nbt
+
+from test_nbt import make_chunk, write_region
 
 class ExampleWorldTest(unittest.TestCase):
     @classmethod
@@ -31,8 +40,244 @@ class ExampleWorldTest(unittest.TestCase):
         self.assertEquals(regionset.get_chunk_mtime(5,0), 1316728905)
         self.assertEquals(regionset.get_chunk_mtime(-22,16), 1316786786)
 
-        
-         
+
+class RegionSetTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="OVTEST")
+        regiondir = os.path.join(self.tmpdir, "region")
+        os.mkdir(regiondir)
+        # written out of coordinate order, so offset order differs
+        write_region(os.path.join(regiondir, "r.0.0.mca"), {
+            (5, 3): (200, make_chunk(5, 3)),
+            (0, 0): (100, make_chunk(0, 0)),
+            (1, 0): (100, make_chunk(1, 0)),
+            })
+        self.regionset = world.RegionSet(regiondir, "region")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_chunks(self):
+        chunks = self.regionset.get_chunks([(5, 3), (0, 0), (7, 7), (40, 40)])
+        self.assertEquals(sorted(chunks.keys()), [(0, 0), (5, 3)])
+        self.assertEquals(chunks[(5, 3)]['xPos'], 5)
+
+        chunks = self.regionset.get_chunks([(1, 0)], fields=('Sections',))
+        self.assertEquals(chunks[(1, 0)].keys(), ['Sections'])
+
+    def test_get_chunks_rotated(self):
+        rset = world.RotatedRegionSet(self.regionset, world.UPPER_RIGHT)
+        coords = [rset.rotate(5, 3), rset.rotate(1, 0)]
+        chunks = rset.get_chunks(coords)
+        self.assertEquals(sorted(chunks.keys()), sorted(coords))
+        for coord in coords:
+            single = rset.get_chunk(*coord)
+            self.assertTrue((chunks[coord]['Biomes'] == single['Biomes']).all())
+            self.assertTrue((chunks[coord]['Sections'][1]['Blocks'] ==
+                single['Sections'][1]['Blocks']).all())
+
+    def test_get_chunks_cached(self):
+        lru = cache.LRUCache(size=10)
+        rset = world.CachedRegionSet(self.regionset, [lru])
+        chunks = rset.get_chunks([(0, 0), (1, 0), (7, 7)], fields=('Sections', 'Biomes'))
+        self.assertEquals(lru.misses, 3)
+        self.assertEquals(sorted(chunks.keys()), [(0, 0), (1, 0)])
+        self.assertTrue(rset.get_chunk(1, 0, fields=('Biomes', 'Sections')) is chunks[(1, 0)])
+        self.assertEquals(lru.hits, 1)
+
+    def test_cache_keys(self):
+        class DigestCache(dict):
+            digest_keys = True
+        lru = cache.LRUCache(size=10)
+        external = DigestCache()
+        rset = world.CachedRegionSet(self.regionset, [lru, external])
+        chunk = rset.get_chunk(0, 0, fields=('Sections', 'Biomes'))
+        key = (rset.key, 0, 0, ('Biomes', 'Sections'))
+        self.assertTrue(lru[key] is chunk)
+        self.assertEquals(external.keys(), [cache.digest_key(key)])
+
+        # a hit in the first tier doesn't need a digest at all
+        old_digest = cache.digest_key
+        def fail(key):
+            raise AssertionError("computed a digest")
+        cache.digest_key = fail
+        try:
+            self.assertTrue(rset.get_chunk(0, 0, fields=['Biomes', 'Sections']) is chunk)
+        finally:
+            cache.digest_key = old_digest
+
+        # backfilled from the digest-keyed tier
+        rset.caches = [cache.LRUCache(size=10), external]
+        self.assertTrue(rset.get_chunk(0, 0, fields=('Sections', 'Biomes')) is chunk)
+        self.assertTrue(rset.caches[0][key] is chunk)
+
+    def test_shared_cache(self):
+        shared = cache.SharedMemoryCache(1024 * 1024, prepare=world.decode_chunk_sections)
+        try:
+            rset = world.CachedRegionSet(self.regionset, [cache.LRUCache(size=10), shared])
+            chunk = rset.get_chunk(0, 0, fields=('Sections', 'Biomes'))
+            self.assertEquals(shared.stores, 1)
+
+            # a worker with its own empty LRU gets the decoded sections
+            other = cPickle.loads(cPickle.dumps(rset, -1))
+            chunk2 = other.get_chunk(0, 0, fields=('Sections', 'Biomes'))
+            self.assertEquals(other.caches[1].hits, 1)
+            for section, section2 in zip(chunk['Sections'], chunk2['Sections']):
+                self.assertTrue((section['Blocks'] == section2['Blocks']).all())
+                self.assertTrue((section['SkyLight'] == section2['SkyLight']).all())
+            other.caches[1].close()
+        finally:
+            shared.close()
+
+    def test_persistent_cache(self):
+        disk = cache.DiskCache(os.path.join(self.tmpdir, "chunkcache"), 1024 * 1024,
+                prepare=world.decode_chunk_sections)
+        rset = world.CachedRegionSet(self.regionset, [cache.LRUCache(size=10), disk])
+        chunk = rset.get_chunk(0, 0, fields=('Sections', 'Biomes'))
+
+        # a later run gets the decoded chunk from the disk
+        rset = world.CachedRegionSet(self.regionset, [cache.LRUCache(size=10), disk])
+        chunk2 = rset.get_chunk(0, 0, fields=('Sections', 'Biomes'))
+        self.assertEquals(disk.hits, 1)
+        self.assertFalse(isinstance(chunk2['Sections'][0]['Blocks'], str))
+        self.assertTrue((chunk['Sections'][1]['Blocks'] == chunk2['Sections'][1]['Blocks']).all())
+
+        # but not once the chunk has changed
+        old_mtime = self.regionset.get_chunk_mtime
+        self.regionset.get_chunk_mtime = lambda x, z: old_mtime(x, z) + 1
+        rset = world.CachedRegionSet(self.regionset, [cache.LRUCache(size=10), disk])
+        rset.get_chunk(0, 0, fields=('Sections', 'Biomes'))
+        self.assertEquals((disk.hits, disk.misses), (1, 2))
+
+    def test_corrupt_chunk(self):
+        regionpath = os.path.join(self.regionset.regiondir, "r.0.0.mca")
+        write_region(regionpath, {
+            (0, 0): (100, make_chunk(0, 0)),
+            (2, 2): (100, make_chunk(2, 2)[:-20]),
+            })
+        self.regionset = world.RegionSet(self.regionset.regiondir, "region")
+        found = []
+        handler = world.RegionSet.corrupt_chunk.register_local(
+                lambda *args: found.append(args))
+        try:
+            self.assertRaises(nbt.CorruptChunkError, self.regionset.get_chunk, 2, 2)
+            self.assertEquals(found, [(self.regionset.regiondir, 2, 2)])
+
+            # known to be corrupt, so it isn't read again
+            old_load = nbt.MCRFileReader.load_chunk
+            def fail(*args, **kwargs):
+                raise AssertionError("read a known corrupt chunk")
+            nbt.MCRFileReader.load_chunk = fail
+            try:
+                self.assertRaises(nbt.CorruptChunkError, self.regionset.get_chunk, 2, 2)
+                self.assertEquals(self.regionset.get_chunks([(2, 2)]), {})
+            finally:
+                nbt.MCRFileReader.load_chunk = old_load
+            self.assertEquals(len(found), 1)
+
+            # until the chunk is written again
+            write_region(regionpath, {
+                (0, 0): (100, make_chunk(0, 0)),
+                (2, 2): (101, make_chunk(2, 2)),
+                })
+            os.utime(regionpath, (1, 1))
+            self.assertEquals(self.regionset.get_chunk(2, 2)['xPos'], 2)
+        finally:
+            world.RegionSet.corrupt_chunk.local_functions.remove(handler)
+
+    def test_chunk_table(self):
+        def table(rset):
+            xs, zs, mtimes = rset.chunk_table()
+            self.assertEquals((xs.dtype, zs.dtype, mtimes.dtype), (numpy.int32,) * 3)
+            return sorted(zip(xs.tolist(), zs.tolist(), mtimes.tolist()))
+        expected = [(0, 0, 100), (1, 0, 100), (5, 3, 200)]
+        self.assertEquals(table(self.regionset), expected)
+        self.assertEquals(sorted(self.regionset.iterate_chunks()), expected)
+
+        for north_dir in (world.UPPER_RIGHT, world.LOWER_RIGHT, world.LOWER_LEFT):
+            rset = world.RotatedRegionSet(self.regionset, north_dir)
+            self.assertEquals(table(rset), sorted(rset.iterate_chunks()))
+            self.assertEquals(table(rset), sorted((rset.rotate(x, z) + (m,)) for x, z, m in expected))
+
+        rset = world.CroppedRegionSet(self.regionset, 0, 0, 31, 100)
+        self.assertEquals(table(rset), [(0, 0, 100), (1, 0, 100)])
+        self.assertEquals(table(world.CachedRegionSet(rset, [])), [(0, 0, 100), (1, 0, 100)])
+
+        self.regionset.use_timestamp_index(self.tmpdir)
+        self.assertEquals(table(self.regionset), expected)
+        self.assertEquals(table(world.RegionSet(self.regionset.regiondir, "region")), expected)
+
+    def test_estimate_chunk_size(self):
+        chunk = self.regionset.get_chunk(0, 0, fields=('Sections', 'Biomes'))
+        size = world.estimate_chunk_size(chunk)
+        # two sections, counted at their decoded size, plus the biomes
+        self.assertEquals(size, 2 * world.DECODED_SECTION_BYTES + chunk['Biomes'].nbytes)
+        for section in chunk['Sections']:
+            nbt.decode_section(section)
+        self.assertEquals(world.estimate_chunk_size(chunk), size)
+
+    def test_section_mask(self):
+        # the test chunks have sections 0 and 1
+        self.assertEquals(self.regionset.get_section_mask(0, 0), 0b11)
+        self.assertEquals(self.regionset.get_section_mask(7, 7), 0)
+        self.assertEquals(self.regionset.get_section_mask(40, 40), 0)
+
+        rset = world.RotatedRegionSet(self.regionset, world.UPPER_RIGHT)
+        self.assertEquals(rset.get_section_mask(*rset.rotate(5, 3)), 0b11)
+        rset = world.CroppedRegionSet(self.regionset, 0, 0, 31, 31)
+        self.assertEquals(rset.get_section_mask(1, 0), 0b11)
+        self.assertEquals(rset.get_section_mask(5, 3), 0)
+
+        # read from the cached chunk, packed or not
+        lru = cache.LRUCache(size=10)
+        rset = world.CachedRegionSet(self.regionset, [lru])
+        chunk = rset.get_chunk(0, 0, fields=('Sections', 'Biomes'))
+        self.assertEquals(rset.get_section_mask(0, 0, fields=('Sections', 'Biomes')), 0b11)
+        self.assertEquals(lru.hits, 1)
+        nbt.decode_section(chunk['Sections'][1])
+        self.assertEquals(world.chunk_section_mask(chunk), 0b11)
+
+        # all air
+        section = {'Y': 3, 'Blocks': "\x00" * 4096}
+        self.assertEquals(world.chunk_section_mask({'Sections': [section]}), 0)
+        section['Add'] = "\x00" * 100 + "\x01" + "\x00" * 1947
+        self.assertEquals(world.chunk_section_mask({'Sections': [section]}), 0b1000)
+        blocks = numpy.zeros((16, 16, 16), dtype=numpy.uint16)
+        self.assertEquals(world.chunk_section_mask({'Sections': [{'Y': 2, 'Blocks': blocks}]}), 0)
+
+    def test_pickle_keeps_regionfiles(self):
+        data = cPickle.dumps(self.regionset, -1)
+        shutil.rmtree(self.regionset.regiondir)
+        os.mkdir(self.regionset.regiondir)
+        rset = cPickle.loads(data)
+        self.assertEquals(rset.regionfiles, self.regionset.regionfiles)
+
+    def test_timestamp_index(self):
+        regiondir = self.regionset.regiondir
+        regionpath = os.path.join(regiondir, "r.0.0.mca")
+        expected = sorted(self.regionset.iterate_chunks())
+
+        self.regionset.use_timestamp_index(self.tmpdir)
+        self.assertEquals(sorted(self.regionset.iterate_chunks()), expected)
+
+        # a fresh regionset gets everything from the index, without opening
+        # any region file
+        rset = world.RegionSet(regiondir, "region")
+        rset.use_timestamp_index(self.tmpdir)
+        def fail(regionfile):
+            raise AssertionError("opened %s" % regionfile)
+        rset._get_regionobj = fail
+        self.assertEquals(sorted(rset.iterate_chunks()), expected)
+        self.assertEquals(rset.get_chunk_mtime(5, 3), 200)
+        self.assertEquals(rset.get_chunk_mtime(7, 7), None)
+
+        # changed regions are read again
+        write_region(regionpath, {(2, 2): (300, make_chunk(2, 2))})
+        os.utime(regionpath, (1, 1))
+        rset = world.RegionSet(regiondir, "region")
+        rset.use_timestamp_index(self.tmpdir)
+        self.assertEquals(list(rset.iterate_chunks()), [(2, 2, 300)])
+        self.assertEquals(rset.get_chunk_mtime(5, 3), None)
 
 if __name__ == "__main__":
     unittest.main()